@@ -0,0 +1,267 @@
+import argparse
+import json
+import sys
+from datetime import datetime
+
+import numpy as np
+
+from datasets import datasets
+import extractors
+
+"""
+Benchmarks a figure extractor on a dataset. The extractor is run on the dataset a number of times
+after some warm-up runs, and the per-document processing times the extractor reports (see
+`ProcessingStatistics` in FigureExtractorBatchCli) are used to build per-document latency
+percentiles and a pages per second throughput that do not include the time taken to start sbt or the
+JVM. Results are saved as a JSON report that can be compared to a previously saved baseline.
+"""
+
+# version 1: Initial version
+# version 2: Add per-stage timings
+REPORT_VERSION = 2
+
+PERCENTILES = [50, 90, 99]
+
+""" Summary metrics where a larger value is worse, and those where a smaller value is worse """
+LOWER_IS_BETTER = ["p50_ms", "p90_ms", "p99_ms", "mean_ms", "processing_time", "startup_time"]
+HIGHER_IS_BETTER = ["pages_per_sec"]
+
+
+def run_benchmark(extractor, filenames, repeats, warmup, extract_images, verbose):
+    """
+    Runs `extractor` on `filenames` `warmup` times without recording anything, then `repeats` more times.
+    Returns a list, one entry per measured run, of (wall_time, list of per-document statistics)
+    """
+    for i in range(warmup):
+        if verbose:
+            print("Warm-up run %d/%d" % (i + 1, warmup))
+        extractor.run_with_stats(filenames, extract_images)
+    runs = []
+    for i in range(repeats):
+        wall_time, stats = extractor.run_with_stats(filenames, extract_images)
+        if verbose:
+            print("Run %d/%d: %0.2f seconds" % (i + 1, repeats, wall_time))
+        runs.append((wall_time, stats))
+    return runs
+
+
+def build_report(runs, file_to_doc_id):
+    """
+    Builds the report dictionary for `runs`, as returned by `run_benchmark`. A document's latency is the
+    median of its processing times across runs, documents that failed in any run are excluded from the
+    percentiles and listed under "errors" instead
+    """
+    documents = {}
+    errors = {}
+    run_summaries = []
+    all_stats = []
+    for wall_time, stats in runs:
+        all_stats += stats
+        processing_ms = 0
+        for entry in stats:
+            doc_id = file_to_doc_id.get(entry["filename"], entry["filename"])
+            if "timeInMillis" not in entry:
+                errors[doc_id] = "%s: %s" % (entry.get("className"), entry.get("msg"))
+                continue
+            processing_ms += entry["timeInMillis"]
+            doc = documents.setdefault(doc_id, dict(pages=entry["numPages"], figures=entry["numFigures"]
+                                                    if "numFigures" in entry else None, latency_ms=[]))
+            doc["latency_ms"].append(entry["timeInMillis"])
+        # What is left of the wall-clock time once documents have been processed is JVM (and sbt)
+        # startup and shutdown, which is close to zero for extractors that stay running between runs
+        run_summaries.append(dict(wall_time=wall_time, processing_time=processing_ms / 1000.0,
+                                  startup_time=max(wall_time - processing_ms / 1000.0, 0)))
+
+    for doc_id in errors:
+        documents.pop(doc_id, None)
+    latencies = np.array([np.median(x["latency_ms"]) for x in documents.values()], dtype=np.float64)
+    total_pages = sum(x["pages"] for x in documents.values())
+    processing_time = float(np.median([x["processing_time"] for x in run_summaries]))
+    summary = dict(
+        num_documents=len(documents), num_pages=total_pages, num_errors=len(errors),
+        mean_ms=float(latencies.mean()) if len(latencies) > 0 else None,
+        processing_time=processing_time,
+        startup_time=float(np.median([x["startup_time"] for x in run_summaries])),
+        pages_per_sec=total_pages * 1000.0 / latencies.sum() if latencies.sum() > 0 else None
+    )
+    for p in PERCENTILES:
+        summary["p%d_ms" % p] = float(np.percentile(latencies, p)) if len(latencies) > 0 else None
+    return dict(summary=summary, runs=run_summaries, documents=documents, errors=errors,
+                stages=build_stage_report(all_stats))
+
+
+def get_histogram_edges():
+    """ Bucket edges, in milliseconds, used for stage timing histograms """
+    return [0] + [2 ** i for i in range(17)] + [np.inf]
+
+
+def build_stage_report(stats):
+    """
+    Aggregates the `stageTimings` and `pageTimings` of the `ProcessingStatistics` dictionaries in `stats`.
+    Returns a dictionary of stage -> summary, where each summary has the total milliseconds spent in the
+    stage, percentiles of the per-document times and a histogram of the per-document times (a list of
+    counts, one per bucket from `get_histogram_edges`). Stages that are timed per page also get the same
+    summary of their per-page times under "pages"
+    """
+    doc_times = {}
+    page_times = {}
+    for entry in stats:
+        for stage, millis in entry.get("stageTimings", {}).items():
+            doc_times.setdefault(stage, []).append(millis)
+        for stage, pages in entry.get("pageTimings", {}).items():
+            page_times.setdefault(stage, []).extend(pages.values())
+
+    edges = get_histogram_edges()
+
+    def summarize(times):
+        times = np.array(times, dtype=np.float64)
+        summary = dict(count=len(times), total_ms=float(times.sum()),
+                       histogram=[int(x) for x in np.histogram(times, edges)[0]])
+        for p in PERCENTILES:
+            summary["p%d_ms" % p] = float(np.percentile(times, p))
+        return summary
+
+    stages = {}
+    for stage, times in doc_times.items():
+        stages[stage] = summarize(times)
+        if stage in page_times:
+            stages[stage]["pages"] = summarize(page_times[stage])
+    return stages
+
+
+def print_stage_report(stages):
+    """ Prints the summary of each stage in `stages`, as built by `build_stage_report` """
+    if len(stages) == 0:
+        print("No stage timings found")
+        return
+    edges = get_histogram_edges()
+    total = sum(x["total_ms"] for x in stages.values())
+    print("%-18s %12s %7s %10s %10s %10s" % ("stage", "total ms", "%", "p50 ms", "p90 ms", "p99 ms"))
+    ordered = sorted(stages.items(), key=lambda x: -x[1]["total_ms"])
+    for stage, summary in ordered:
+        print("%-18s %12.1f %6.1f%% %10.2f %10.2f %10.2f" % (
+            stage, summary["total_ms"], summary["total_ms"] * 100.0 / max(total, 1e-9),
+            summary["p50_ms"], summary["p90_ms"], summary["p99_ms"]))
+    for stage, summary in ordered:
+        for name, values in [(stage + " (per document)", summary), (stage + " (per page)", summary.get("pages"))]:
+            if values is None:
+                continue
+            print("")
+            print(name)
+            scale = max(values["histogram"])
+            for i, count in enumerate(values["histogram"]):
+                if count == 0:
+                    continue
+                label = ">= %g ms" % edges[i] if edges[i + 1] == np.inf else "< %g ms" % edges[i + 1]
+                print("  %10s %6d %s" % (label, count, "#" * int(round(count * 40.0 / scale))))
+
+
+def compare_to_baseline(summary, baseline_summary, threshold):
+    """
+    Returns a list of (metric, baseline value, value, relative change) for each metric in `summary` that
+    got worse by more than `threshold` (a fraction) compared to `baseline_summary`
+    """
+    regressions = []
+    for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+        old, new = baseline_summary.get(metric), summary.get(metric)
+        if old is None or new is None or old == 0:
+            continue
+        change = (new - old) / old
+        if (metric in LOWER_IS_BETTER and change > threshold) or \
+                (metric in HIGHER_IS_BETTER and change < -threshold):
+            regressions.append((metric, old, new, change))
+    return regressions
+
+
+def print_summary(summary, baseline_summary=None):
+    metrics = ["p50_ms", "p90_ms", "p99_ms", "mean_ms", "pages_per_sec", "processing_time", "startup_time"]
+    print("%d documents, %d pages, %d errors" % (summary["num_documents"], summary["num_pages"],
+                                                 summary["num_errors"]))
+    for metric in metrics:
+        value = summary[metric]
+        line = "%-16s %10s" % (metric, "-" if value is None else "%0.2f" % value)
+        if baseline_summary is not None and baseline_summary.get(metric) is not None and value is not None:
+            old = baseline_summary[metric]
+            line += "   baseline %10.2f" % old
+            if old != 0:
+                line += " (%+0.1f%%)" % ((value - old) * 100.0 / old)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark a figure extractor')
+    parser.add_argument("dataset", choices=list(datasets.DATASETS.keys()), help="Name of the dataset to benchmark on")
+    parser.add_argument("extractor", choices=list(extractors.EXTRACTORS.keys()),
+                        help="Name of the extractor to benchmark")
+    parser.add_argument("-n", "--repeats", type=int, default=3, help="Number of measured runs")
+    parser.add_argument("-u", "--warmup", type=int, default=1, help="Number of warm-up runs before measuring")
+    parser.add_argument("-w", "--write-figures", action="store_true")
+    parser.add_argument("-r", "--compare-non-standard", action='store_true', help="Don't skip PDF in the dataset that" +
+                                                                                  "are marked as being non-standard")
+    parser.add_argument("-d", "--docs", nargs="+", help="Only benchmark on these documents")
+    parser.add_argument("-o", "--output", help="Save the report as JSON to this file")
+    parser.add_argument("-b", "--baseline", help="Compare to the report saved in this file")
+    parser.add_argument("-t", "--threshold", type=float, default=0.1,
+                        help="Relative change compared to the baseline that counts as a regression")
+    parser.add_argument("-s", "--stages", action='store_true', help="Print per-stage timings and histograms")
+    parser.add_argument("-q", "--quiet", action='store_true', help="Reduce printed output")
+    args = parser.parse_args()
+    if args.repeats < 1:
+        raise ValueError("Repeats must be >= 1")
+
+    verbose = not args.quiet
+    dataset = datasets.get_dataset(args.dataset)
+    doc_ids_to_use = dataset.get_doc_ids() if args.docs is None else args.docs
+
+    if not args.compare_non_standard:
+        nonstandard_docs = dataset.get_nonstandard_doc_ids()
+        nonstandard_docs = nonstandard_docs.intersection(doc_ids_to_use)
+        print("Skipping %d non-standard docs" % len(nonstandard_docs))
+        doc_ids_to_use = list(set(doc_ids_to_use) - nonstandard_docs)
+
+    file_map = dataset.get_pdf_file_map()
+    doc_ids_to_use = sorted(doc_ids_to_use)
+    filenames = [file_map[x] for x in doc_ids_to_use]
+    file_to_doc_id = {file_map[x]: x for x in doc_ids_to_use}
+    extractor = extractors.get_extractor(args.extractor)
+    print("Benchmarking extractor %s on dataset %s (%d docs, %d warm-up runs, %d runs)" % (
+        args.extractor, args.dataset, len(filenames), args.warmup, args.repeats))
+    try:
+        runs = run_benchmark(extractor, filenames, args.repeats, args.warmup, args.write_figures, verbose)
+    finally:
+        if hasattr(extractor, "close"):
+            extractor.close()
+
+    report = build_report(runs, file_to_doc_id)
+    report.update(
+        version=REPORT_VERSION, dataset_name=args.dataset, dataset_version=dataset.get_version(),
+        extractor_name=extractor.NAME, extractor_version=extractor.get_version(),
+        extractor_config=extractor.get_config(), repeats=args.repeats, warmup=args.warmup,
+        timestamp=datetime.now().isoformat())
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["dataset_name"] != args.dataset or \
+                set(baseline["documents"].keys()) != set(report["documents"].keys()):
+            print("WARNING: baseline was run on different documents")
+    print_summary(report["summary"], None if baseline is None else baseline["summary"])
+    if args.stages:
+        print("")
+        print_stage_report(report["stages"])
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare_to_baseline(report["summary"], baseline["summary"], args.threshold)
+        for metric, old, new, change in regressions:
+            print("REGRESSION: %s went from %0.2f to %0.2f (%+0.1f%%)" % (metric, old, new, change * 100))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
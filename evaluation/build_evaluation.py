@@ -1,136 +1,138 @@
 from datasets import datasets
 import extractors
+from extraction_cache import ExtractionCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_SIZE
+from grading import FigurePairs, StreamingGrader
+from evaluation_store import ColumnarEvaluationWriter
 import sys
 from pdffigures_utils import *
 import argparse
-from os.path import isfile
+from os.path import exists, getsize
 import pickle
 from time import time, strftime
-from parse_evaluation import print_pr
+from parse_evaluation import print_error_counts
 from multiprocessing import Pool
 
 """
 Script for evaluating an extractor against a dataset
 """
 
-""" How high the intersection/union ration of two bounding boxes has to be
-for them to be considered correct """
-UNION_INTERSECT_OVERLAP_THRESH = 0.8
+""" Default number of documents graded, and saved as one part of columnar output, at a time """
+DEFAULT_PART_SIZE = 100
 
 
-def pair_extractions(labels, extractions):
+def evaluate(dataset, extractor, doc_ids_to_use, crop_extractions, verbose, only_annotated_pages=True,
+             cache=None, grader=None):
     """
-    :param labels: list of 'Label' figures, currently we assume they are uniquely identified
-        by (page, figure_type, and number)
-    :param extractions: list of 'extraction' Figures
-    :return: yields (true_figure, extracted_figure) for each name found in either
-             labels of extractions, either true_figure or extracted_figure may be None
-             if there were figures in `extractions` that were not found in `labels` or vice versa
+    Runs `extractor` on the given documents and returns `FigurePairs` of its extractions and the labels. If
+    `grader` (a `StreamingGrader`) is given the pairs of each document are added to it as soon as they are
+    built instead, and the returned `FigurePairs` is empty
     """
+    pairs = FigurePairs()
+    bitmap_cache = PageBitmapCache()
+    documents = dataset.load_doc_ids(doc_ids_to_use)
+    if only_annotated_pages:
+        # Extractions on other pages are discarded when grading, so don't ask the extractor for them
+        pages = {doc.doc_id: doc.pages_annotated for doc in documents}
+    else:
+        pages = None
 
-    label_ids_to_fig = {fig.get_id(): fig for fig in labels}
-    if len(label_ids_to_fig) != len(labels):
-        raise ValueError("Multiple labels with the same ID")
+    # Only run the extractor on documents we do not have cached extractions for
+    cached_extractions = {}
+    if cache is not None:
+        for doc in documents:
+            extractions = cache.get(doc.pdffile, None if pages is None else pages[doc.doc_id])
+            if extractions is not None:
+                cached_extractions[doc.doc_id] = extractions
+        if verbose:
+            print("Loaded cached extractions for %d of %d documents" % (len(cached_extractions), len(documents)))
+    to_extract = [doc for doc in documents if doc.doc_id not in cached_extractions]
+    if len(to_extract) > 0:
+        extractor.start_batch([x.pdffile for x in to_extract], pages)
 
-    ids_in_extractions = set(fig.get_id() for fig in extractions)
-    for fig_id, fig in label_ids_to_fig.items():
-        if fig_id not in ids_in_extractions:
-            yield fig, None
+    for i, doc in enumerate(documents):
+        if verbose:
+            print("checking PDF %s (%d of %d)" % (doc.doc_id, i + 1, len(documents)))
+        if doc.doc_id in cached_extractions:
+            extractions = cached_extractions[doc.doc_id]
+        else:
+            extractions = extractor.get_extractions(doc.pdffile, dataset.NAME, doc.doc_id)
+            if extractions is None:
+                # The extractor failed on this document, grade it as having no extractions but don't cache
+                # that so the document is retried on the next run
+                extractions = []
+            elif cache is not None:
+                cache.put(doc.pdffile, extractions, None if pages is None else pages[doc.doc_id])
+        if grader is None:
+            pairs.add_document(doc, extractions, crop_extractions, bitmap_cache)
+        else:
+            doc_pairs = FigurePairs()
+            doc_pairs.add_document(doc, extractions, crop_extractions, bitmap_cache)
+            grader.add(doc_pairs, 1)
 
-    for fig in extractions:
-        fig_id = fig.get_id()
-        yield label_ids_to_fig.get(fig_id), fig
+    return pairs
 
 
-def grade_document_extractions(document, extractions, compare_caption_text, crop_extractions):
+def make_batches(doc_ids, weights, batch_size=None, num_batches=None):
     """
-    Evaluates an extraction
-
-    :param document: data/dataset.Document containing the true figures
-    :param extractions: list of utils.Figure an extractor returned
-    :param compare_caption_text: whether to grade captions by comparing the caption text as well as comparing
-        the bounding boxes of the captions
-    :param crop_extractions: whether to whitepsace crop the extractions
-    :return: List of utils.EvaluatedFigure
+    Splits `doc_ids` into batches to hand out to worker processes, heaviest documents first so stragglers
+    do not hold up the end of a run. If `num_batches` is given documents are instead spread over that many
+    batches so each batch has roughly the same total weight.
     """
-    evaluated_figures = []
-    pages = document.pages_annotated
-    true_figures = document.figures
-    extracted_figures = []
-    for ex in extractions:
-        if ex.page in pages:
-            extracted_figures.append(ex)
-
-    for true_figure, extracted_figure in pair_extractions(true_figures, extracted_figures):
-        grayscale_images = document.gray_images
-        if crop_extractions and grayscale_images is None:
-            raise ValueError("Unable to corp extraction since grayscale image have not been built" +
-                             " for document %s" % document.doc_id)
-        if extracted_figure is None:
-            if true_figure is None:
-                raise RuntimeError()
-            error = Error.missing
-        elif extracted_figure.caption_bb is None:
-            error = Error.no_caption_found
-        elif true_figure is None:
-            if extracted_figure.region_bb is None:
-                error = Error.false_positive_no_region
-            else:
-                error = Error.false_positive
-        else:
-            # At this point we have a valid `true_figure` and an `extracted_figure` with a caption_bb
-            page = true_figure.page
-            if crop_extractions:
-                gray_img = Image.open(grayscale_images[page])
-                bw_img = gray_img.convert('L').point(lambda x: 0 if x<200 else 255, '1')
-                extracted_capt_box, extracted_region_box = \
-                    scale_and_crop_figure(extracted_figure, bw_img, document.dpi)
-            else:
-                extracted_capt_box, extracted_region_box = scale_figure(extracted_figure, document.dpi)
-            true_capt_box, true_region_box = scale_figure(true_figure, document.dpi)
-            caption_correct = box_overlap(extracted_capt_box, true_capt_box)[0] >= UNION_INTERSECT_OVERLAP_THRESH
-            if not caption_correct and compare_caption_text:
-                caption_correct = compare_captions(true_figure.caption, extracted_figure.caption)
-            if extracted_region_box is None:
-                if caption_correct:
-                    error = Error.right_caption_no_region
-                else:
-                    error = Error.wrong_caption_no_region
-            else:
-                region_correct = box_overlap(extracted_region_box, true_region_box)[0] >= UNION_INTERSECT_OVERLAP_THRESH
-                if not region_correct and not caption_correct:
-                    error = Error.wrong_caption_and_region
-                elif not region_correct:
-                    error = Error.wrong_region_box
-                elif not caption_correct:
-                    error = Error.wrong_caption_box
-                else:
-                    error = Error.correct
-
-        evaluated_figures.append(EvaluatedFigure(true_figure, extracted_figure, error, document.doc_id))
-
-    num_missing = sum(1 for x in evaluated_figures if x.error == Error.missing)
-
-    # Sanity check, one error per output minus the missing examples
-    if len(extracted_figures) != (len(evaluated_figures) - num_missing):
-        raise ValueError("Have %d extractions %d errors - %d missing = %d recorded" % (len(extracted_figures),
-            len(evaluated_figures), num_missing, len(evaluated_figures) - num_missing))
-    return evaluated_figures
-
-
-def evaluate(dataset, extractor, doc_ids_to_use,
-             compare_caption_text, crop_extractions, verbose):
-    all_errors = []
-    documents = dataset.load_doc_ids(doc_ids_to_use)
-    extractor.start_batch([x.pdffile for x in documents])
-    for i, doc in enumerate(documents):
-        if verbose:
-            print("checking PDF %s (%d of %d)" % (doc.doc_id, i + 1, len(documents)))
-        extractions = extractor.get_extractions(doc.pdffile, dataset.NAME, doc.doc_id)
-        errors = grade_document_extractions(doc, extractions, compare_caption_text, crop_extractions)
-        all_errors += errors
+    ordered = sorted(doc_ids, key=lambda x: weights[x], reverse=True)
+    if num_batches is not None:
+        batches = [[] for _ in range(num_batches)]
+        loads = [0] * num_batches
+        for doc_id in ordered:
+            lightest = loads.index(min(loads))
+            batches[lightest].append(doc_id)
+            loads[lightest] += weights[doc_id]
+        return [x for x in batches if len(x) > 0]
+    return [ordered[i:i + batch_size] for i in range(0, len(ordered), batch_size)]
+
+
+# Arguments shared by every batch a worker process evaluates, set by `_init_worker`
+_worker_args = None
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _evaluate_batch(doc_ids):
+    dataset, extractor, crop, only_annotated_pages, cache = _worker_args
+    return doc_ids, evaluate(dataset, extractor, doc_ids, crop, False, only_annotated_pages, cache)
 
-    return all_errors
+
+def evaluate_in_parallel(dataset, extractor, doc_ids_to_use, crop_extractions, verbose, only_annotated_pages, cache,
+                         processes, weights, batch_size=None, num_batches=None, grader=None):
+    """
+    Evaluates `doc_ids_to_use` with a pool of `processes` workers. Batches of documents (see `make_batches`)
+    are handed out to whichever worker is free and the results are collected as each batch completes, or
+    added to `grader` if it is given (the returned `FigurePairs` is then empty)
+    """
+    batches = make_batches(doc_ids_to_use, weights, batch_size, num_batches)
+    total_weight = sum(weights[x] for x in doc_ids_to_use)
+    done_weight = 0
+    num_done = 0
+    pairs = FigurePairs()
+    t0 = time()
+    init_args = (dataset, extractor, crop_extractions, only_annotated_pages, cache)
+    with Pool(processes, initializer=_init_worker, initargs=init_args) as pool:
+        for doc_ids, batch_pairs in pool.imap_unordered(_evaluate_batch, batches):
+            if grader is None:
+                pairs.extend(batch_pairs)
+            else:
+                grader.add(batch_pairs, len(doc_ids))
+            num_done += len(doc_ids)
+            done_weight += sum(weights[x] for x in doc_ids)
+            if verbose:
+                elapsed = time() - t0
+                # Estimate time remaining by weight, since documents are processed heaviest first
+                eta = elapsed * (total_weight - done_weight) / max(done_weight, 1)
+                print("Finished %d of %d documents (%0.1f%%), %0.1f seconds elapsed, ETA %0.1f seconds" % (
+                    num_done, len(doc_ids_to_use), 100.0 * done_weight / max(total_weight, 1), elapsed, eta))
+    return pairs
 
 
 def main():
@@ -146,8 +148,25 @@ def main():
     parser.add_argument("-d", "--docs", nargs="+", help="Which document ids to evaluate on, can't be used in conjunction with `which`")
     parser.add_argument("-o", "--output", nargs="?", const=True, help="Where to store the output, " +
         "if this -o flag is used without parameters a default filename is chosen based on the current date.")
+    parser.add_argument("--format", choices=["pickle", "columnar"], default="pickle", help="Save the output as a " +
+                        "pickled Evaluation or as a directory in the columnar format (see evaluation_store.py)")
     parser.add_argument("-r", "--compare-non-standard", action='store_true', help="Don't skip PDF in the dataset that" +
                                                                                   "are marked as being non-standard")
+    parser.add_argument("-a", "--extract-all-pages", action='store_true', help="Have the extractor process every " +
+                        "page of each PDF, not just the pages that were annotated")
+    parser.add_argument("--no-cache", action='store_true', help="Don't read or write cached extractions")
+    parser.add_argument("--refresh", action='store_true', help="Re-run the extractor on every document and " +
+                        "overwrite any cached extractions")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory to cache extractions in")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_SIZE // (1024 * 1024),
+                        help="Maximum size of the extraction cache in megabytes")
+    parser.add_argument("--batch-size", type=int, help="Number of documents to hand a worker at once when " +
+                        "using multiple processes. Defaults to one, except for extractors that have to be " +
+                        "restarted for every batch where the documents are split evenly between the processes. " +
+                        "Documents are also graded, and saved as a part of columnar output, in batches of this " +
+                        "many documents (%d by default)" % DEFAULT_PART_SIZE)
+    parser.add_argument("--order", choices=["size", "pages"], default="size", help="Process documents with the " +
+                        "largest files or the most pages first when using multiple processes")
     args = parser.parse_args()
 
     dataset = datasets.get_dataset(args.dataset)
@@ -157,12 +176,14 @@ def main():
     if args.output is not None:
         if args.output == True:
             time_str = strftime("%m-%d-%H-%M")
-            output_file = "%s-%s_%s.pkl" % (args.dataset, args.extractor, time_str)
+            output_file = "%s-%s_%s" % (args.dataset, args.extractor, time_str)
+            if args.format == "pickle":
+                output_file += ".pkl"
             print("Using output file %s" % output_file)
         else:
             output_file = args.output
-        if isfile(args.output):
-            raise ValueError("File %s already exists" % args.output)
+        if exists(output_file):
+            raise ValueError("File %s already exists" % output_file)
     else:
         output_file = None
 
@@ -192,32 +213,60 @@ def main():
     # Load the extractor to use and set `evaluation` to the completed evaluation
     extractor = extractors.get_extractor(args.extractor)
     print("Evaluating %s (%s)" % (sys.argv[2], extractor.get_version()))
+    only_annotated_pages = not args.extract_all_pages
+    if args.no_cache:
+        cache = None
+    else:
+        cache = ExtractionCache(extractor.NAME, extractor.get_version(), extractor.get_config(),
+                                extractor.get_build_id(), args.cache_dir, args.cache_size * 1024 * 1024,
+                                args.refresh)
+    # Columnar output is written a part at a time as documents are graded, so an interrupted run keeps the
+    # parts it completed
+    if output_file is not None and args.format == "columnar":
+        writer = ColumnarEvaluationWriter(output_file, dataset.NAME, dataset.get_version(),
+                                          extractor.NAME, extractor.get_version(),
+                                          extractor.get_config(), compare_caption_text, doc_ids_to_use, time())
+    else:
+        writer = None
+    part_size = args.batch_size if args.batch_size is not None else DEFAULT_PART_SIZE
+    grader = StreamingGrader(compare_caption_text, part_size, writer)
     if args.processes == 1:
-        evaluated_figures = evaluate(dataset, extractor, doc_ids_to_use, compare_caption_text, crop, verbose)
+        evaluate(dataset, extractor, doc_ids_to_use, crop, verbose, only_annotated_pages, cache, grader)
     else:
-        pool = Pool(args.processes)
-        num_docs = len(doc_ids_to_use)
-        chunk_size = num_docs // args.processes + 1
-        chunks = [doc_ids_to_use[i:i + chunk_size] for i in
-                  range(0, num_docs, chunk_size)]
-        chunks_with_args = [(dataset, extractors.get_extractor(args.extractor),
-                             x, compare_caption_text, crop, verbose) for x in chunks]
-        evaluated_figures = []
-        for evaluated_figures_in_chunk in pool.starmap(evaluate, chunks_with_args):
-                evaluated_figures += evaluated_figures_in_chunk
-
-    evaluation = Evaluation(dataset.NAME, dataset.get_version(),
-                            extractor.NAME, extractor.get_version(),
-                            extractor.get_config(), evaluated_figures,
-                            compare_caption_text, doc_ids_to_use, time())
+        pdf_file_map = dataset.get_pdf_file_map()
+        if args.order == "size":
+            weights = {x: getsize(pdf_file_map[x]) for x in doc_ids_to_use}
+        else:
+            weights = {x: get_num_pages_in_pdf(pdf_file_map[x]) for x in doc_ids_to_use}
+        batch_size, num_batches = args.batch_size, None
+        if isinstance(extractor, extractors.PDFFigures2Server):
+            # Share one server between all the workers
+            extractor.start_server(threads=args.processes)
+        elif batch_size is None and isinstance(extractor, extractors.PDFFigures2):
+            # Each batch restarts sbt, so use one large batch per process
+            num_batches = args.processes
+        if batch_size is None:
+            batch_size = 1
+        evaluate_in_parallel(dataset, extractor, doc_ids_to_use, crop, verbose, only_annotated_pages, cache,
+                             args.processes, weights, batch_size, num_batches, grader)
+    graded_figures = grader.finish()
 
     # Save the resulting evaluation
-    if output_file is not None:
+    if writer is not None:
+        print("Evaluation saved to %s" % output_file)
+    elif output_file is not None:
+        # Only build every `EvaluatedFigure` when they are going to be pickled, the summary below is computed
+        # from the graded columns
+        evaluation = Evaluation(dataset.NAME, dataset.get_version(),
+                                extractor.NAME, extractor.get_version(),
+                                extractor.get_config(), list(graded_figures),
+                                compare_caption_text, doc_ids_to_use, time())
         with open(output_file, "wb") as f:
             pickle.dump(evaluation, f)
             print("Evaluation saved to %s" % output_file)
 
-    print_pr(evaluation, False)
+    print_error_counts(graded_figures.get_error_counts(FigureType.table),
+                       graded_figures.get_error_counts(FigureType.figure), False)
 
 if __name__ == "__main__":
     main()
@@ -1,23 +1,121 @@
 import argparse
-import pickle
+import csv
 from collections import defaultdict
+from os.path import isdir
+import numpy as np
+from evaluation_store import ColumnarEvaluation, load_evaluation
+from pdffigures_utils import Error, FigureType
 
 """
-Script for comparing two Evaluation objects
+Script for comparing two Evaluation objects, or for tracking how the errors on each figure change
+across many Evaluations
 """
 
-def main():
-    parser = argparse.ArgumentParser(description='Compare two evaluations')
-    parser.add_argument("evaluation1")
-    parser.add_argument("evaluation2")
-    parser.add_argument("-d", "--documents", nargs="+", help="Only compare on these documents")
-    args = parser.parse_args()
 
-    with open(args.evaluation1, "rb") as f:
-        eval1 = pickle.load(f)
-    with open(args.evaluation2, "rb") as f:
-        eval2 = pickle.load(f)
+def load_errors(path):
+    """
+    Returns the evaluation at `path` and lists of the doc, name (as in `EvaluatedFigure.name`) and `Error`
+    value of each of its figures. Columnar evaluations are read without building `EvaluatedFigure`s.
+    """
+    if isdir(path):
+        evaluation = ColumnarEvaluation(path)
+        c = evaluation.load_columns(["doc", "name", "page", "figure_type", "error"])
+        names = ["%s%s p=%d" % ("F" if t == FigureType.figure.value else "T", name, page)
+                 for name, page, t in zip(c["name"], c["page"], c["figure_type"])]
+        return evaluation, c["doc"], names, list(c["error"])
+    evaluation = load_evaluation(path)
+    figs = evaluation.evaluated_figures
+    return evaluation, [x.doc for x in figs], [x.name for x in figs], [x.error.value for x in figs]
+
+
+def build_error_matrix(runs, docs):
+    """
+    Indexes the figures of each run in `runs`, a list of (docs, names, errors) lists as returned by
+    `load_errors`, by (doc, name). Returns the list of figure ids and a (figures x runs) array of `Error`
+    values, 0 where a run does not have that figure. Only figures in `docs` are included.
+    """
+    index = {}
+    rows = []
+    for run, (fig_docs, names, errors) in enumerate(runs):
+        # Figures that share an id (which can happen for false positives) are told apart by the order
+        # they occur in
+        occurrences = defaultdict(int)
+        for doc, name, error in zip(fig_docs, names, errors):
+            if doc not in docs:
+                continue
+            fig_id = (doc, name, occurrences[(doc, name)])
+            occurrences[(doc, name)] += 1
+            if fig_id not in index:
+                index[fig_id] = len(rows)
+                rows.append([0] * len(runs))
+            rows[index[fig_id]][run] = error
+    fig_ids = [None] * len(index)
+    for fig_id, i in index.items():
+        fig_ids[i] = fig_id
+    return fig_ids, np.array(rows, dtype=np.int8).reshape(len(rows), len(runs))
+
+
+def compare_many(paths, documents, show_all, matrix_output):
+    runs = []
+    evaluations = []
+    for path in paths:
+        evaluation, fig_docs, names, errors = load_errors(path)
+        evaluations.append(evaluation)
+        runs.append((fig_docs, names, errors))
+        print("Loaded %s: %s (version=%s), %d figures" % (
+            path, evaluation.extractor_name, evaluation.extractor_version, len(errors)))
+
+    if len(set(x.dataset_name for x in evaluations)) != 1:
+        raise ValueError("Evaluations had different datasets (%s)" % ", ".join(x.dataset_name for x in evaluations))
+    if len(set(str(x.dataset_version) for x in evaluations)) != 1:
+        print("WARNING: Evaluation compared different dataset versions")
+    if len(set(x.compare_caption_text for x in evaluations)) != 1:
+        print("WARNING: Some evaluations compared text and some did not")
+
+    same_docs = set(evaluations[0].docs)
+    for evaluation in evaluations[1:]:
+        same_docs.intersection_update(evaluation.docs)
+    print("Evaluations shared %d docs" % len(same_docs))
+    if documents is not None:
+        if any(x not in same_docs for x in documents):
+            raise ValueError()
+        same_docs = set(documents)
+
+    fig_ids, matrix = build_error_matrix(runs, same_docs)
+    changed = np.any(matrix != matrix[:, :1], axis=1)
+    print("%d of %d figures had different outcomes between runs" % (changed.sum(), len(fig_ids)))
 
+    def error_name(value):
+        return "-" if value == 0 else Error(int(value)).name
+
+    order = sorted(range(len(fig_ids)), key=lambda i: fig_ids[i])
+    print()
+    print("Error matrix (runs in the order given, '-' if a run did not have the figure):")
+    for i in order:
+        if show_all or changed[i]:
+            doc, name, _ = fig_ids[i]
+            print("%s: %s %s" % (doc, name, " ".join(error_name(x) for x in matrix[i])))
+
+    print()
+    for run in range(len(paths) - 1):
+        differs = np.flatnonzero(matrix[:, run] != matrix[:, run + 1])
+        changed_docs = sorted(set(fig_ids[i][0] for i in differs))
+        print("%s -> %s: %d figures in %d documents changed" % (
+            paths[run], paths[run + 1], len(differs), len(changed_docs)))
+        for doc in changed_docs:
+            print("    %s" % doc)
+
+    if matrix_output is not None:
+        with open(matrix_output, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["doc", "figure"] + paths)
+            for i in order:
+                doc, name, _ = fig_ids[i]
+                writer.writerow([doc, name] + [error_name(x) for x in matrix[i]])
+        print("Error matrix saved to %s" % matrix_output)
+
+
+def compare_two(eval1, eval2, documents):
     if eval1.dataset_name != eval2.dataset_name:
         raise ValueError("Evaluations had different datasets (%s vs %s)" % (
                 eval1.dataset_name, eval2.dataset_name))
@@ -30,10 +128,10 @@ def main():
     same_docs = set(eval1.docs).intersection(set(eval2.docs))
     print("Evaluations shared %d docs (%d in eval1, %d in eval2)" % (len(same_docs), len(eval1.docs), len(eval2.docs)))
 
-    if args.documents is not None:
-        if any(x not in same_docs for x in args.documents):
+    if documents is not None:
+        if any(x not in same_docs for x in documents):
             raise ValueError()
-        same_docs = set(args.documents)
+        same_docs = set(documents)
 
     differences = 0
     # Build dictionary of figure_id -> all EvaluatedFigures with that id for evaluation1
@@ -89,5 +187,25 @@ def main():
 
     print("Total of %d differences" % differences)
 
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare evaluations')
+    parser.add_argument("evaluations", nargs="+", help="Evaluations to compare, if more than two are given " +
+                        "(or --matrix is set) prints a matrix of the error on each figure in each evaluation")
+    parser.add_argument("-d", "--documents", nargs="+", help="Only compare on these documents")
+    parser.add_argument("-m", "--matrix", action='store_true', help="Print the error matrix even if there are " +
+                        "only two evaluations")
+    parser.add_argument("-a", "--all", action='store_true', help="Include figures with the same outcome in " +
+                        "every evaluation in the error matrix")
+    parser.add_argument("-o", "--matrix-output", help="Save the full error matrix to this CSV file")
+    args = parser.parse_args()
+
+    if len(args.evaluations) < 2:
+        raise ValueError("Need at least two evaluations to compare")
+    if len(args.evaluations) == 2 and not args.matrix and args.matrix_output is None:
+        compare_two(load_evaluation(args.evaluations[0]), load_evaluation(args.evaluations[1]), args.documents)
+    else:
+        compare_many(args.evaluations, args.documents, args.all, args.matrix_output)
+
 if __name__ == "__main__":
     main()
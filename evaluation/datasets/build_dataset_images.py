@@ -1,18 +1,92 @@
 import argparse
+import os
+from collections import defaultdict
+from multiprocessing import Pool
 from os import listdir, mkdir
-from os.path import join, isdir
+from os.path import join, isdir, dirname, abspath, basename
 from subprocess import call
 import sys
+import tempfile
+from time import time
 import datasets
-from shutil import which
+from shutil import which, rmtree
+from pdffigures_utils import load_foreground_bitmap, get_num_pages_in_pdf, PageBitmapStore
 
 
 """
-Script to use pdftoppm to turn the pdfs into single images per page
+Script to use pdftoppm to turn the pdfs into single images per page, or into a single file of
+thresholded page bitmaps
 """
 
 
-def get_images(pdf_dir, output_dir, dpi, mono=True):
+def get_rendered_pages(directory):
+    """ Returns a map of document id -> page number -> path for the page images in `directory` """
+    pages = defaultdict(dict)
+    for filename in listdir(directory):
+        if "-page-" not in filename:
+            raise ValueError("Unexpected file %s in %s" % (filename, directory))
+        doc_id, page = filename[:filename.rfind(".")].split("-page-")
+        pages[doc_id][int(page)] = join(directory, filename)
+    return pages
+
+
+def get_page_ranges(pages):
+    """ Returns `pages` grouped into a list of (first, last) inclusive ranges of consecutive pages """
+    ranges = []
+    for page in sorted(pages):
+        if len(ranges) > 0 and ranges[-1][1] == page - 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return [tuple(x) for x in ranges]
+
+
+def render_pages(pdf_file, doc_id, pages, output_dir, dpi, mono):
+    """
+    Renders `pages` of `pdf_file` into `output_dir`. Pages are rendered into a temporary directory and then
+    moved into place, so `output_dir` never contains partially written images. Returns the number of pages
+    rendered.
+    """
+    tmpdir = tempfile.mkdtemp(prefix=".render-", dir=dirname(abspath(output_dir)))
+    try:
+        for first, last in get_page_ranges(pages):
+            if mono:
+                args = ["pdftoppm", "-gray", "-r", str(dpi),
+                        "-aa", "no", "-aaVector", "no", "-cropbox"]
+            else:
+                args = ["pdftoppm", "-jpeg", "-r", str(dpi), "-cropbox"]
+            args += ["-f", str(first), "-l", str(last), pdf_file, join(tmpdir, doc_id + "-page")]
+            retcode = call(args)
+            if retcode != 0:
+                raise ValueError("Bad return code for <%s> (%d)" % (" ".join(args), retcode))
+        rendered = get_rendered_pages(tmpdir)[doc_id]
+        if set(rendered.keys()) != set(pages):
+            raise ValueError("Expected pages %s of %s but got %s" % (sorted(pages), pdf_file, sorted(rendered)))
+        for filename in rendered.values():
+            os.replace(filename, join(output_dir, basename(filename)))
+    finally:
+        rmtree(tmpdir)
+    return len(pages)
+
+
+def _render_pages(args):
+    return render_pages(*args)
+
+
+def get_pages_to_render(pdf_file, doc_id, pages_to_render):
+    """ Returns the pages of `pdf_file` listed for `doc_id` in `pages_to_render`, or all pages if it is None """
+    num_pages = get_num_pages_in_pdf(pdf_file)
+    if pages_to_render is None:
+        return list(range(1, num_pages + 1))
+    return sorted(x for x in set(pages_to_render[doc_id]) if x <= num_pages)
+
+
+def get_images(pdf_dir, output_dir, dpi, mono=True, processes=None, pages_to_render=None):
+    """
+    Renders every page of every PDF in `pdf_dir` that does not already have an image in `output_dir`, using
+    `processes` processes (defaults to one per CPU). If `pages_to_render`, a map of document id -> list of
+    page numbers (1 based), is given only those pages are rendered.
+    """
     if which("pdftoppm") is None:
         raise ValueError("Requires executable pdftopmm to be on the PATH")
 
@@ -25,50 +99,104 @@ def get_images(pdf_dir, output_dir, dpi, mono=True):
 
     pdf_doc_ids = [x.split(".pdf")[0] for x in listdir(pdf_dir)]
 
-    already_have = set()
-    for filename in listdir(output_dir):
-        if "-page" not in filename:
-            raise ValueError()
-        doc_id = filename.split("-page")[0]
+    already_have = get_rendered_pages(output_dir)
+    for doc_id in already_have:
         if doc_id not in pdf_doc_ids:
             raise ValueError("doc id %s in output dir not found in pdfs" % doc_id)
-        already_have.add(doc_id)
 
+    tasks = []
+    num_pages_have = 0
+    for pdfname in sorted(listdir(pdf_dir)):
+        if not pdfname.endswith(".pdf"):
+            raise ValueError()
+        doc_id = pdfname[:-4]
+        pdf_file = join(pdf_dir, pdfname)
+        have = already_have.get(doc_id, {})
+        missing = [x for x in get_pages_to_render(pdf_file, doc_id, pages_to_render) if x not in have]
+        num_pages_have += len(have)
+        if len(missing) > 0:
+            tasks.append((pdf_file, doc_id, missing, output_dir, dpi, mono))
+
+    num_pages = sum(len(x[2]) for x in tasks)
+    print("Already have %d pages, rendering %d pages from %d docs" % (num_pages_have, num_pages, len(tasks)))
+    if num_pages == 0:
+        return
+
+    # Largest documents first so a few big PDFs do not hold up the end of the run
+    tasks.sort(key=lambda x: len(x[2]), reverse=True)
+    t0 = time()
+    pages_done = 0
+    with Pool(processes) as pool:
+        for i, pages_rendered in enumerate(pool.imap_unordered(_render_pages, tasks)):
+            pages_done += pages_rendered
+            elapsed = time() - t0
+            print("Rendered %d / %d docs, %d / %d pages (%0.2f pages/sec)" % (
+                i + 1, len(tasks), pages_done, num_pages, pages_done / elapsed))
+
+
+def get_bitmaps(pdf_dir, store, dpi, pages_to_render=None):
+    """
+    Renders each PDF in `pdf_dir` that is not already in `store` and adds its page bitmaps to `store`,
+    optionally only rendering the pages listed in `pages_to_render` (see `get_images`)
+    """
+    if which("pdftoppm") is None:
+        raise ValueError("Requires executable pdftopmm to be on the PATH")
+
+    if not isdir(pdf_dir):
+        raise ValueError(pdf_dir + " is not a directory")
+
+    already_have = set(store.get_doc_ids())
     if len(already_have) != 0:
         print("Already have %d docs" % len(already_have))
 
     num_pdfs = len(listdir(pdf_dir))
-    for (i, pdfname) in enumerate(listdir(pdf_dir)):
-        if not pdfname.endswith(".pdf"):
-            raise ValueError()
-        doc_id = pdfname[:-4]
-        if doc_id in already_have:
-            continue
-        print("Creating images for pdf %s (%d / %d)" % (pdfname, i + 1, num_pdfs))
-        if (mono):
-            args = ["pdftoppm", "-gray", "-r", str(dpi),
-                  "-aa", "no", "-aaVector", "no", "-cropbox",
-                  join(pdf_dir, pdfname), join(output_dir, doc_id + "-page")]
-        else:
-            args = ["pdftoppm", "-jpeg", "-r", str(dpi), "-cropbox",
-                  join(pdf_dir, pdfname), join(output_dir, doc_id + "-page")]
-        retcode = call(args)
-        if retcode != 0:
-            raise ValueError("Bad return code for <%s> (%d)", " ".join(args), retcode)
+    try:
+        for (i, pdfname) in enumerate(listdir(pdf_dir)):
+            if not pdfname.endswith(".pdf"):
+                raise ValueError()
+            doc_id = pdfname[:-4]
+            if doc_id in already_have:
+                continue
+            print("Creating bitmaps for pdf %s (%d / %d)" % (pdfname, i + 1, num_pdfs))
+            pdf_file = join(pdf_dir, pdfname)
+            tmpdir = tempfile.mkdtemp()
+            try:
+                pages = get_pages_to_render(pdf_file, doc_id, pages_to_render)
+                render_pages(pdf_file, doc_id, pages, tmpdir, dpi, True)
+                page_bitmaps = {}
+                for page, filename in get_rendered_pages(tmpdir)[doc_id].items():
+                    page_bitmaps[page] = load_foreground_bitmap(filename)
+                store.add_document(doc_id, page_bitmaps)
+            finally:
+                rmtree(tmpdir)
+    finally:
+        # Documents that were fully written are kept even if a later one fails
+        store.save_index()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Cache rasterized page images for a dataset')
     parser.add_argument("dataset", choices=datasets.DATASETS.keys(), help="target dataset")
-    parser.add_argument("color", choices=["gray", "color"], help="kind of images to render")
+    parser.add_argument("color", choices=["gray", "color", "bitmap"], help="kind of images to render, " +
+                        "'bitmap' builds the packed page bitmaps used to crop extractions")
+    parser.add_argument("-p", "--processes", type=int, help="Number of processes to render with, " +
+                        "defaults to one per CPU")
+    parser.add_argument("--all-pages", action="store_true", help="Render every page, not just the pages " +
+                        "that were annotated")
     args = parser.parse_args()
 
     dataset = datasets.get_dataset(args.dataset)
     print("Running on dataset: " + dataset.name)
+    pages_to_render = None if args.all_pages else dataset.get_annotated_pages_map()
     if args.color == "gray":
         get_images(dataset.pdf_dir, dataset.page_images_gray_dir,
-                   dataset.IMAGE_DPI, True)
+                   dataset.IMAGE_DPI, True, args.processes, pages_to_render)
     elif args.color == "color":
         get_images(dataset.pdf_dir, dataset.page_images_color_dir,
-                   dataset.COLOR_IMAGE_DPI, False)
+                   dataset.COLOR_IMAGE_DPI, False, args.processes, pages_to_render)
+    elif args.color == "bitmap":
+        get_bitmaps(dataset.pdf_dir, PageBitmapStore(dataset.page_bitmaps_file,
+                                                     dataset.page_bitmaps_index_file),
+                    dataset.IMAGE_DPI, pages_to_render)
     else:
         exit(1)
@@ -1,7 +1,11 @@
+import os
+import pickle
+import tempfile
+from functools import partial
 from os import listdir, mkdir
-from os.path import join, dirname, isdir, isfile
+from os.path import join, dirname, isdir, isfile, relpath
 import json
-from pdffigures_utils import Figure
+from pdffigures_utils import Figure, PageBitmapStore
 
 """
 This file defines a number of "Dataset" classes. Dataset classes represent a
@@ -16,6 +20,9 @@ exports "get_dataset" which can retrieve a dataset by name
 # So file locations work regardless of where scripts are run
 BASE_DIR = dirname(__file__)
 
+# Dataset directory -> manifest, so manifests are only loaded once per process
+_MANIFESTS = {}
+
 
 def get_image_dict(directory):
     if not isdir(directory):
@@ -29,10 +36,18 @@ def get_image_dict(directory):
     return data
 
 
+def _decode_figures(data):
+    return Figure.from_dicts(json.loads(data.decode("utf-8")))
+
+
 class Document(object):
+    """
+    A PDF in a dataset and its annotations. `figures` can either be a list of `Figure`, or a function
+    that returns one, in which case it is called the first time the figures are accessed.
+    """
 
     def __init__(self, doc_id, pages_annotated, figures, pdffile, dpi,
-                 gray_images=None, color_images=None, non_standard=False):
+                 gray_images=None, color_images=None, non_standard=False, page_bitmaps=None):
 
         if non_standard is not None and not isinstance(non_standard, bool):
             raise ValueError()
@@ -44,12 +59,19 @@ class Document(object):
         self.doc_id = doc_id
         self.dpi = dpi
         self.pages_annotated = pages_annotated
-        self.figures = figures
+        self._figures = figures
         self.gray_images = gray_images
         self.color_images = color_images
+        self.page_bitmaps = page_bitmaps
         self.pdffile = pdffile
         self.non_standard = non_standard
 
+    @property
+    def figures(self):
+        if callable(self._figures):
+            self._figures = self._figures()
+        return self._figures
+
 
 class Dataset(object):
     """
@@ -60,9 +82,15 @@ class Dataset(object):
     PDFS = "pdfs"
     PAGE_IMAGES_COLOR = "page_images_color"
     PAGE_IMAGES_GRAY = "page_images_gray"
+    PAGE_BITMAPS = "page_bitmaps.bin"
+    PAGE_BITMAPS_INDEX = "page_bitmaps.json"
     ANNOTATIONS = "annotations.json"
     PAGES_ANNOTATED = "pages_annotated.json"
     NON_STANDARD_DOCS = "non_standard_documents.txt"
+    MANIFEST = "dataset_manifest.pkl"
+
+    # version 1: Initial version
+    MANIFEST_VERSION = 1
 
     def __init__(self, name, directory, version, image_dpi):
         self.dir = directory
@@ -72,9 +100,12 @@ class Dataset(object):
         self.image_dpi = image_dpi
         self.page_images_color_dir = join(directory, self.PAGE_IMAGES_COLOR)
         self.page_images_gray_dir = join(directory, self.PAGE_IMAGES_GRAY)
+        self.page_bitmaps_file = join(directory, self.PAGE_BITMAPS)
+        self.page_bitmaps_index_file = join(directory, self.PAGE_BITMAPS_INDEX)
         self.annotation_file = join(directory, self.ANNOTATIONS)
         self.pages_annotated_file = join(directory, self.PAGES_ANNOTATED)
         self.non_standard_docs_file = join(directory, self.NON_STANDARD_DOCS)
+        self.manifest_file = join(directory, self.MANIFEST)
 
     """ Return all document ids """
     def get_doc_ids(self):
@@ -110,32 +141,105 @@ class Dataset(object):
         doc_ids = self.get_doc_ids()
         return self.load_doc_ids(doc_ids)
 
-    """ Return a list of `Document` objects for each of the given document ids """
+    """ Return a list of `Document` objects for each of the given document ids. Documents are loaded
+        from the dataset's manifest (see `get_manifest`) and only parse their figures when they are used """
     def load_doc_ids(self, doc_ids):
-        pdf_file_map = self.get_pdf_file_map()
-        color_image_map = self.get_color_image_file_map()
-        gray_image_map = self.get_gray_image_file_map()
-        annotations = self.get_annotations()
-        ocr_docs = self.get_nonstandard_doc_ids()
+        manifest = self.get_manifest()
+        bitmap_store = self.get_page_bitmap_store()
+        blob = manifest["annotations"]
         documents = []
         for doc_id in doc_ids:
-            if doc_id not in annotations:
+            if doc_id not in manifest["docs"]:
                 raise ValueError("Not annotations for document %s" % doc_id)
-            ann = annotations[doc_id]
-            non_standard = False
-            if ocr_docs is not None:
-                non_standard = doc_id in ocr_docs
+            doc = manifest["docs"][doc_id]
+            start, end = doc["annotations"]
+            gray_images, color_images = [
+                None if x is None else {page: join(self.dir, f) for page, f in x.items()}
+                for x in [doc["gray_images"], doc["color_images"]]]
             documents.append(Document(
                 doc_id,
-                ann["annotated_pages"],
-                ann["figures"],
-                pdf_file_map[doc_id],
+                doc["annotated_pages"],
+                partial(_decode_figures, blob[start:end]),
+                join(self.dir, doc["pdf"]),
                 self.image_dpi,
-                gray_image_map[doc_id] if gray_image_map is not None else None,
-                color_image_map[doc_id] if color_image_map is not None else None,
-                non_standard=non_standard))
+                gray_images,
+                color_images,
+                non_standard=doc["non_standard"],
+                page_bitmaps=bitmap_store.get_page_bitmaps(doc_id) if bitmap_store is not None else None))
         return documents
 
+    """ Return the key used to decide if the manifest is out of date, which changes if the dataset's version
+        changes or if any of the files or directories the manifest is built from are modified """
+    def get_manifest_key(self):
+        key = [self.MANIFEST_VERSION, self.version]
+        for filename in [self.annotation_file, self.pages_annotated_file, self.non_standard_docs_file,
+                         self.pdf_dir, self.page_images_gray_dir, self.page_images_color_dir]:
+            key.append(os.stat(filename).st_mtime_ns if os.path.exists(filename) else None)
+        return key
+
+    """ Return the dataset's manifest, a dictionary with the document ids, file paths (relative to the
+        dataset directory), annotated pages and non-standard flags of each annotated document. The figures
+        of each document are stored as a slice of the JSON encoded bytes in `annotations`.
+        The manifest is saved in the dataset directory and rebuilt whenever `get_manifest_key` changes """
+    def get_manifest(self):
+        key = self.get_manifest_key()
+        cached = _MANIFESTS.get(self.dir)
+        if cached is not None and cached["key"] == key:
+            return cached
+        manifest = None
+        if isfile(self.manifest_file):
+            with open(self.manifest_file, "rb") as f:
+                manifest = pickle.load(f)
+            if manifest["key"] != key:
+                manifest = None
+        if manifest is None:
+            manifest = self.build_manifest(key)
+            try:
+                handle, tmp_file = tempfile.mkstemp(dir=self.dir, suffix=".tmp")
+                with os.fdopen(handle, "wb") as f:
+                    pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_file, self.manifest_file)
+            except OSError as e:
+                print("WARNING: unable to save the dataset manifest (%s)" % e)
+        _MANIFESTS[self.dir] = manifest
+        return manifest
+
+    def build_manifest(self, key):
+        pdf_file_map = self.get_pdf_file_map()
+        color_image_map = self.get_color_image_file_map()
+        gray_image_map = self.get_gray_image_file_map()
+        ocr_docs = self.get_nonstandard_doc_ids()
+        with open(self.annotation_file) as f:
+            annotations = json.load(f)
+
+        def image_paths(image_map, doc_id):
+            if image_map is None:
+                return None
+            return {page: relpath(f, self.dir) for page, f in image_map.get(doc_id, {}).items()}
+
+        docs = {}
+        blob = bytearray()
+        for doc_id in sorted(pdf_file_map.keys()):
+            if doc_id not in annotations:
+                continue
+            doc_annotations = annotations[doc_id]
+            pages = doc_annotations["pages_annotated"]
+            for figure in doc_annotations["figures"]:
+                # Validated once here, documents later load their figures without the checks
+                Figure.from_dict(figure)
+                if not figure["page"] in pages:
+                    raise ValueError()
+            data = json.dumps(doc_annotations["figures"]).encode("utf-8")
+            docs[doc_id] = dict(
+                pdf=relpath(pdf_file_map[doc_id], self.dir),
+                gray_images=image_paths(gray_image_map, doc_id),
+                color_images=image_paths(color_image_map, doc_id),
+                annotated_pages=pages,
+                non_standard=doc_id in ocr_docs,
+                annotations=(len(blob), len(blob) + len(data)))
+            blob += data
+        return dict(key=key, docs=docs, annotations=bytes(blob))
+
     """ Return a list of `Figure` objects and which pages where annotated
         for each of the given document ids """
     def get_annotations(self):
@@ -176,6 +280,13 @@ class Dataset(object):
     def get_gray_image_file_map(self):
         return get_image_dict(join(self.dir, self.PAGE_IMAGES_GRAY))
 
+    """ Return the `PageBitmapStore` containing thresholded gray images of the pages, or None if it
+        has not been built """
+    def get_page_bitmap_store(self):
+        if not isfile(self.page_bitmaps_index_file):
+            return None
+        return PageBitmapStore(self.page_bitmaps_file, self.page_bitmaps_index_file)
+
     """ Return version of the dataset """
     def get_version(self):
         return self.version
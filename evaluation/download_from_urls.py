@@ -1,24 +1,148 @@
 import argparse
+import json
 import os
-import tempfile
-from os import listdir
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os import listdir, remove
 from os import mkdir
-from os.path import join, isdir
-
-from requests import HTTPError
+from os.path import join, isdir, isfile, getsize, basename
+from time import sleep
+from urllib.parse import urlparse
 
 from datasets import datasets
 from datasets.build_dataset_images import get_images
 from datasets.datasets import DATASETS
+from extraction_cache import hash_file
 
 """
 This script checks for missing PDFs or missing rasterized images and re-downloads or regenerates
-any that are missing. Unless a file was only partially downloaded it can be safely restarted if it crashes.
+any that are missing. It can be safely restarted if it crashes, partially downloaded PDFs are resumed.
 """
 
+""" Size of the chunks downloads are streamed to disk in """
+CHUNK_SIZE = 64 * 1024
+
+
+class DownloadError(Exception):
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class Downloader(object):
+    """
+    Downloads files with a pool of `threads` threads sharing one `requests.Session`, with at most `per_host`
+    concurrent connections to any one host. Files are streamed into `partial_dir` and moved into place once
+    complete, interrupted downloads are resumed with HTTP Range requests, and failed requests are retried up
+    to `retries` times with exponential backoff. The size and SHA-256 of each completed file are recorded in
+    the JSON file `manifest_file`.
+    """
+
+    def __init__(self, partial_dir, manifest_file, threads=8, per_host=4, retries=4, backoff=1.0, timeout=60):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.partial_dir = partial_dir
+        self.manifest_file = manifest_file
+        self.threads = threads
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=threads, pool_maxsize=max(threads, per_host))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._host_limits = defaultdict(lambda: threading.BoundedSemaphore(self.per_host))
+        self._lock = threading.Lock()
+        if isfile(manifest_file):
+            with open(manifest_file) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {}
+
+    def _get_host_limit(self, url):
+        with self._lock:
+            return self._host_limits[urlparse(url).netloc]
+
+    def _record(self, key, url, size, sha256_hash):
+        with self._lock:
+            self.manifest[key] = dict(url=url, size=size, sha256=sha256_hash)
+            tmp_file = self.manifest_file + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(self.manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp_file, self.manifest_file)
 
-def download_from_urls(doc_id_to_url, output_dir):
-    import requests
+    def _fetch(self, url, partial_file):
+        """ Downloads, or continues downloading, `url` into `partial_file` """
+        from requests import RequestException
+        size = getsize(partial_file) if isfile(partial_file) else 0
+        headers = {"Range": "bytes=%d-" % size} if size > 0 else {}
+        try:
+            with self._get_host_limit(url):
+                with self.session.get(url, headers=headers, stream=True, allow_redirects=True,
+                                      timeout=self.timeout) as r:
+                    if r.status_code == 416 and size > 0:
+                        return  # We already have the whole file
+                    if r.status_code >= 400:
+                        retryable = r.status_code == 429 or r.status_code >= 500
+                        raise DownloadError("HTTP status %d for %s" % (r.status_code, url), retryable)
+                    # Servers that do not support ranges send the whole file again
+                    mode = "ab" if r.status_code == 206 else "wb"
+                    with open(partial_file, mode) as f:
+                        for chunk in r.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+        except RequestException as e:
+            raise DownloadError("Request for %s failed: %s" % (url, e), True)
+
+    def download(self, key, url, output_file):
+        """ Downloads `url` to `output_file`, recording it in the manifest under `key` """
+        partial_file = join(self.partial_dir, basename(output_file) + ".part")
+        for attempt in range(self.retries + 1):
+            try:
+                self._fetch(url, partial_file)
+                break
+            except DownloadError as e:
+                if not e.retryable or attempt == self.retries:
+                    raise
+                sleep(self.backoff * 2 ** attempt)
+
+        size = getsize(partial_file)
+        if size == 0:
+            remove(partial_file)
+            raise DownloadError("Empty response for url=%s" % url)
+        with open(partial_file, "rb") as f:
+            if f.read(len("<!DOCTYPE html>")).lower() == b"<!doctype html>":
+                remove(partial_file)
+                raise DownloadError("Appeared to get an HTML file for url=%s" % url)
+        sha256_hash = hash_file(partial_file)
+        os.replace(partial_file, output_file)
+        self._record(key, url, size, sha256_hash)
+
+    def download_all(self, downloads):
+        """
+        Downloads each of `downloads`, a map of key -> (url, output_file). Returns a map of key -> error message
+        for the downloads that failed
+        """
+        if not isdir(self.partial_dir):
+            mkdir(self.partial_dir)
+        failures = {}
+        with ThreadPoolExecutor(self.threads) as executor:
+            futures = {executor.submit(self.download, key, url, output_file): key
+                       for key, (url, output_file) in downloads.items()}
+            for i, future in enumerate(as_completed(futures)):
+                key = futures[future]
+                try:
+                    future.result()
+                    print("Downloaded %s (%d of %d)" % (key, i + 1, len(futures)))
+                except DownloadError as e:
+                    failures[key] = str(e)
+                    print("Failed to download %s (%d of %d): %s" % (key, i + 1, len(futures), e))
+        return failures
+
+
+def download_from_urls(doc_id_to_url, output_dir, threads=8):
     already_have = 0
     if not isdir(output_dir):
         print("Making directory %s to store PDFs" % output_dir)
@@ -33,31 +157,18 @@ def download_from_urls(doc_id_to_url, output_dir):
             already_have += 1
             del doc_id_to_url[doc_id]
     print("Already have %d documents, need to download %d" % (already_have, len(doc_id_to_url)))
+    if len(doc_id_to_url) == 0:
+        return
 
-    for i, (doc_id, url) in enumerate(sorted(doc_id_to_url.items())):
-        print("Downloading %s (%d of %d)" % (doc_id, i + 1, len(doc_id_to_url)))
-        r = requests.get(url, allow_redirects=True)
-        try:
-            r.raise_for_status()
-        except HTTPError as e:
-            # REMOVE THIS EXCEPT
-            print(e)
-            continue
-        content = r.content
-        if len(content) == 0:
-            raise ValueError("Empty response for doc %s url=%s" % (doc_id, url))
-        try:
-            if content.decode("utf-8").startswith("<!DOCTYPE html>"):
-                print(content)
-                raise ValueError("Appeared to get an HTML file for doc %s url=%s" % (doc_id, url))
-        except UnicodeDecodeError:
-            pass
-        # To ensure atomic writes, dump into a tmp file and then rename the tmp file
-        with tempfile.NamedTemporaryFile(mode="wb", delete=False) as pdf_file:
-            name = pdf_file.name
-            pdf_file.write(content)
-        r.close()
-        os.rename(name, join(output_dir, doc_id + ".pdf"))
+    # Partial downloads and the manifest are kept outside `output_dir`, which should only contain PDFs
+    output_dir = output_dir.rstrip("/")
+    downloader = Downloader(output_dir + "_partial", output_dir + "_manifest.json", threads)
+    failures = downloader.download_all({doc_id: (url, join(output_dir, doc_id + ".pdf"))
+                                        for doc_id, url in doc_id_to_url.items()})
+    if len(failures) > 0:
+        print("Failed to download %d documents:" % len(failures))
+        for doc_id, error in sorted(failures.items()):
+            print("%s: %s" % (doc_id, error))
 
 
 def setup():
@@ -66,21 +177,29 @@ def setup():
                                                     "(used for cropping extractor output)", action="store_true")
     parser.add_argument("-c", "--color-images", help="Build color images for each PDF (used for debugging)",
                         action="store_true")
+    parser.add_argument("-p", "--processes", type=int, help="Number of processes to use when building images, " +
+                        "defaults to one per CPU")
+    parser.add_argument("-t", "--threads", type=int, default=8, help="Number of PDFs to download at once")
+    parser.add_argument("--all-pages", action="store_true", help="Build images for every page, not just the " +
+                        "pages that were annotated")
     args = parser.parse_args()
 
     for name, dataset in sorted(DATASETS.items()):
         print("*" * 10 + " SETTING UP DATASET: %s" % name + " " + "*" * 10)
         dataset = dataset()
         print("DOWNLOADING PDFS:")
-        download_from_urls(dataset.get_urls(), dataset.pdf_dir)
+        download_from_urls(dataset.get_urls(), dataset.pdf_dir, args.threads)
         print("Done!")
+        pages_to_render = None if args.all_pages else dataset.get_annotated_pages_map()
         if args.gray_images:
             print("\nBUILDING GRAYSCALE IMAGES:")
-            get_images(dataset.pdf_dir, dataset.page_images_gray_dir, dataset.image_dpi, True)
+            get_images(dataset.pdf_dir, dataset.page_images_gray_dir, dataset.image_dpi, True, args.processes,
+                       pages_to_render)
             print("Done!")
         if args.color_images:
             print("\nBUILDING COLOR IMAGES:")
-            get_images(dataset.pdf_dir, dataset.page_images_color_dir, dataset.image_dpi, False)
+            get_images(dataset.pdf_dir, dataset.page_images_color_dir, dataset.image_dpi, False, args.processes,
+                       pages_to_render)
             print("Done!")
 
 if __name__ == "__main__":
@@ -0,0 +1,253 @@
+import json
+import os
+import pickle
+from os import mkdir
+from os.path import join, isdir
+import numpy as np
+from pdffigures_utils import Evaluation, EvaluatedFigure, Error, Figure, FigureType
+
+"""
+Columnar on-disk format for evaluations. An evaluation is stored as a directory containing a
+"meta.json" file with the dataset and extractor information and a list of parts, and one
+"part-NNNNN.npz" file per part. Each part stores one array per column (see `COLUMNS`) and a string table
+that the string columns index into, so readers can load only the columns they need and skip parts
+that do not contain the documents they are interested in.
+"""
+
+META = "meta.json"
+
+# version 1: Initial version
+FORMAT_VERSION = 1
+
+""" Columns stored for each EvaluatedFigure, string columns are indices into the part's string table """
+COLUMNS = ["doc", "page", "figure_type", "name", "error",
+           "has_true", "true_caption", "true_dpi", "true_page_size", "true_caption_bb", "true_region_bb",
+           "has_extracted", "extracted_caption", "extracted_dpi", "extracted_page_size",
+           "extracted_caption_bb", "extracted_region_bb"]
+
+
+def _box(box):
+    return [np.nan] * 4 if box is None else box
+
+
+def _value(x):
+    return np.nan if x is None else x
+
+
+def _from_box(row):
+    return None if np.isnan(row[0]) else [float(x) for x in row]
+
+
+def _from_value(x):
+    if np.isnan(x):
+        return None
+    return int(x) if float(x).is_integer() else float(x)
+
+
+class _StringTable(object):
+
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def get_id(self, string):
+        if string is None:
+            return -1
+        if string not in self.ids:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.ids[string]
+
+    def to_arrays(self):
+        encoded = [x.encode("utf-8") for x in self.strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in encoded])
+        return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _load_string_table(part):
+    data = part["string_data"].tobytes()
+    offsets = part["string_offsets"]
+    return [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+
+def build_columns(docs, true_figures, extracted_figures, errors):
+    """
+    Returns a dictionary of column name -> array, and the list of strings the string columns index, for
+    EvaluatedFigures described by the given lists (`errors` holds the values of their `Error`s)
+    """
+    strings = _StringTable()
+    rows = {x: [] for x in COLUMNS}
+    for doc, true_figure, extracted_figure, error in zip(docs, true_figures, extracted_figures, errors):
+        figure = true_figure if true_figure is not None else extracted_figure
+        rows["doc"].append(strings.get_id(doc))
+        rows["page"].append(figure.page)
+        rows["figure_type"].append(figure.figure_type.value)
+        rows["name"].append(strings.get_id(figure.name))
+        rows["error"].append(int(error))
+        for prefix, fig in [("true", true_figure), ("extracted", extracted_figure)]:
+            rows["has_" + prefix].append(fig is not None)
+            rows[prefix + "_caption"].append(-1 if fig is None else strings.get_id(fig.caption))
+            rows[prefix + "_dpi"].append(np.nan if fig is None else _value(fig.dpi))
+            rows[prefix + "_page_size"].append([np.nan, np.nan] if fig is None else
+                                               [_value(fig.page_width), _value(fig.page_height)])
+            rows[prefix + "_caption_bb"].append(_box(None if fig is None else fig.caption_bb))
+            rows[prefix + "_region_bb"].append(_box(None if fig is None else fig.region_bb))
+
+    n = len(rows["doc"])
+    columns = {}
+    for name in ["doc", "name", "true_caption", "extracted_caption"]:
+        columns[name] = np.array(rows[name], dtype=np.int32)
+    columns["page"] = np.array(rows["page"], dtype=np.int32)
+    columns["figure_type"] = np.array(rows["figure_type"], dtype=np.int8)
+    columns["error"] = np.array(rows["error"], dtype=np.int8)
+    for prefix in ["true", "extracted"]:
+        columns["has_" + prefix] = np.array(rows["has_" + prefix], dtype=bool)
+        columns[prefix + "_dpi"] = np.array(rows[prefix + "_dpi"], dtype=np.float64)
+        columns[prefix + "_page_size"] = np.array(rows[prefix + "_page_size"], dtype=np.float64).reshape(n, 2)
+        for box in ["_caption_bb", "_region_bb"]:
+            columns[prefix + box] = np.array(rows[prefix + box], dtype=np.float64).reshape(n, 4)
+    return columns, strings
+
+
+class ColumnarEvaluationWriter(object):
+    """
+    Writes an evaluation to `directory` in the columnar format. Figures can be appended in any number of
+    calls to `append`, each of which adds a part and is immediately readable.
+    """
+
+    def __init__(self, directory, dataset_name, dataset_version, extractor_name, extractor_version,
+                 extractor_config, compare_caption_text, doc_ids, timestamp):
+        if isdir(directory):
+            raise ValueError("%s already exists" % directory)
+        mkdir(directory)
+        self.directory = directory
+        self.meta = dict(
+            format_version=FORMAT_VERSION, version=Evaluation.version,
+            dataset_name=dataset_name, dataset_version=dataset_version,
+            extractor_name=extractor_name, extractor_version=extractor_version,
+            extractor_config=extractor_config, compare_caption_text=compare_caption_text,
+            docs=list(doc_ids), timestamp=timestamp, parts=[])
+        self._write_meta()
+
+    def _write_meta(self):
+        tmp_file = join(self.directory, META + ".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_file, join(self.directory, META))
+
+    def append(self, graded_figures):
+        """ Appends a `grading.GradedFigures` or a list of `EvaluatedFigure` """
+        if isinstance(graded_figures, list):
+            docs = [x.doc for x in graded_figures]
+            true_figures = [x.true_figure for x in graded_figures]
+            extracted_figures = [x.extracted_figure for x in graded_figures]
+            errors = [x.error.value for x in graded_figures]
+        else:
+            docs, true_figures, extracted_figures, errors = (
+                graded_figures.docs, graded_figures.true_figures,
+                graded_figures.extracted_figures, graded_figures.errors)
+        if len(docs) == 0:
+            return
+        columns, strings = build_columns(docs, true_figures, extracted_figures, errors)
+        columns["string_data"], columns["string_offsets"] = strings.to_arrays()
+        filename = "part-%05d.npz" % len(self.meta["parts"])
+        with open(join(self.directory, filename), "wb") as f:
+            np.savez(f, **columns)
+        self.meta["parts"].append(dict(file=filename, docs=sorted(set(docs)), size=len(docs)))
+        self._write_meta()
+
+
+class ColumnarEvaluation(object):
+    """
+    Reads an evaluation saved by `ColumnarEvaluationWriter`. Dataset and extractor information is available
+    as attributes, figures are read column by column with `load_columns`
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(join(directory, META)) as f:
+            meta = json.load(f)
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError("Unsupported evaluation format version %d" % meta["format_version"])
+        if meta["version"] != Evaluation.version:
+            print("WARNING: evaluation loaded with out-of-date version %d" % meta["version"])
+        self.dataset_name = meta["dataset_name"]
+        self.dataset_version = meta["dataset_version"]
+        self.extractor_name = meta["extractor_name"]
+        self.extractor_version = meta["extractor_version"]
+        self.extractor_config = meta["extractor_config"]
+        self.compare_caption_text = meta["compare_caption_text"]
+        self.docs = meta["docs"]
+        self.timestamp = meta["timestamp"]
+        self.parts = meta["parts"]
+
+    def load_columns(self, columns, docs=None, figure_type=None):
+        """
+        Returns a dictionary of column name -> array for the requested `columns`, only including rows for
+        documents in `docs` and figures of type `figure_type` if given. String columns are returned as
+        lists of strings (None for missing strings). Parts without any of `docs` are not opened.
+        """
+        if docs is not None:
+            docs = set(docs)
+        loaded = {x: [] for x in columns}
+        for part_info in self.parts:
+            if docs is not None and docs.isdisjoint(part_info["docs"]):
+                continue
+            with np.load(join(self.directory, part_info["file"])) as part:
+                mask = None
+                strings = None
+                if docs is not None or any(x in columns for x in ["doc", "name", "true_caption",
+                                                                    "extracted_caption"]):
+                    strings = _load_string_table(part)
+                if docs is not None:
+                    doc_ids = np.array([i for i, x in enumerate(strings) if x in docs], dtype=np.int32)
+                    mask = np.isin(part["doc"], doc_ids)
+                if figure_type is not None:
+                    type_mask = part["figure_type"] == figure_type.value
+                    mask = type_mask if mask is None else mask & type_mask
+                for column in columns:
+                    values = part[column]
+                    if mask is not None:
+                        values = values[mask]
+                    if column in ["doc", "name", "true_caption", "extracted_caption"]:
+                        values = [None if x < 0 else strings[x] for x in values]
+                    loaded[column].append(values)
+        result = {}
+        for column, values in loaded.items():
+            if column in ["doc", "name", "true_caption", "extracted_caption"]:
+                result[column] = [x for part in values for x in part]
+            elif len(values) == 0:
+                result[column] = np.zeros(0)
+            else:
+                result[column] = np.concatenate(values)
+        return result
+
+    def to_evaluation(self, docs=None, figure_type=None):
+        """ Builds an `Evaluation` containing `EvaluatedFigure`s for the figures selected by the filters """
+        c = self.load_columns(COLUMNS, docs, figure_type)
+        evaluated_figures = []
+        for i in range(len(c["doc"])):
+            figures = []
+            for prefix in ["true", "extracted"]:
+                if not c["has_" + prefix][i]:
+                    figures.append(None)
+                    continue
+                page_width, page_height = c[prefix + "_page_size"][i]
+                figures.append(Figure(
+                    FigureType(int(c["figure_type"][i])), c["name"][i], int(c["page"][i]),
+                    _from_value(c[prefix + "_dpi"][i]), c[prefix + "_caption"][i],
+                    _from_value(page_height), _from_value(page_width),
+                    _from_box(c[prefix + "_caption_bb"][i]), _from_box(c[prefix + "_region_bb"][i])))
+            evaluated_figures.append(EvaluatedFigure(figures[0], figures[1], Error(int(c["error"][i])), c["doc"][i]))
+        return Evaluation(self.dataset_name, self.dataset_version, self.extractor_name, self.extractor_version,
+                          self.extractor_config, evaluated_figures, self.compare_caption_text, self.docs,
+                          self.timestamp)
+
+
+def load_evaluation(path):
+    """ Loads an `Evaluation` saved either as a pickle or in the columnar format """
+    if isdir(path):
+        return ColumnarEvaluation(path).to_evaluation()
+    with open(path, "rb") as f:
+        return pickle.load(f)
@@ -0,0 +1,123 @@
+import json
+import os
+import tempfile
+from hashlib import sha256
+from os import listdir, remove
+from os.path import join, getsize, getmtime, dirname
+
+from pdffigures_utils import Figure
+
+"""
+On-disk cache of extractor output, so evaluations can be re-run (for example after changing the
+grading code) without re-running the extractor on every PDF.
+"""
+
+DEFAULT_CACHE_DIR = join(dirname(__file__), "extraction_cache")
+
+""" Default maximum size of the cache in bytes """
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+
+def hash_file(filename, chunk_size=1024 * 1024):
+    """ Returns the SHA-256 hex digest of the contents of `filename` """
+    h = sha256()
+    with open(filename, "rb") as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            h.update(chunk)
+            chunk = f.read(chunk_size)
+    return h.hexdigest()
+
+
+class ExtractionCache(object):
+    """
+    Caches the list of `Figure`s an extractor returned for a PDF. Entries are keyed by the SHA-256 of the
+    PDF's bytes, the extractor's name, version, config and build id, and the pages the extractor was
+    asked to process. Each entry is stored as a JSON file, and once the cache grows larger than
+    `max_size` bytes the least recently used entries are deleted. If `refresh` is set, existing entries
+    are ignored (and overwritten) rather than returned.
+    """
+
+    def __init__(self, extractor_name, extractor_version, extractor_config, build_id=None,
+                 directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE, refresh=False):
+        if max_size <= 0:
+            raise ValueError("Cache size must be > 0")
+        self.directory = directory
+        self.max_size = max_size
+        self.refresh = refresh
+        self.extractor_key = [extractor_name, extractor_version, extractor_config, build_id]
+        self._pdf_hashes = {}
+        # Running total of the cache's size in bytes, None until the directory has been listed. Entries
+        # other processes add are only counted the next time the directory is listed by `evict`
+        self._size = None
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, pdf_filepath, pages=None):
+        # Hashing is cheap compared to extraction, but we still avoid re-reading unchanged files
+        stat = os.stat(pdf_filepath)
+        file_id = (pdf_filepath, stat.st_size, stat.st_mtime)
+        if file_id not in self._pdf_hashes:
+            self._pdf_hashes[file_id] = hash_file(pdf_filepath)
+        pages = None if pages is None else sorted(pages)
+        key = json.dumps([self._pdf_hashes[file_id], self.extractor_key, pages], sort_keys=True)
+        return sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, pdf_filepath, pages=None):
+        """ Returns the cached list of `Figure`s for `pdf_filepath`, or None if there is no entry """
+        if self.refresh:
+            return None
+        entry = join(self.directory, self.get_key(pdf_filepath, pages) + ".json")
+        try:
+            with open(entry) as f:
+                figures = Figure.from_dicts(json.load(f))
+            # Mark the entry as recently used
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        return figures
+
+    def put(self, pdf_filepath, figures, pages=None):
+        entry = join(self.directory, self.get_key(pdf_filepath, pages) + ".json")
+        # Write to a tmp file and then rename it so concurrent readers never see partial entries
+        handle, tmp_file = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, "w") as f:
+            json.dump([x.as_dict() for x in figures], f)
+        size = getsize(tmp_file)
+        try:
+            replaced_size = getsize(entry)
+        except FileNotFoundError:
+            replaced_size = 0
+        os.replace(tmp_file, entry)
+        if self._size is None:
+            self.evict()
+        else:
+            self._size += size - replaced_size
+            if self._size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """ Deletes least recently used entries until the cache fits in `max_size` bytes """
+        entries = []
+        total_size = 0
+        for filename in listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            path = join(self.directory, filename)
+            try:
+                size = getsize(path)
+                entries.append((getmtime(path), size, path))
+            except FileNotFoundError:
+                continue  # Evicted by another process
+            total_size += size
+        self._size = total_size
+        if total_size <= self.max_size:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            self._size = total_size
+            if total_size <= self.max_size:
+                break
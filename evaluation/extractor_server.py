@@ -0,0 +1,126 @@
+import atexit
+import json
+import socket
+import tempfile
+from os.path import join, isfile, abspath
+from shutil import rmtree
+from subprocess import Popen, DEVNULL
+from time import time, sleep
+
+"""
+Helpers for running pdffigures2's `FigureExtractorServer` as a long running process that PDFs
+can be sent to, so the JVM only has to be started (and warmed up) once.
+"""
+
+
+class ExtractorServer(object):
+    """
+    Starts and stops a FigureExtractorServer. If the stand-alone jar built by `sbt assembly` exists in
+    `extractor_home` it is run with java directly, otherwise the server is started through sbt.
+    `cli_args` are additional arguments to pass to the server, such as "-d" to set where it saves the
+    figure data.
+    """
+
+    MAIN_CLASS = "org.allenai.pdffigures2.FigureExtractorServer"
+    JAR = "pdffigures2.jar"
+
+    # Important to get good performance rendering image heavy pdfs
+    # (see https://pdfbox.apache.org/2.0/getting-started.html)
+    JAVA_OPTS = ["-Dsun.java2d.cmm=sun.java2d.cmm.kcms.KcmsServiceProvider"]
+
+    def __init__(self, extractor_home, cli_args, threads=1, startup_timeout=900):
+        self.extractor_home = extractor_home
+        self.cli_args = cli_args
+        self.threads = threads
+        self.startup_timeout = startup_timeout
+        self.process = None
+        self.address = None
+        self.startup_time = None
+
+    def start(self):
+        """ Starts the server and blocks until it is accepting connections, returns its address """
+        if self.process is not None:
+            return self.address
+        tmpdir = tempfile.mkdtemp()
+        try:
+            port_file = join(tmpdir, "port")
+            server_args = self.cli_args + ["-t", str(self.threads), "--port-file", port_file]
+            jar = join(self.extractor_home, self.JAR)
+            if isfile(jar):
+                args = ["java"] + self.JAVA_OPTS + ["-cp", jar, self.MAIN_CLASS] + server_args
+            else:
+                args = ["sbt"] + self.JAVA_OPTS + [" ".join(["runMain", self.MAIN_CLASS] + server_args)]
+
+            t0 = time()
+            self.process = Popen(args, cwd=self.extractor_home, stdin=DEVNULL)
+            atexit.register(self.close)
+            while not isfile(port_file):
+                exit_code = self.process.poll()
+                if exit_code is not None:
+                    self.process = None
+                    raise ValueError("Extractor server exited with status %d, call:\n%s" %
+                                     (exit_code, " ".join(args)))
+                if time() - t0 > self.startup_timeout:
+                    self.close()
+                    raise ValueError("Extractor server did not start within %d seconds" % self.startup_timeout)
+                sleep(0.1)
+            with open(port_file) as f:
+                self.address = ("127.0.0.1", int(f.read().strip()))
+            self.startup_time = time() - t0
+        finally:
+            rmtree(tmpdir)
+        return self.address
+
+    def close(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+                self.process.wait()
+            self.process = None
+
+
+class ExtractorClient(object):
+    """
+    Connection to a running FigureExtractorServer, requests are answered in the order they are sent.
+    Only the address is kept when pickled so clients can be handed to other processes.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.sock = None
+        self.reader = None
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address)
+        self.reader = self.sock.makefile("r", encoding="utf-8")
+
+    def process(self, pdf_filepath, pages=None):
+        """
+        Asks the server to process `pdf_filepath`, optionally only locating figures on `pages` (1 based),
+        returns the server's response as a dictionary with either a "stats" or an "error" entry
+        """
+        if self.sock is None:
+            self.connect()
+        request = {"input": abspath(pdf_filepath)}
+        if pages is not None:
+            request["pages"] = list(pages)
+        request = json.dumps(request) + "\n"
+        self.sock.sendall(request.encode("utf-8"))
+        line = self.reader.readline()
+        if line == "":
+            self.close()
+            raise ValueError("Extractor server closed the connection while processing %s" % pdf_filepath)
+        return json.loads(line)
+
+    def close(self):
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+            self.sock = None
+            self.reader = None
+
+    def __getstate__(self):
+        return {"address": self.address}
+
+    def __setstate__(self, state):
+        self.__init__(state["address"])
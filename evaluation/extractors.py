@@ -1,12 +1,16 @@
+import atexit
 import json
 import os
 import tempfile
-from os import remove, environ
+from hashlib import sha256
+from os import remove, environ, walk
 from os.path import isdir, join, isfile, dirname
 from shutil import which, rmtree
 from subprocess import call, DEVNULL, check_output
+from time import time
 
-from pdffigures_utils import Figure, FigureType, str_to_fig_type
+from extractor_server import ExtractorServer, ExtractorClient
+from pdffigures_utils import Figure, FigureType, str_to_fig_type, get_num_pages_in_pdf
 
 
 class PDFFigures2(object):
@@ -39,6 +43,21 @@ class PDFFigures2(object):
             self.version = output.decode("utf-8").strip().split("\n")[-1].split("[info] ")[-1]
         return self.version
 
+    def get_build_id(self):
+        """
+        Hash of the extractor's source code. The sbt version is rarely bumped during development, so
+        this is used to avoid re-using cached extractions after the code has changed
+        """
+        h = sha256()
+        source_dir = join(self.extractor_home, "src", "main")
+        for root, dirs, files in walk(source_dir):
+            dirs.sort()
+            for filename in sorted(files):
+                h.update(filename.encode("utf-8"))
+                with open(join(root, filename), "rb") as f:
+                    h.update(f.read())
+        return h.hexdigest()
+
     def time(self, pdf_filenames, extract_images=False, verbose=False):
         tmpdir = tempfile.mkdtemp()
         try:
@@ -58,13 +77,45 @@ class PDFFigures2(object):
         finally:
             rmtree(tmpdir)
 
-    def start_batch(self, pdf_filenames):
+    def run_with_stats(self, pdf_filenames, extract_images=False):
+        """
+        Runs the extractor on `pdf_filenames`. Returns the wall-clock time taken, which includes starting
+        sbt and the JVM, and the list of per-document `ProcessingStatistics` (or `ProcessingError`)
+        dictionaries the CLI saved with "-s"
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            stats_file = join(tmpdir, "stats.json")
+            cli_args = ["run", ",".join(pdf_filenames), "-c", "-d", tmpdir + "/", "-e", "-q", "-s", stats_file]
+            if extract_images:
+                cli_args += ["-m", tmpdir + "/fig"]
+            args = ["sbt", "-Dsun.java2d.cmm=sun.java2d.cmm.kcms.KcmsServiceProvider", " ".join(cli_args)]
+            t0 = time()
+            exit_code = call(args, cwd=self.extractor_home)
+            wall_time = time() - t0
+            if exit_code != 0:
+                raise ValueError("Non-zero exit status %d, call:\n%s" % (exit_code, " ".join(args)))
+            with open(stats_file) as f:
+                return wall_time, json.load(f)
+        finally:
+            rmtree(tmpdir)
+
+    def start_batch(self, pdf_filenames, pages=None):
+        """
+        Extract figures from `pdf_filenames`. If `pages`, a map of document id -> 1 based page numbers,
+        is given, the extractor only locates figures on those pages of the listed documents.
+        """
         tmpdir = tempfile.mkdtemp()
         try:
             # TODO it would be nice remove SBT's logging from reaching STDOUT
             extractions = {}
-            cli_args = " ".join(["run", ",".join(pdf_filenames),
-                                 "-c", "-d", tmpdir + "/", "-e", "-q"])
+            cli_args = ["run", ",".join(pdf_filenames), "-c", "-d", tmpdir + "/", "-e", "-q"]
+            if pages is not None:
+                manifest_file = join(tmpdir, "page-manifest.json")
+                with open(manifest_file, "w") as f:
+                    json.dump(pages, f)
+                cli_args += ["-p", manifest_file]
+            cli_args = " ".join(cli_args)
             args = ["sbt", "-Dsun.java2d.cmm=sun.java2d.cmm.kcms.KcmsServiceProvider", cli_args]
             exit_code = call(args, cwd=self.extractor_home)
             if exit_code != 0:
@@ -78,43 +129,199 @@ class PDFFigures2(object):
             rmtree(tmpdir)
 
     def load_json(self, output_file):
-        figs = []
-        if isfile(output_file):
-            with open(output_file) as f:
-                loaded_figs = json.load(f)
-            for fig in loaded_figs["figures"] + loaded_figs["regionless-captions"]:
-                if "regionBoundary" in fig:
-                    caption = fig["caption"]
-                    bb = fig["regionBoundary"]
-                    region_bb = [bb["x1"], bb["y1"], bb["x2"], bb["y2"]]
-                    bb = fig["captionBoundary"]
-                    caption_bb = [bb["x1"], bb["y1"], bb["x2"], bb["y2"]]
-                else:
-                    bb = fig["boundary"]
-                    caption_bb = [bb["x1"], bb["y1"], bb["x2"], bb["y2"]]
-                    caption = fig["text"]
-                    region_bb = None
-                # For some reason (maybe due to text location issues in PDFBox?) the caption bounding box
-                # is consistently just a little too small relative to our annotated caption bounding box.
-                # It seems fair to account for this by fractionally expanding the returned bounding box
-                caption_bb[1] -= 3
-                caption_bb[0] -= 3
-                caption_bb[2] += 3
-                caption_bb[3] += 3
-                figs.append(Figure(
-                    figure_type=str_to_fig_type(fig["figType"]),
-                    name=fig["name"],
-                    page=fig["page"] + 1,
-                    dpi=72.0,
-                    caption=caption,
-                    caption_bb=caption_bb,
-                    region_bb=region_bb))
-        return figs
+        """
+        Loads the `Figure`s the extractor saved to `output_file`, returns None if there is no such file
+        which means the extractor failed on the document
+        """
+        if not isfile(output_file):
+            return None
+        figure_types, names, pages, captions, caption_bbs, region_bbs = [], [], [], [], [], []
+        with open(output_file) as f:
+            loaded_figs = json.load(f)
+        for fig in loaded_figs["figures"] + loaded_figs["regionless-captions"]:
+            if "regionBoundary" in fig:
+                caption = fig["caption"]
+                bb = fig["regionBoundary"]
+                region_bb = [bb["x1"], bb["y1"], bb["x2"], bb["y2"]]
+                bb = fig["captionBoundary"]
+                caption_bb = [bb["x1"], bb["y1"], bb["x2"], bb["y2"]]
+            else:
+                bb = fig["boundary"]
+                caption_bb = [bb["x1"], bb["y1"], bb["x2"], bb["y2"]]
+                caption = fig["text"]
+                region_bb = None
+            # For some reason (maybe due to text location issues in PDFBox?) the caption bounding box
+            # is consistently just a little too small relative to our annotated caption bounding box.
+            # It seems fair to account for this by fractionally expanding the returned bounding box
+            caption_bb[1] -= 3
+            caption_bb[0] -= 3
+            caption_bb[2] += 3
+            caption_bb[3] += 3
+            figure_types.append(str_to_fig_type(fig["figType"]))
+            names.append(fig["name"])
+            pages.append(fig["page"] + 1)
+            captions.append(caption)
+            caption_bbs.append(caption_bb)
+            region_bbs.append(region_bb)
+        return Figure.bulk(figure_types, names, pages, [72.0] * len(names), captions, caption_bbs, region_bbs)
 
     def get_extractions(self, pdf_filepath, dataset, doc_id):
         return self.extractions[doc_id]
 
 
+class PDFFigures2Server(PDFFigures2):
+    """
+    `PDFFigures2`, but run as a long lived FigureExtractorServer that PDFs are streamed to, so the cost of
+    starting sbt and the JVM is only paid once. The time taken to start the server and the time taken to
+    process the first document (which includes the JIT warm up) are recorded in `startup_time` and
+    `first_document_time`. If the stand-alone jar has been built (`sbt assembly`) it will be used
+    instead of sbt.
+    """
+
+    NAME = "pdffigures2-server"
+
+    def __init__(self):
+        super().__init__()
+        self.output_dir = None
+        # Directory the server writes figure images to, if it was started with `extract_images`
+        self.image_dir = None
+        self.server = None
+        self.address = None
+        self.client = None
+        # Processes that started the server and opened `client`. Forked processes inherit both objects
+        # without them being pickled, these are used to tell that they belong to the parent process
+        self.server_pid = None
+        self.client_pid = None
+        self.first_document_time = None
+
+    @property
+    def startup_time(self):
+        return None if self.server is None else self.server.startup_time
+
+    def start_server(self, extract_images=False, threads=1):
+        """
+        Start the server if it is not already running, or restart it if this process started it with a
+        different `extract_images` setting. `threads` sets how many documents it will process in parallel,
+        which is useful if this object is going to be shared between processes. If `extract_images` is set
+        figure images are written to `image_dir`, which exists until the server is closed
+        """
+        if self.address is not None and self.server_pid == os.getpid() and \
+                extract_images != (self.image_dir is not None):
+            self.close()
+        if self.address is None:
+            self.output_dir = tempfile.mkdtemp()
+            args = ["-c", "-q", "-d", self.output_dir + "/"]
+            if extract_images:
+                self.image_dir = tempfile.mkdtemp()
+                args += ["-m", self.image_dir + "/fig"]
+            self.server = ExtractorServer(self.extractor_home, args, threads)
+            self.address = self.server.start()
+            self.server_pid = os.getpid()
+            atexit.register(self.close)
+
+    def connect(self):
+        """
+        Returns this process's connection to the server, connecting on first use and starting the server if
+        it is not running
+        """
+        if self.client is None or self.client_pid != os.getpid():
+            if self.address is None:
+                self.start_server()
+            self.client = ExtractorClient(self.address)
+            self.client_pid = os.getpid()
+        return self.client
+
+    def close(self):
+        if self.client is not None:
+            if self.client_pid == os.getpid():
+                self.client.close()
+            self.client = None
+        if self.server is not None and self.server_pid == os.getpid():
+            # Only the process that started the server owns it and its output and image directories
+            self.server.close()
+            self.server = None
+            self.address = None
+            rmtree(self.output_dir)
+            self.output_dir = None
+            if self.image_dir is not None:
+                rmtree(self.image_dir)
+                self.image_dir = None
+
+    def __getstate__(self):
+        # Copies sent to other processes open their own connection to this object's server, using its
+        # address, rather than starting their own server or sharing this process's socket
+        state = self.__dict__.copy()
+        state["server"] = None
+        state["client"] = None
+        return state
+
+    def extract(self, pdf_filename, pages=None):
+        """
+        Returns the `Figure`s the server extracted from `pdf_filename`, optionally only from `pages`, or None
+        if the server failed to process it
+        """
+        client = self.connect()
+        t0 = time()
+        response = client.process(pdf_filename, pages)
+        if self.first_document_time is None:
+            self.first_document_time = time() - t0
+        if "error" in response:
+            # Mirror the batch CLI with "-e", errors are logged and no figures are returned
+            error = response["error"]
+            print("Error extracting %s: %s: %s" % (pdf_filename, error["className"], error.get("msg")))
+        doc_id = pdf_filename[:pdf_filename.rfind(".")].split("/")[-1]
+        output_file = join(self.output_dir, doc_id + ".json")
+        figs = self.load_json(output_file)
+        if isfile(output_file):
+            remove(output_file)
+        return None if "error" in response else figs
+
+    def get_latency_report(self):
+        def seconds(t):
+            return "n/a" if t is None else "%0.2f seconds" % t
+        return "server startup: %s, first document: %s" % (
+            seconds(self.startup_time), seconds(self.first_document_time))
+
+    def time(self, pdf_filenames, extract_images=False, verbose=False):
+        try:
+            self.start_server(extract_images)
+            t0 = time()
+            for filename in pdf_filenames:
+                self.extract(filename)
+            if verbose:
+                print(self.get_latency_report())
+                print("Processing time: %0.2f seconds" % (time() - t0))
+        finally:
+            self.close()
+
+    def run_with_stats(self, pdf_filenames, extract_images=False):
+        """
+        Sends `pdf_filenames` to the server, starting it if needed (or restarting it if it was started with a
+        different `extract_images`). Returns the wall-clock time taken, which does not include starting the
+        server (see `startup_time`), and the list of `ProcessingStatistics` (or `ProcessingError`)
+        dictionaries the server returned
+        """
+        self.start_server(extract_images)
+        client = self.connect()
+        results = []
+        t0 = time()
+        for filename in pdf_filenames:
+            response = client.process(filename)
+            results.append(response["stats"] if "stats" in response else response["error"])
+            doc_id = filename[:filename.rfind(".")].split("/")[-1]
+            output_file = join(self.output_dir, doc_id + ".json")
+            if isfile(output_file):
+                remove(output_file)
+        return time() - t0, results
+
+    def start_batch(self, pdf_filenames, pages=None):
+        self.extractions = {}
+        for filename in pdf_filenames:
+            doc_id = filename[:filename.rfind(".")].split("/")[-1]
+            doc_pages = None if pages is None else pages.get(doc_id)
+            self.extractions[doc_id] = self.extract(filename, doc_pages)
+
+
 class PDFFigures(object):
     """
     The original C++ based pffigures program. Requires the CLI tool `pdffigures` to be in PATH
@@ -132,6 +339,9 @@ class PDFFigures(object):
     def get_version(self):
         return check_output(["pdffigures", "--version"]).decode("UTF-8").strip()
 
+    def get_build_id(self):
+        return None
+
     def time(self, pdf_filenames, extract_images=False, verbose=False):
         output_dir = tempfile.mkdtemp()
         try:
@@ -145,7 +355,32 @@ class PDFFigures(object):
         finally:
             rmtree(output_dir)
 
-    def start_batch(self, pdf_filenames):
+    def run_with_stats(self, pdf_filenames, extract_images=False):
+        """
+        Runs pdffigures on each of `pdf_filenames`, returns the total wall-clock time and a list of
+        dictionaries in the same format as pdffigures2's `ProcessingStatistics`
+        """
+        output_dir = tempfile.mkdtemp()
+        try:
+            args = ["pdffigures", "-i", "-m", "-j", join(output_dir, "output.json")]
+            if extract_images:
+                args += ["-o", output_dir]
+            results = []
+            t0 = time()
+            for filename in pdf_filenames:
+                t1 = time()
+                exit_code = call(args + [filename], stderr=DEVNULL, stdout=DEVNULL)
+                if exit_code != 0:
+                    results.append(dict(filename=filename, msg="Exit code %d" % exit_code,
+                                        className="ExitCode"))
+                else:
+                    results.append(dict(filename=filename, numPages=get_num_pages_in_pdf(filename),
+                                        timeInMillis=int((time() - t1) * 1000)))
+            return time() - t0, results
+        finally:
+            rmtree(output_dir)
+
+    def start_batch(self, pdf_filenames, pages=None):
         pass
 
     def get_extractions(self, pdf_filepath, dataset, doc_id):
@@ -186,7 +421,8 @@ class PDFFigures(object):
 
 EXTRACTORS = {
   PDFFigures.NAME: PDFFigures,
-  PDFFigures2.NAME: PDFFigures2
+  PDFFigures2.NAME: PDFFigures2,
+  PDFFigures2Server.NAME: PDFFigures2Server
 }
 
 
@@ -0,0 +1,257 @@
+from collections import Counter
+import numpy as np
+from pdffigures_utils import Error, EvaluatedFigure, FigureType, PageBitmapCache, scale_figure, \
+    scale_and_crop_figure, compare_captions
+
+"""
+Grades extracted figures against the true figures of many documents at once. Documents are paired up and
+their boxes scaled and cropped one at a time (`FigurePairs.add_document`), then every pair is graded
+in a single vectorized pass (`FigurePairs.grade`).
+"""
+
+""" How high the intersection/union ration of two bounding boxes has to be
+for them to be considered correct """
+UNION_INTERSECT_OVERLAP_THRESH = 0.8
+
+_NO_BOX = [np.nan] * 4
+
+
+def pair_extractions(labels, extractions):
+    """
+    :param labels: list of 'Label' figures, currently we assume they are uniquely identified
+        by (page, figure_type, and number)
+    :param extractions: list of 'extraction' Figures
+    :return: yields (true_figure, extracted_figure) for each name found in either
+             labels of extractions, either true_figure or extracted_figure may be None
+             if there were figures in `extractions` that were not found in `labels` or vice versa
+    """
+
+    label_ids_to_fig = {fig.get_id(): fig for fig in labels}
+    if len(label_ids_to_fig) != len(labels):
+        raise ValueError("Multiple labels with the same ID")
+
+    ids_in_extractions = set(fig.get_id() for fig in extractions)
+    for fig_id, fig in label_ids_to_fig.items():
+        if fig_id not in ids_in_extractions:
+            yield fig, None
+
+    for fig in extractions:
+        fig_id = fig.get_id()
+        yield label_ids_to_fig.get(fig_id), fig
+
+
+def box_overlaps_vectorized(boxes1, boxes2):
+    """
+    Returns the overlap `box_overlap` would compute for each pair of rows in the (n, 4) arrays
+    `boxes1` and `boxes2`. Rows where either box is missing (NaN) get NaN.
+    """
+    # The same sanity checks as `box_overlap`, on the rows that have both boxes
+    present = ~(np.isnan(boxes1).any(axis=1) | np.isnan(boxes2).any(axis=1))
+    for boxes in [boxes1[present], boxes2[present]]:
+        assert np.all(boxes[:, 0] < boxes[:, 2]) and np.all(boxes[:, 1] < boxes[:, 3])
+    union = ((np.maximum(boxes1[:, 2], boxes2[:, 2]) - np.minimum(boxes1[:, 0], boxes2[:, 0])) *
+             (np.maximum(boxes1[:, 3], boxes2[:, 3]) - np.minimum(boxes1[:, 1], boxes2[:, 1])))
+    intersect = ((np.minimum(boxes1[:, 2], boxes2[:, 2]) - np.maximum(boxes1[:, 0], boxes2[:, 0])) *
+                 (np.minimum(boxes1[:, 3], boxes2[:, 3]) - np.maximum(boxes1[:, 1], boxes2[:, 1])))
+    disjoint = ((boxes2[:, 0] > boxes1[:, 2]) | (boxes2[:, 1] > boxes1[:, 3]) |
+                (boxes1[:, 0] > boxes2[:, 2]) | (boxes1[:, 1] > boxes2[:, 3]))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        overlap = intersect / union
+    overlap[disjoint] = 0
+    assert np.all((overlap[present] >= 0.0) & (overlap[present] <= 1.0))
+    return overlap
+
+
+class GradedFigures(object):
+    """
+    Result of `FigurePairs.grade`. Behaves like a read-only list of `EvaluatedFigure`, which are only built
+    when they are accessed. `errors` holds the value of the `Error` of each figure.
+    """
+
+    def __init__(self, docs, true_figures, extracted_figures, figure_types, errors):
+        self.docs = docs
+        self.true_figures = true_figures
+        self.extracted_figures = extracted_figures
+        self.figure_types = figure_types
+        self.errors = errors
+
+    def __len__(self):
+        return len(self.errors)
+
+    def __getitem__(self, i):
+        return EvaluatedFigure(self.true_figures[i], self.extracted_figures[i], Error(int(self.errors[i])),
+                               self.docs[i])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def get_error_counts(self, figure_type=None):
+        """ Returns a Counter of `Error` -> number of figures, optionally only for figures of `figure_type` """
+        errors = self.errors
+        if figure_type is not None:
+            errors = errors[self.figure_types == figure_type.value]
+        values, counts = np.unique(errors, return_counts=True)
+        return Counter({Error(int(v)): int(c) for v, c in zip(values, counts)})
+
+    @staticmethod
+    def concatenate(parts):
+        """ Returns a `GradedFigures` containing the figures of each `GradedFigures` in `parts`, in order """
+        return GradedFigures([x for part in parts for x in part.docs],
+                             [x for part in parts for x in part.true_figures],
+                             [x for part in parts for x in part.extracted_figures],
+                             np.concatenate([np.zeros(0, dtype=np.int8)] + [x.figure_types for x in parts]),
+                             np.concatenate([np.zeros(0, dtype=np.int8)] + [x.errors for x in parts]))
+
+
+class FigurePairs(object):
+    """
+    The true and extracted figures of any number of documents paired up by name (see `pair_extractions`),
+    along with their boxes scaled to the dataset's DPI. Missing boxes are stored as NaN.
+    """
+
+    def __init__(self):
+        self.docs = []
+        self.true_figures = []
+        self.extracted_figures = []
+        self.figure_types = []
+        self.true_boxes = []
+        self.extracted_boxes = []
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add_document(self, document, extractions, crop_extractions, bitmap_cache=None):
+        """
+        Pairs `extractions` with the true figures of `document`, ignoring extractions on pages that were not
+        annotated, and whitespace crops the extracted boxes if `crop_extractions` is set
+        """
+        if crop_extractions and bitmap_cache is None:
+            bitmap_cache = PageBitmapCache()
+        pages = document.pages_annotated
+        extracted_figures = [x for x in extractions if x.page in pages]
+        for true_figure, extracted_figure in pair_extractions(document.figures, extracted_figures):
+            if true_figure is not None:
+                true_boxes = [x if x is not None else _NO_BOX for x in scale_figure(true_figure, document.dpi)]
+                figure_type = true_figure.figure_type
+            else:
+                true_boxes = [_NO_BOX, _NO_BOX]
+                figure_type = extracted_figure.figure_type
+            if extracted_figure is None:
+                extracted_boxes = [_NO_BOX, _NO_BOX]
+            elif crop_extractions and true_figure is not None:
+                # Only extractions paired with a true figure have their boxes compared, so only crop those
+                if document.page_bitmaps is not None:
+                    foreground = document.page_bitmaps[extracted_figure.page]
+                elif document.gray_images is not None:
+                    foreground = bitmap_cache.get(document.gray_images[extracted_figure.page])
+                else:
+                    raise ValueError("Unable to corp extraction since grayscale image have not been built" +
+                                     " for document %s" % document.doc_id)
+                extracted_boxes = [x if x is not None else _NO_BOX for x in
+                                   scale_and_crop_figure(extracted_figure, foreground, document.dpi)]
+            else:
+                extracted_boxes = [x if x is not None else _NO_BOX for x in
+                                   scale_figure(extracted_figure, document.dpi)]
+            self.docs.append(document.doc_id)
+            self.true_figures.append(true_figure)
+            self.extracted_figures.append(extracted_figure)
+            self.figure_types.append(figure_type.value)
+            self.true_boxes.append(true_boxes)
+            self.extracted_boxes.append(extracted_boxes)
+
+    def extend(self, other):
+        self.docs += other.docs
+        self.true_figures += other.true_figures
+        self.extracted_figures += other.extracted_figures
+        self.figure_types += other.figure_types
+        self.true_boxes += other.true_boxes
+        self.extracted_boxes += other.extracted_boxes
+
+    def grade(self, compare_caption_text):
+        """
+        Grades every pair, returns a `GradedFigures` with the same results grading each document one figure
+        at a time would give (see `grade_document_extractions` in test_grading.py)
+        """
+        n = len(self)
+        true_boxes = np.array(self.true_boxes, dtype=np.float64).reshape(n, 2, 4)
+        extracted_boxes = np.array(self.extracted_boxes, dtype=np.float64).reshape(n, 2, 4)
+        has_true = np.array([x is not None for x in self.true_figures], dtype=bool)
+        has_extraction = np.array([x is not None for x in self.extracted_figures], dtype=bool)
+        has_extracted_caption = ~np.isnan(extracted_boxes[:, 0, 0])
+        has_extracted_region = ~np.isnan(extracted_boxes[:, 1, 0])
+
+        if np.any(has_extraction & ~has_extracted_caption):
+            raise ValueError("Extraction without a caption box")
+
+        paired = has_true & has_extraction
+        caption_correct = np.zeros(n, dtype=bool)
+        caption_correct[paired] = box_overlaps_vectorized(
+            extracted_boxes[paired, 0], true_boxes[paired, 0]) >= UNION_INTERSECT_OVERLAP_THRESH
+        if compare_caption_text:
+            for i in np.flatnonzero(paired & ~caption_correct):
+                caption_correct[i] = compare_captions(self.true_figures[i].caption,
+                                                      self.extracted_figures[i].caption)
+        with_region = paired & has_extracted_region
+        region_correct = np.zeros(n, dtype=bool)
+        region_correct[with_region] = box_overlaps_vectorized(
+            extracted_boxes[with_region, 1], true_boxes[with_region, 1]) >= UNION_INTERSECT_OVERLAP_THRESH
+
+        errors = np.select(
+            [~has_extraction,
+             ~has_true & ~has_extracted_region,
+             ~has_true,
+             ~has_extracted_region & caption_correct,
+             ~has_extracted_region,
+             ~region_correct & ~caption_correct,
+             ~region_correct,
+             ~caption_correct],
+            [Error.missing.value,
+             Error.false_positive_no_region.value,
+             Error.false_positive.value,
+             Error.right_caption_no_region.value,
+             Error.wrong_caption_no_region.value,
+             Error.wrong_caption_and_region.value,
+             Error.wrong_region_box.value,
+             Error.wrong_caption_box.value],
+            Error.correct.value).astype(np.int8)
+        return GradedFigures(self.docs, self.true_figures, self.extracted_figures,
+                             np.array(self.figure_types, dtype=np.int8), errors)
+
+
+class StreamingGrader(object):
+    """
+    Grades `FigurePairs` as they are produced. Pairs are graded every `batch_size` documents and, if `writer`
+    (an `evaluation_store.ColumnarEvaluationWriter`) is given, each graded batch is appended to it as a
+    part, so the parts written before a run is interrupted are kept.
+    """
+
+    def __init__(self, compare_caption_text, batch_size, writer=None):
+        if batch_size < 1:
+            raise ValueError("Batch size must be >= 1")
+        self.compare_caption_text = compare_caption_text
+        self.batch_size = batch_size
+        self.writer = writer
+        self.pending = FigurePairs()
+        self.pending_docs = 0
+        self.parts = []
+
+    def add(self, pairs, num_docs):
+        """ Adds `pairs`, the pairs of `num_docs` documents """
+        self.pending.extend(pairs)
+        self.pending_docs += num_docs
+        if self.pending_docs >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) > 0:
+            graded = self.pending.grade(self.compare_caption_text)
+            if self.writer is not None:
+                self.writer.append(graded)
+            self.parts.append(graded)
+        self.pending = FigurePairs()
+        self.pending_docs = 0
+
+    def finish(self):
+        """ Grades any remaining pairs, returns a `GradedFigures` of every pair that was added """
+        self.flush()
+        return GradedFigures.concatenate(self.parts)
@@ -1,8 +1,10 @@
 import argparse
 from collections import Counter, defaultdict
-import pickle
+from os.path import isdir
+import numpy as np
 from pdffigures_utils import *
 from datasets import datasets
+from evaluation_store import ColumnarEvaluation, load_evaluation
 from random import shuffle
 
 """
@@ -54,6 +56,21 @@ def print_pr(evaluation, caption_only):
             error_counts_tables[fig.error] += 1
         else:
             raise RuntimeError()
+    print_error_counts(error_counts_tables, error_counts_figures, caption_only)
+
+
+def print_pr_columns(evaluation, caption_only, docs=None, figure_type=None):
+    """ `print_pr` for a `ColumnarEvaluation`, only reads the columns it needs """
+    columns = evaluation.load_columns(["figure_type", "error"], docs, figure_type)
+    counts = {}
+    for fig_type in FigureType:
+        errors = columns["error"][columns["figure_type"] == fig_type.value]
+        values, value_counts = np.unique(errors, return_counts=True)
+        counts[fig_type] = Counter({Error(int(v)): int(c) for v, c in zip(values, value_counts)})
+    print_error_counts(counts[FigureType.table], counts[FigureType.figure], caption_only)
+
+
+def print_error_counts(error_counts_tables, error_counts_figures, caption_only):
 
     def print_count_table(table):
         for k, v in table.items():
@@ -135,7 +152,7 @@ def show_errors(evaluation, random_order, errors_to_show):
 
 def main():
     parser = argparse.ArgumentParser(description='Display an evaluation')
-    parser.add_argument("evaluation")
+    parser.add_argument("evaluation", help="Evaluation pickle or directory saved in the columnar format")
     parser.add_argument("-s", "--show-errors", nargs="?", const="all",
                         choices=[x.name for x in Error] + ["all"])
     parser.add_argument("-t", "--list-errors", action='store_true')
@@ -145,19 +162,31 @@ def main():
     parser.add_argument("-c", "--caption-evaluation", action='store_true')
     args = parser.parse_args()
 
-    with open(args.evaluation, "rb") as f:
-        evaluation = pickle.load(f)
+    figure_type = None
+    if args.type is not None:
+        figure_type = FigureType.figure if args.type[0] == "F" else FigureType.table
+    docs = None if args.doc is None else [args.doc]
+
+    if isdir(args.evaluation):
+        evaluation = ColumnarEvaluation(args.evaluation)
+    else:
+        evaluation = load_evaluation(args.evaluation)
 
     print("Extractor: %s (version=%s)" % (evaluation.extractor_name, evaluation.extractor_version))
     print("Dataset: %s (version=%s)" % (evaluation.dataset_name, evaluation.dataset_version))
 
-    if args.doc is not None:
-        evaluation.evaluated_figures = [x for x in evaluation.evaluated_figures if x.doc == args.doc]
-    if args.type is not None:
-        figure_type = FigureType.figure if args.type[0] == "F" else FigureType.table
-        evaluation.evaluated_figures = [x for x in evaluation.evaluated_figures if x.figure_type == figure_type]
-
-    print_pr(evaluation, args.caption_evaluation)
+    if isinstance(evaluation, ColumnarEvaluation):
+        print_pr_columns(evaluation, args.caption_evaluation, docs, figure_type)
+        if args.show_errors is None and not args.list_errors:
+            return
+        evaluation = evaluation.to_evaluation(docs, figure_type)
+    else:
+        if docs is not None:
+            evaluation.evaluated_figures = [x for x in evaluation.evaluated_figures if x.doc in docs]
+        if figure_type is not None:
+            evaluation.evaluated_figures = [x for x in evaluation.evaluated_figures
+                                            if x.figure_type == figure_type]
+        print_pr(evaluation, args.caption_evaluation)
     if args.show_errors is not None:
         if args.show_errors == "all":
             if args.caption_evaluation:
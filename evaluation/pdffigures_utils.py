@@ -1,8 +1,16 @@
+from collections import OrderedDict, defaultdict
 from enum import Enum
+from functools import lru_cache
+import os
+from os.path import isfile, getsize
 from unicodedata import normalize
 from PIL import Image, ImageDraw, ImageChops
+import numpy as np
+import json
 from subprocess import check_output
 import re
+import sys
+import xml.etree.ElementTree as ElementTree
 
 
 class FigureType(Enum):
@@ -34,7 +42,29 @@ def str_to_fig_type(string):
         raise ValueError("%s is not a valid figure type string" % string)
 
 
+def _row_to_box(row):
+    if row[0] != row[0]:  # NaN marks a missing box
+        return None
+    return tuple(row.tolist())
+
+
+def _to_box(box):
+    return None if box is None else tuple(box)
+
+
 class Figure(object):
+    """
+    A figure or table and its caption. To keep large numbers of figures compact, names are interned and
+    the caption and region boxes are tuples, figures built with `Figure.bulk` instead store their boxes as
+    a row of eight floats (NaN for missing boxes) in an array shared between all of them. Boxes are returned
+    as tuples either way, so they can not be modified in place.
+    """
+
+    __slots__ = ["figure_type", "name", "page", "page_height", "page_width", "dpi", "caption",
+                 "_caption_bb", "_region_bb", "_boxes", "_row"]
+
+    """ Names of the fields stored in the dictionaries `as_dict` returns and `from_dict` reads """
+    FIELDS = ["figure_type", "name", "page", "page_height", "page_width", "dpi", "caption", "caption_bb", "region_bb"]
 
     @staticmethod
     def from_dict(data):
@@ -42,9 +72,46 @@ class Figure(object):
                       data["dpi"], data["caption"], data["page_height"], data["page_width"],
                       data["caption_bb"], data["region_bb"])
 
+    @staticmethod
+    def from_dicts(data):
+        """ Builds `Figure`s from a list of `as_dict` output without validating them """
+        return Figure.bulk([str_to_fig_type(x["figure_type"]) for x in data], [x["name"] for x in data],
+                           [x["page"] for x in data], [x["dpi"] for x in data], [x["caption"] for x in data],
+                           [x["caption_bb"] for x in data], [x["region_bb"] for x in data],
+                           [x["page_height"] for x in data], [x["page_width"] for x in data])
+
+    @staticmethod
+    def bulk(figure_types, names, pages, dpis, captions, caption_bbs, region_bbs, page_heights=None,
+             page_widths=None):
+        """
+        Builds many `Figure`s at once from parallel lists of their fields, skipping the checks the constructor
+        does. The boxes of all the figures are stored in one array, so they are returned as floats.
+        """
+        n = len(names)
+        boxes = np.full((n, 8), np.nan)
+        figures = []
+        for i in range(n):
+            if caption_bbs[i] is not None:
+                boxes[i, :4] = caption_bbs[i]
+            if region_bbs[i] is not None:
+                boxes[i, 4:] = region_bbs[i]
+            fig = Figure.__new__(Figure)
+            fig.figure_type = figure_types[i]
+            fig.name = sys.intern(names[i])
+            fig.page = pages[i]
+            fig.page_height = None if page_heights is None else page_heights[i]
+            fig.page_width = None if page_widths is None else page_widths[i]
+            fig.dpi = dpis[i]
+            fig.caption = captions[i]
+            fig._caption_bb = None
+            fig._region_bb = None
+            fig._boxes = boxes
+            fig._row = i
+            figures.append(fig)
+        return figures
+
     def as_dict(self):
-        data = {}
-        data.update(self.__dict__)
+        data = {x: getattr(self, x) for x in self.FIELDS}
         data["figure_type"] = fig_type_to_str(data["figure_type"])
         return data
 
@@ -70,15 +137,60 @@ class Figure(object):
         if not isinstance(name, str):
             raise ValueError("Name was not a string")
 
-        self.name = name
+        self.name = sys.intern(name)
         self.figure_type = figure_type
         self.page = page
         self.page_height = page_height
         self.page_width = page_width
         self.dpi = dpi
         self.caption = caption
-        self.caption_bb = caption_bb
-        self.region_bb = region_bb
+        self._caption_bb = _to_box(caption_bb)
+        self._region_bb = _to_box(region_bb)
+        self._boxes = None
+        self._row = None
+
+    @property
+    def caption_bb(self):
+        if self._boxes is None:
+            return self._caption_bb
+        return _row_to_box(self._boxes[self._row, :4])
+
+    @caption_bb.setter
+    def caption_bb(self, box):
+        if self._boxes is None:
+            self._caption_bb = _to_box(box)
+        else:
+            self._boxes[self._row, :4] = np.nan if box is None else box
+
+    @property
+    def region_bb(self):
+        if self._boxes is None:
+            return self._region_bb
+        return _row_to_box(self._boxes[self._row, 4:])
+
+    @region_bb.setter
+    def region_bb(self, box):
+        if self._boxes is None:
+            self._region_bb = _to_box(box)
+        else:
+            self._boxes[self._row, 4:] = np.nan if box is None else box
+
+    def __getstate__(self):
+        return {x: getattr(self, x) for x in self.FIELDS}
+
+    def __setstate__(self, state):
+        # Also used to load figures pickled before `Figure` used slots, whose state was their __dict__
+        self.figure_type = state["figure_type"]
+        self.name = sys.intern(state["name"])
+        self.page = state["page"]
+        self.page_height = state["page_height"]
+        self.page_width = state["page_width"]
+        self.dpi = state["dpi"]
+        self.caption = state["caption"]
+        self._caption_bb = _to_box(state["caption_bb"])
+        self._region_bb = _to_box(state["region_bb"])
+        self._boxes = None
+        self._row = None
 
     def __str__(self):
         if self.page_width is not None:
@@ -92,7 +204,7 @@ class Figure(object):
             return "%s:<page=%s, caption=%s>" % (self.name, str(self.page), self.caption[:20])
 
     def __eq__(self, other):
-        return isinstance(other, Figure) and self.__dict__ == other.__dict__
+        return isinstance(other, Figure) and self.__getstate__() == other.__getstate__()
 
 
 class Error(Enum):
@@ -142,6 +254,8 @@ class EvaluatedFigure(object):
     or a true figure and extracted figure that were paired together and graded for correctness.
     """
 
+    __slots__ = ["true_figure", "extracted_figure", "error", "doc"]
+
     def __init__(self, true_figure, extracted_figure, error, doc):
         if true_figure is None and extracted_figure is None:
             raise ValueError()
@@ -155,25 +269,40 @@ class EvaluatedFigure(object):
         self.true_figure = true_figure
         self.extracted_figure = extracted_figure
         self.error = error
-        if true_figure is not None:
-            self.name = true_figure.name
-            self.page = true_figure.page
-            self.figure_type = true_figure.figure_type
-        else:
-            self.figure_type = extracted_figure.figure_type
-            self.name = extracted_figure.name
-            self.page = extracted_figure.page
-        self.doc = doc
-        if self.figure_type == FigureType.figure:
-            self.name = "F%s p=%d" % (self.name, self.page)
+        self.doc = sys.intern(doc)
+
+    @property
+    def page(self):
+        return (self.true_figure if self.true_figure is not None else self.extracted_figure).page
+
+    @property
+    def figure_type(self):
+        return (self.true_figure if self.true_figure is not None else self.extracted_figure).figure_type
+
+    @property
+    def name(self):
+        figure = self.true_figure if self.true_figure is not None else self.extracted_figure
+        if figure.figure_type == FigureType.figure:
+            return "F%s p=%d" % (figure.name, figure.page)
         else:
-            self.name = "T%s p=%d" % (self.name, self.page)
+            return "T%s p=%d" % (figure.name, figure.page)
 
     def get_id(self):
         return self.doc, self.name
 
+    def __getstate__(self):
+        return dict(true_figure=self.true_figure, extracted_figure=self.extracted_figure,
+                    error=self.error, doc=self.doc)
+
+    def __setstate__(self, state):
+        # Older pickles also include the derived name, page and figure_type, which are ignored
+        self.true_figure = state["true_figure"]
+        self.extracted_figure = state["extracted_figure"]
+        self.error = state["error"]
+        self.doc = sys.intern(state["doc"])
+
     def __eq__(self, other):
-        return isinstance(other, EvaluatedFigure) and self.__dict__ == other.__dict__
+        return isinstance(other, EvaluatedFigure) and self.__getstate__() == other.__getstate__()
 
 
 class Evaluation(object):
@@ -284,6 +413,148 @@ def crop_to_foreground(box, bw_image):
     return cropped
 
 
+def crop_to_foreground_bitmap(box, foreground):
+    """
+    Returns `box` cropped to non-whitespace in `foreground`, a boolean array that is True for non-whitespace
+    pixels. Gives the same result as `crop_to_foreground`, but only looks at the pixels inside `box`
+    """
+    height, width = foreground.shape
+    # Match how PIL rasterizes the rectangle: truncate to int and include the right and bottom edges
+    x1, y1, x2, y2 = [int(x) for x in box]
+    x1, y1 = max(x1, 0), max(y1, 0)
+    x2, y2 = min(x2, width - 1), min(y2, height - 1)
+    if x2 < x1 or y2 < y1:
+        return None
+    region = foreground[y1:y2 + 1, x1:x2 + 1]
+    rows = np.flatnonzero(region.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(region[rows[0]:rows[-1] + 1].any(axis=0))
+    return x1 + int(cols[0]), y1 + int(rows[0]), x1 + int(cols[-1]) + 1, y1 + int(rows[-1]) + 1
+
+
+def load_foreground_bitmap(image_file, threshold=200):
+    """ Returns a boolean array marking pixels darker than `threshold` in the image at `image_file` """
+    with Image.open(image_file) as img:
+        return np.asarray(img.convert('L')) < threshold
+
+
+class PageBitmapCache(object):
+    """
+    Least recently used cache of the foreground bitmaps (see `load_foreground_bitmap`) of up to
+    `max_pages` page images, so pages shared by several figures are only decoded once
+    """
+
+    def __init__(self, max_pages=16):
+        self.max_pages = max_pages
+        self._bitmaps = OrderedDict()
+
+    def get(self, image_file):
+        bitmap = self._bitmaps.get(image_file)
+        if bitmap is None:
+            bitmap = load_foreground_bitmap(image_file)
+            self._bitmaps[image_file] = bitmap
+            if len(self._bitmaps) > self.max_pages:
+                self._bitmaps.popitem(last=False)
+        else:
+            self._bitmaps.move_to_end(image_file)
+        return bitmap
+
+
+class PackedBitmap(object):
+    """
+    Read-only boolean page bitmap stored with eight pixels per byte (see `numpy.packbits`). Supports `shape`
+    and two dimensional slicing, which only unpacks the requested region, so it can be passed to
+    `crop_to_foreground_bitmap` in place of a boolean array
+    """
+
+    def __init__(self, packed, width):
+        self.packed = packed
+        self.shape = (packed.shape[0], width)
+
+    def __getitem__(self, key):
+        rows, cols = key
+        x1, x2, _ = cols.indices(self.shape[1])
+        if x2 <= x1:
+            return np.zeros((len(range(*rows.indices(self.shape[0]))), 0), dtype=bool)
+        bits = np.unpackbits(self.packed[rows, x1 // 8:(x2 - 1) // 8 + 1], axis=1)
+        start = x1 % 8
+        return bits[:, start:start + x2 - x1].astype(bool)
+
+    def unpack(self):
+        return self[:, :]
+
+
+class PageBitmapStore(object):
+    """
+    Foreground bitmaps (see `load_foreground_bitmap`) for every page of every document in a dataset, packed
+    into a single file that is memory mapped when read. `index_file` is a JSON file mapping
+    document id -> page number -> [byte offset, height, width] of that page's bitmap in `data_file`.
+    When adding documents the index is saved every `save_every` documents, `save_index` has to be called
+    once the last document is added.
+    """
+
+    def __init__(self, data_file, index_file, save_every=100):
+        self.data_file = data_file
+        self.index_file = index_file
+        self.save_every = save_every
+        if isfile(index_file):
+            with open(index_file) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+        self._end = max([offset + height * ((width + 7) // 8) for pages in self.index.values()
+                         for offset, height, width in pages.values()], default=0)
+        self._unsaved = 0
+        self._data = None
+
+    def get_doc_ids(self):
+        return self.index.keys()
+
+    def get_page_bitmaps(self, doc_id):
+        """ Returns a map of page number (1 based) -> `PackedBitmap` for `doc_id`, or None if it is not stored """
+        if doc_id not in self.index:
+            return None
+        if self._data is None:
+            self._data = np.memmap(self.data_file, dtype=np.uint8, mode="r")
+        bitmaps = {}
+        for page, (offset, height, width) in self.index[doc_id].items():
+            row_bytes = (width + 7) // 8
+            packed = self._data[offset:offset + height * row_bytes].reshape(height, row_bytes)
+            bitmaps[int(page)] = PackedBitmap(packed, width)
+        return bitmaps
+
+    def add_document(self, doc_id, page_bitmaps):
+        """
+        Appends the boolean arrays in `page_bitmaps`, a map of page number -> bitmap, to the store. Pages
+        written after the index was last saved, for example by a run that was interrupted, are overwritten
+        """
+        if isfile(self.data_file) and getsize(self.data_file) < self._end:
+            raise ValueError("%s is smaller than its index says it should be" % self.data_file)
+        pages = {}
+        with open(self.data_file, "r+b" if isfile(self.data_file) else "wb") as f:
+            f.truncate(self._end)
+            f.seek(self._end)
+            for page, bitmap in sorted(page_bitmaps.items()):
+                height, width = bitmap.shape
+                pages[str(page)] = [f.tell(), height, width]
+                f.write(np.packbits(bitmap, axis=1).tobytes())
+            self._end = f.tell()
+        self.index[doc_id] = pages
+        self._data = None
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save_index()
+
+    def save_index(self):
+        """ Saves the index of the documents added so far """
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_file, self.index_file)
+        self._unsaved = 0
+
+
 def scale_figure(figure, dpi):
     """ Returns the caption and region bbox of a `figure` when scaled to `dpi` """
     rescaling = dpi/figure.dpi
@@ -298,18 +569,18 @@ def scale_figure(figure, dpi):
     return caption_box, region_box
 
 
-def scale_and_crop_figure(figure, img, img_dpi):
+def scale_and_crop_figure(figure, foreground, img_dpi):
     """
     Returns the caption and region bbox of a `figure` when scaled to `image_dpi` and
-    whitespace cropped to `img`
+    whitespace cropped to `foreground`, a page bitmap from `load_foreground_bitmap`
     """
     caption_box, region_box = scale_figure(figure, img_dpi)
     if caption_box is not None:
-        cropped = crop_to_foreground(caption_box, img)
+        cropped = crop_to_foreground_bitmap(caption_box, foreground)
         if cropped is not None:
             caption_box = cropped
     if region_box is not None:
-        cropped = crop_to_foreground(region_box, img)
+        cropped = crop_to_foreground_bitmap(region_box, foreground)
         if cropped is not None:
             region_box = cropped
     return caption_box, region_box
@@ -325,6 +596,13 @@ def get_num_pages_in_pdf(pdf_filepath):
     """
     Returns the number of pages of the PDF found at `pdf_filepath`
     """
+    # Cached by size and modification time as well, so a PDF that is replaced is counted again
+    stat = os.stat(pdf_filepath)
+    return _get_num_pages_in_pdf(pdf_filepath, stat.st_size, stat.st_mtime)
+
+
+@lru_cache(maxsize=4096)
+def _get_num_pages_in_pdf(pdf_filepath, size, mtime):
     args = ["pdfinfo", pdf_filepath]
     output = check_output(args).decode("UTF-8")
     lines = output.split("\n")
@@ -335,17 +613,80 @@ def get_num_pages_in_pdf(pdf_filepath):
     raise ValueError("No page returned?")
 
 
-def get_pdf_text(pdf_filepath, page, box, dpi, tol=0):
+class PdfTextIndex(object):
     """
-    Returns the text found on the given `page` and `box` containing coordinates specified at dpi `dpi`on the
-    pdf at `pdf_filepath` while padding `box` by `tol`.
+    The words on each page of a PDF and their bounding boxes (in points), indexed by a grid over the page
+    so the text inside a region can be found without re-running pdftotext. Words are assigned to a region
+    if their center falls inside it, which is how pdftotext decides what text is inside a crop box.
     """
-    box = [round(x) for x in box]
-    args = ["pdftotext", "-x", str(box[0] - tol), "-y", str(box[1] - tol), "-W",
-            str(box[2] - box[0] + tol*2), "-H", str(box[3] - box[1] + tol*2), "-f", str(page),
-            "-l", str(page), "-r", str(dpi), pdf_filepath, "-"]
-    output = check_output(args)
-    return output.decode("UTF-8").rstrip()
+
+    """ Size, in points, of the cells of the grid used to index the words """
+    CELL_SIZE = 36
+
+    @staticmethod
+    def from_pdf(pdf_filepath):
+        output = check_output(["pdftotext", "-bbox-layout", pdf_filepath, "-"])
+        return PdfTextIndex.from_bbox_layout(output.decode("UTF-8"))
+
+    @staticmethod
+    def from_bbox_layout(xhtml):
+        """ Builds an index from the XHTML output of `pdftotext -bbox-layout` """
+        root = ElementTree.fromstring(xhtml)
+        pages = []
+        for page in root.iter():
+            if page.tag.split("}")[-1] != "page":
+                continue
+            words = []
+            for line_num, line in enumerate(x for x in page.iter() if x.tag.split("}")[-1] == "line"):
+                for word in line:
+                    words.append((float(word.get("xMin")), float(word.get("yMin")),
+                                  float(word.get("xMax")), float(word.get("yMax")),
+                                  word.text or "", line_num))
+            pages.append(words)
+        return PdfTextIndex(pages)
+
+    def __init__(self, pages):
+        """ `pages` is a list containing, for each page, a list of (x1, y1, x2, y2, text, line number) tuples """
+        self.pages = pages
+        self.grids = []
+        for words in pages:
+            grid = defaultdict(list)
+            for i, (x1, y1, x2, y2, _, _) in enumerate(words):
+                grid[(int((x1 + x2) / 2 // self.CELL_SIZE), int((y1 + y2) / 2 // self.CELL_SIZE))].append(i)
+            self.grids.append(grid)
+
+    def get_num_pages(self):
+        return len(self.pages)
+
+    def get_words(self, page, box):
+        """ Returns the words on `page` (1 based) whose centers are inside `box`, given in points """
+        words = self.pages[page - 1]
+        grid = self.grids[page - 1]
+        x1, y1, x2, y2 = box
+        found = []
+        for cell_x in range(int(x1 // self.CELL_SIZE), int(x2 // self.CELL_SIZE) + 1):
+            for cell_y in range(int(y1 // self.CELL_SIZE), int(y2 // self.CELL_SIZE) + 1):
+                for i in grid.get((cell_x, cell_y), []):
+                    wx1, wy1, wx2, wy2, _, _ = words[i]
+                    if x1 <= (wx1 + wx2) / 2 <= x2 and y1 <= (wy1 + wy2) / 2 <= y2:
+                        found.append(i)
+        return [words[i] for i in sorted(found)]
+
+    def get_text(self, page, box, dpi, tol=0):
+        """
+        Returns the text on `page` (1 based) inside `box`, given in coordinates at dpi `dpi`, padded by `tol`.
+        Words on the same line are separated by spaces, and lines by newlines
+        """
+        scale = 72.0 / dpi
+        box = [(box[0] - tol) * scale, (box[1] - tol) * scale, (box[2] + tol) * scale, (box[3] + tol) * scale]
+        lines = []
+        prev_line = None
+        for _, _, _, _, text, line_num in self.get_words(page, box):
+            if line_num != prev_line:
+                lines.append([])
+                prev_line = line_num
+            lines[-1].append(text)
+        return "\n".join(" ".join(x) for x in lines)
 
 
 def normalize_string(string):
@@ -8,6 +8,8 @@ import xml.etree.ElementTree as ET
 import json
 import tempfile
 
+from extractor_server import ExtractorServer, ExtractorClient
+
 """
 File for section extractors. Section extractor are python objects that have 'get_sections'
 method which takes] as input a list of PDF files and outputs a dictionary of
@@ -36,12 +38,19 @@ class FigureExtractor(object):
                 remove(join(self.scratch_dir, filename))
 
     def get_sections(self, doc_list):
-        args = ["sbt", "run " +
-                ",".join(doc_list) + " -q -g " + self.scratch_dir + "/"]
-        exit_code = call(args, cwd=self.home)
-        if exit_code != 0:
-            raise ValueError("Non-zero exit status %d, call:\n%s" % (exit_code,
-                                                                    " ".join(args)))
+        # Stream the documents through a FigureExtractorServer so the JVM is only started once
+        server = ExtractorServer(self.home, ["-q", "-g", self.scratch_dir + "/"])
+        try:
+            client = ExtractorClient(server.start())
+            for filename in doc_list:
+                response = client.process(filename)
+                if "error" in response:
+                    error = response["error"]
+                    raise ValueError("Error extracting sections from %s: %s: %s" % (
+                        filename, error["className"], error.get("msg")))
+            client.close()
+        finally:
+            server.close()
         sections = {}
         for filename in listdir(self.scratch_dir):
             with open(join(self.scratch_dir, filename)) as f:
@@ -0,0 +1,50 @@
+import unittest
+from benchmark_extractor import build_report, build_stage_report, compare_to_baseline
+
+
+class TestBenchmarkReport(unittest.TestCase):
+
+    def test_build_report(self):
+        files = {"/a.pdf": "a", "/b.pdf": "b", "/c.pdf": "c"}
+        runs = [
+            (5.0, [dict(filename="/a.pdf", numPages=2, numFigures=1, timeInMillis=1000),
+                   dict(filename="/b.pdf", numPages=4, numFigures=0, timeInMillis=2000),
+                   dict(filename="/c.pdf", msg="bad", className="java.io.IOException")]),
+            (4.0, [dict(filename="/a.pdf", numPages=2, numFigures=1, timeInMillis=3000),
+                   dict(filename="/b.pdf", numPages=4, numFigures=0, timeInMillis=1000),
+                   dict(filename="/c.pdf", numPages=1, numFigures=0, timeInMillis=10)]),
+        ]
+        report = build_report(runs, files)
+        self.assertEqual(set(report["documents"].keys()), {"a", "b"})
+        self.assertEqual(set(report["errors"].keys()), {"c"})
+        self.assertEqual(report["documents"]["a"]["latency_ms"], [1000, 3000])
+        summary = report["summary"]
+        self.assertEqual(summary["num_pages"], 6)
+        self.assertEqual(summary["p50_ms"], 1750)
+        self.assertAlmostEqual(summary["pages_per_sec"], 6 / 3.5)
+        self.assertEqual([x["startup_time"] for x in report["runs"]], [2.0, 0.0])
+
+    def test_compare_to_baseline(self):
+        baseline = dict(p50_ms=100.0, p90_ms=200.0, pages_per_sec=10.0, startup_time=None)
+        summary = dict(p50_ms=105.0, p90_ms=250.0, pages_per_sec=8.0, startup_time=3.0)
+        regressions = compare_to_baseline(summary, baseline, 0.1)
+        self.assertEqual([x[0] for x in regressions], ["p90_ms", "pages_per_sec"])
+
+    def test_build_stage_report(self):
+        stats = [dict(filename="/a.pdf", stageTimings=dict(extractText=3.0, extractGraphics=10.0),
+                      pageTimings=dict(extractGraphics={"0": 4.0, "2": 6.0})),
+                 dict(filename="/b.pdf", stageTimings=dict(extractText=1.5, extractGraphics=0.5),
+                      pageTimings=dict(extractGraphics={"1": 0.5})),
+                 dict(filename="/c.pdf", msg="bad", className="java.io.IOException")]
+        stages = build_stage_report(stats)
+        self.assertEqual(set(stages.keys()), {"extractText", "extractGraphics"})
+        self.assertNotIn("pages", stages["extractText"])
+        self.assertEqual(stages["extractText"]["total_ms"], 4.5)
+        self.assertEqual(stages["extractText"]["histogram"][:4], [0, 1, 1, 0])
+        pages = stages["extractGraphics"]["pages"]
+        self.assertEqual(pages["count"], 3)
+        self.assertEqual(pages["histogram"][:5], [1, 0, 0, 2, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+import json
+import tempfile
+import threading
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import listdir
+from os.path import join
+from shutil import rmtree
+from download_from_urls import Downloader
+
+FILES = {
+    "/a.pdf": b"%PDF-1.4 " + bytes(range(256)) * 1000,
+    "/flaky.pdf": b"%PDF-1.5 " + bytes(range(255, -1, -1)) * 700,
+    "/html.pdf": b"<!DOCTYPE html><html></html>",
+}
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """ Serves `FILES` with Range support, the first request for /flaky.pdf is cut off half way through """
+
+    flaky_served = False
+    requests_seen = []
+
+    def do_GET(self):
+        RangeHandler.requests_seen.append((self.path, self.headers.get("Range")))
+        if self.path not in FILES:
+            self.send_error(404)
+            return
+        body = FILES[self.path]
+        start = 0
+        if self.headers.get("Range") is not None:
+            start = int(self.headers["Range"][len("bytes="):].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        if self.path == "/flaky.pdf" and not RangeHandler.flaky_served:
+            RangeHandler.flaky_served = True
+            self.wfile.write(body[start:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        rmtree(self.tmpdir)
+
+    def test_download(self):
+        base_url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        manifest_file = join(self.tmpdir, "manifest.json")
+        downloader = Downloader(join(self.tmpdir, "partial"), manifest_file, threads=4, per_host=2, backoff=0)
+        downloads = {name: (base_url + "/" + name + ".pdf", join(self.tmpdir, name + ".pdf"))
+                     for name in ["a", "flaky", "html", "missing"]}
+        failures = downloader.download_all(downloads)
+
+        self.assertEqual(set(failures.keys()), {"html", "missing"})
+        for name in ["a", "flaky"]:
+            with open(join(self.tmpdir, name + ".pdf"), "rb") as f:
+                self.assertEqual(f.read(), FILES["/" + name + ".pdf"])
+        # The second request for the flaky file should resume from the data written by the first
+        flaky_requests = [r for path, r in RangeHandler.requests_seen if path == "/flaky.pdf"]
+        self.assertEqual(len(flaky_requests), 2)
+        self.assertIsNone(flaky_requests[0])
+        self.assertTrue(0 < int(flaky_requests[1][len("bytes="):-1]) <= len(FILES["/flaky.pdf"]) // 2)
+        # 404s are not retried
+        self.assertEqual(len([p for p, _ in RangeHandler.requests_seen if p == "/missing.pdf"]), 1)
+
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        self.assertEqual(set(manifest.keys()), {"a", "flaky"})
+        for name, entry in manifest.items():
+            body = FILES["/" + name + ".pdf"]
+            self.assertEqual(entry["size"], len(body))
+            self.assertEqual(entry["sha256"], sha256(body).hexdigest())
+        self.assertEqual(listdir(join(self.tmpdir, "partial")), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+from os.path import dirname, isdir
+from unittest import mock
+import extractors
+
+
+class FakeServer(object):
+    """ Stands in for `ExtractorServer`, records the arguments each server was started with """
+
+    started = []
+
+    def __init__(self, extractor_home, cli_args, threads=1):
+        self.cli_args = cli_args
+        self.startup_time = 0.0
+        self.closed = False
+
+    def start(self):
+        FakeServer.started.append(self)
+        return "127.0.0.1", len(FakeServer.started)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient(object):
+    """ Stands in for `ExtractorClient`, writes a figure image if its server was started with "-m" """
+
+    def __init__(self, address):
+        self.server = FakeServer.started[address[1] - 1]
+
+    def process(self, pdf_filepath, pages=None):
+        assert not self.server.closed
+        args = self.server.cli_args
+        if "-m" in args:
+            prefix = args[args.index("-m") + 1]
+            with open(prefix + "-doc-Figure1-1.png", "w") as f:
+                f.write("png")
+        return {"stats": {"filename": pdf_filepath, "numPages": 1, "timeInMillis": 10}}
+
+    def close(self):
+        pass
+
+
+class TestPDFFigures2Server(unittest.TestCase):
+
+    def setUp(self):
+        FakeServer.started = []
+
+    @mock.patch("extractors.ExtractorClient", FakeClient)
+    @mock.patch("extractors.ExtractorServer", FakeServer)
+    def test_run_with_stats_extracting_images(self):
+        extractor = extractors.PDFFigures2Server()
+        try:
+            for _ in range(2):
+                _, stats = extractor.run_with_stats(["/docs/doc.pdf"], extract_images=True)
+                self.assertEqual([x["filename"] for x in stats], ["/docs/doc.pdf"])
+                self.assertTrue(isdir(extractor.image_dir))
+            self.assertEqual(len(FakeServer.started), 1)
+
+            # The server has to be restarted to stop writing images
+            image_dir = extractor.image_dir
+            extractor.run_with_stats(["/docs/doc.pdf"], extract_images=False)
+            self.assertEqual(len(FakeServer.started), 2)
+            self.assertNotIn("-m", FakeServer.started[-1].cli_args)
+            self.assertFalse(isdir(image_dir))
+            self.assertIsNone(extractor.image_dir)
+        finally:
+            extractor.close()
+        self.assertFalse(isdir(dirname(FakeServer.started[0].cli_args[3])))
+
+    def test_get_latency_report(self):
+        extractor = extractors.PDFFigures2Server()
+        self.assertEqual(extractor.get_latency_report(), "server startup: n/a, first document: n/a")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+import unittest
+import random
+import tempfile
+from os.path import join
+from shutil import rmtree
+import numpy as np
+from datasets.datasets import Document
+from pdffigures_utils import Figure, FigureType, Error, EvaluatedFigure, PageBitmapCache, box_overlap, \
+    compare_captions, scale_and_crop_figure, scale_figure
+from grading import FigurePairs, StreamingGrader, box_overlaps_vectorized, pair_extractions, \
+    UNION_INTERSECT_OVERLAP_THRESH
+from evaluation_store import ColumnarEvaluation, ColumnarEvaluationWriter
+
+
+def grade_document_extractions(document, extractions, compare_caption_text, crop_extractions, bitmap_cache=None):
+    """
+    Evaluates an extraction one figure at a time. This is the reference `FigurePairs` is checked against,
+    `FigurePairs` should be used to grade many documents efficiently
+
+    :param document: data/dataset.Document containing the true figures
+    :param extractions: list of utils.Figure an extractor returned
+    :param compare_caption_text: whether to grade captions by comparing the caption text as well as comparing
+        the bounding boxes of the captions
+    :param crop_extractions: whether to whitepsace crop the extractions
+    :param bitmap_cache: utils.PageBitmapCache to load page images from when cropping
+    :return: List of utils.EvaluatedFigure
+    """
+    if crop_extractions and bitmap_cache is None:
+        bitmap_cache = PageBitmapCache()
+    evaluated_figures = []
+    pages = document.pages_annotated
+    true_figures = document.figures
+    extracted_figures = []
+    for ex in extractions:
+        if ex.page in pages:
+            extracted_figures.append(ex)
+
+    for true_figure, extracted_figure in pair_extractions(true_figures, extracted_figures):
+        grayscale_images = document.gray_images
+        if crop_extractions and grayscale_images is None and document.page_bitmaps is None:
+            raise ValueError("Unable to corp extraction since grayscale image have not been built" +
+                             " for document %s" % document.doc_id)
+        if extracted_figure is None:
+            if true_figure is None:
+                raise RuntimeError()
+            error = Error.missing
+        elif extracted_figure.caption_bb is None:
+            error = Error.no_caption_found
+        elif true_figure is None:
+            if extracted_figure.region_bb is None:
+                error = Error.false_positive_no_region
+            else:
+                error = Error.false_positive
+        else:
+            # At this point we have a valid `true_figure` and an `extracted_figure` with a caption_bb
+            page = true_figure.page
+            if crop_extractions:
+                if document.page_bitmaps is not None:
+                    foreground = document.page_bitmaps[page]
+                else:
+                    foreground = bitmap_cache.get(grayscale_images[page])
+                extracted_capt_box, extracted_region_box = \
+                    scale_and_crop_figure(extracted_figure, foreground, document.dpi)
+            else:
+                extracted_capt_box, extracted_region_box = scale_figure(extracted_figure, document.dpi)
+            true_capt_box, true_region_box = scale_figure(true_figure, document.dpi)
+            caption_correct = box_overlap(extracted_capt_box, true_capt_box)[0] >= UNION_INTERSECT_OVERLAP_THRESH
+            if not caption_correct and compare_caption_text:
+                caption_correct = compare_captions(true_figure.caption, extracted_figure.caption)
+            if extracted_region_box is None:
+                if caption_correct:
+                    error = Error.right_caption_no_region
+                else:
+                    error = Error.wrong_caption_no_region
+            else:
+                region_correct = box_overlap(extracted_region_box, true_region_box)[0] >= UNION_INTERSECT_OVERLAP_THRESH
+                if not region_correct and not caption_correct:
+                    error = Error.wrong_caption_and_region
+                elif not region_correct:
+                    error = Error.wrong_region_box
+                elif not caption_correct:
+                    error = Error.wrong_caption_box
+                else:
+                    error = Error.correct
+
+        evaluated_figures.append(EvaluatedFigure(true_figure, extracted_figure, error, document.doc_id))
+
+    num_missing = sum(1 for x in evaluated_figures if x.error == Error.missing)
+
+    # Sanity check, one error per output minus the missing examples
+    if len(extracted_figures) != (len(evaluated_figures) - num_missing):
+        raise ValueError("Have %d extractions %d errors - %d missing = %d recorded" % (len(extracted_figures),
+            len(evaluated_figures), num_missing, len(evaluated_figures) - num_missing))
+    return evaluated_figures
+
+
+class TestGrading(unittest.TestCase):
+
+    def random_box(self, rng, near=None):
+        if near is not None and rng.random() < 0.7:
+            return [x + rng.uniform(-8, 8) for x in near[:2]] + [x + rng.uniform(-8, 8) for x in near[2:]]
+        x1, y1 = rng.uniform(0, 500), rng.uniform(0, 700)
+        return [x1, y1, x1 + rng.uniform(20, 300), y1 + rng.uniform(10, 200)]
+
+    def random_document(self, rng, doc_id, pdffile, foreground):
+        figures = []
+        extractions = []
+        for page in [1, 2, 3]:
+            for name in range(rng.randint(0, 4)):
+                fig_type = rng.choice([FigureType.figure, FigureType.table])
+                caption = rng.choice(["Figure 1: A caption", "Figure 2: Another"])
+                caption_bb, region_bb = self.random_box(rng), self.random_box(rng)
+                if rng.random() < 0.8:
+                    figures.append(Figure(fig_type, str(name), page, 100, caption, 792, 612, caption_bb, region_bb))
+                if rng.random() < 0.8:
+                    extracted_region = self.random_box(rng, region_bb) if rng.random() < 0.8 else None
+                    extractions.append(Figure(fig_type, str(name), page, 72, rng.choice([caption, "Table 3"]),
+                                              792, 612, [x * 0.72 for x in self.random_box(rng, caption_bb)],
+                                              None if extracted_region is None else
+                                              [x * 0.72 for x in extracted_region]))
+        # Extractions on a page that was not annotated should be ignored
+        extractions.append(Figure(FigureType.figure, "9", 4, 72, "Figure 9", 792, 612, [0, 0, 10, 10], None))
+        bitmaps = {page: foreground for page in [1, 2, 3]}
+        return Document(doc_id, [1, 2, 3], figures, pdffile, 100, page_bitmaps=bitmaps), extractions
+
+    def test_matches_scalar_grading(self):
+        rng = random.Random(0)
+        foreground = np.random.RandomState(0).rand(800, 700) < 0.001
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as pdffile:
+            for compare_caption_text in [True, False]:
+                for crop in [True, False]:
+                    pairs = FigurePairs()
+                    expected = []
+                    for i in range(30):
+                        doc, extractions = self.random_document(rng, "doc%d" % i, pdffile.name, foreground)
+                        pairs.add_document(doc, extractions, crop)
+                        expected += grade_document_extractions(doc, extractions, compare_caption_text, crop)
+                    graded = pairs.grade(compare_caption_text)
+                    self.assertEqual(len(graded), len(expected))
+                    self.assertEqual(list(graded), expected)
+                    self.assertGreater(len(set(x.error for x in expected)), 4)
+
+    def test_box_overlaps_checks_boxes(self):
+        boxes = np.array([[0, 0, 10, 10], [np.nan] * 4], dtype=np.float64)
+        overlap = box_overlaps_vectorized(boxes, np.array([[5, 0, 15, 10], [0, 0, 1, 1]], dtype=np.float64))
+        self.assertEqual(overlap[0], 50 / 150)
+        self.assertTrue(np.isnan(overlap[1]))
+        with self.assertRaises(AssertionError):
+            box_overlaps_vectorized(boxes, np.array([[10, 0, 5, 10], [0, 0, 1, 1]], dtype=np.float64))
+
+    def test_columnar_round_trip(self):
+        rng = random.Random(1)
+        foreground = np.zeros((800, 700), dtype=bool)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with tempfile.NamedTemporaryFile(suffix=".pdf") as pdffile:
+                output = join(tmpdir, "evaluation")
+                writer = ColumnarEvaluationWriter(output, "s2", 8, "test", "1", {}, True, [], 0.0)
+                expected = []
+                for part in range(3):
+                    pairs = FigurePairs()
+                    for i in range(10):
+                        doc, extractions = self.random_document(rng, "doc%d-%d" % (part, i), pdffile.name,
+                                                                foreground)
+                        pairs.add_document(doc, extractions, False)
+                    graded = pairs.grade(True)
+                    writer.append(graded)
+                    expected += list(graded)
+            evaluation = ColumnarEvaluation(output)
+            self.assertEqual(evaluation.to_evaluation().evaluated_figures, expected)
+            filtered = evaluation.to_evaluation(["doc1-3", "doc2-0"], FigureType.table).evaluated_figures
+            self.assertEqual(filtered, [x for x in expected if x.doc in {"doc1-3", "doc2-0"} and
+                                        x.figure_type == FigureType.table])
+            errors = evaluation.load_columns(["error"], figure_type=FigureType.figure)["error"]
+            self.assertEqual(list(errors), [x.error.value for x in expected if x.figure_type == FigureType.figure])
+        finally:
+            rmtree(tmpdir)
+
+    def test_streaming_grader(self):
+        rng = random.Random(2)
+        foreground = np.zeros((800, 700), dtype=bool)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with tempfile.NamedTemporaryFile(suffix=".pdf") as pdffile:
+                output = join(tmpdir, "evaluation")
+                writer = ColumnarEvaluationWriter(output, "s2", 8, "test", "1", {}, True, [], 0.0)
+                grader = StreamingGrader(True, 4, writer)
+                pairs = FigurePairs()
+                for i in range(10):
+                    doc, extractions = self.random_document(rng, "doc%d" % i, pdffile.name, foreground)
+                    doc_pairs = FigurePairs()
+                    doc_pairs.add_document(doc, extractions, False)
+                    grader.add(doc_pairs, 1)
+                    pairs.extend(doc_pairs)
+                    if i == 4:
+                        # The first batch of documents is saved before the run is finished
+                        self.assertEqual(len(ColumnarEvaluation(output).to_evaluation().evaluated_figures),
+                                         len(grader.parts[0]))
+                graded = grader.finish()
+            self.assertEqual(len(grader.parts), 3)
+            expected = list(pairs.grade(True))
+            self.assertEqual(list(graded), expected)
+            self.assertEqual(ColumnarEvaluation(output).to_evaluation().evaluated_figures, expected)
+            self.assertEqual(len(StreamingGrader(True, 4).finish()), 0)
+        finally:
+            rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import pickle
+import unittest
+import random
+import tempfile
+from os.path import getsize, join
+from shutil import rmtree
+import numpy as np
+from PIL import Image
+from pdffigures_utils import crop_to_foreground, crop_to_foreground_bitmap, Figure, FigureType, PageBitmapStore, \
+    PdfTextIndex
+
+
+class TestCropping(unittest.TestCase):
+
+    def test_bitmap_crop_matches_image_crop(self):
+        rng = random.Random(0)
+        width, height = 120, 90
+        gray = np.full((height, width), 255, dtype=np.uint8)
+        for _ in range(40):
+            x, y = rng.randrange(width), rng.randrange(height)
+            gray[y:y + rng.randrange(1, 8), x:x + rng.randrange(1, 8)] = rng.randrange(0, 256)
+        img = Image.fromarray(gray, "L")
+        bw_img = img.point(lambda x: 0 if x < 200 else 255, '1')
+        foreground = np.asarray(img) < 200
+
+        boxes = [[0, 0, width - 1, height - 1], [-10.5, -3.2, width + 4.7, height + 8.1], [5, 5, 5, 5]]
+        for _ in range(300):
+            x1, y1 = rng.uniform(-10, width), rng.uniform(-10, height)
+            boxes.append([x1, y1, x1 + rng.uniform(0, 60), y1 + rng.uniform(0, 60)])
+        for box in boxes:
+            self.assertEqual(crop_to_foreground(box, bw_img), crop_to_foreground_bitmap(box, foreground), box)
+
+
+class TestPageBitmapStore(unittest.TestCase):
+
+    def test_round_trip(self):
+        rng = np.random.RandomState(0)
+        docs = {"a": {1: rng.rand(30, 21) < 0.3, 2: rng.rand(17, 64) < 0.1},
+                "b": {3: rng.rand(9, 5) < 0.5}}
+        tmpdir = tempfile.mkdtemp()
+        try:
+            store = PageBitmapStore(join(tmpdir, "bitmaps.bin"), join(tmpdir, "bitmaps.json"))
+            for doc_id, pages in docs.items():
+                store.add_document(doc_id, pages)
+            store.save_index()
+            store = PageBitmapStore(join(tmpdir, "bitmaps.bin"), join(tmpdir, "bitmaps.json"))
+            for doc_id, pages in docs.items():
+                stored = store.get_page_bitmaps(doc_id)
+                self.assertEqual(set(stored.keys()), set(pages.keys()))
+                for page, bitmap in pages.items():
+                    packed = stored[page]
+                    self.assertEqual(packed.shape, bitmap.shape)
+                    np.testing.assert_array_equal(packed.unpack(), bitmap)
+                    np.testing.assert_array_equal(packed[2:7, 3:19], bitmap[2:7, 3:19])
+                    for _ in range(50):
+                        x1, y1 = rng.randint(-5, bitmap.shape[1]), rng.randint(-5, bitmap.shape[0])
+                        box = [x1, y1, x1 + rng.randint(0, 30), y1 + rng.randint(0, 30)]
+                        self.assertEqual(crop_to_foreground_bitmap(box, packed),
+                                         crop_to_foreground_bitmap(box, bitmap))
+            self.assertIsNone(store.get_page_bitmaps("c"))
+        finally:
+            rmtree(tmpdir)
+
+    def test_unsaved_documents_are_overwritten(self):
+        rng = np.random.RandomState(0)
+        a, b, c = rng.rand(30, 21) < 0.3, rng.rand(17, 64) < 0.1, rng.rand(9, 5) < 0.5
+        tmpdir = tempfile.mkdtemp()
+        try:
+            data_file, index_file = join(tmpdir, "bitmaps.bin"), join(tmpdir, "bitmaps.json")
+            store = PageBitmapStore(data_file, index_file, save_every=1)
+            store.add_document("a", {1: a})
+            store.save_every = 2
+            store.add_document("b", {1: b})  # Written but, like an interrupted run, never indexed
+
+            store = PageBitmapStore(data_file, index_file)
+            self.assertEqual(list(store.get_doc_ids()), ["a"])
+            store.add_document("c", {1: c})
+            store.save_index()
+            store = PageBitmapStore(data_file, index_file)
+            self.assertEqual(sorted(store.get_doc_ids()), ["a", "c"])
+            np.testing.assert_array_equal(store.get_page_bitmaps("a")[1].unpack(), a)
+            np.testing.assert_array_equal(store.get_page_bitmaps("c")[1].unpack(), c)
+            self.assertEqual(getsize(data_file), 30 * 3 + 9 * 1)
+        finally:
+            rmtree(tmpdir)
+
+
+BBOX_LAYOUT = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title></title></head>
+<body>
+<doc>
+  <page width="612.000000" height="792.000000">
+    <flow><block xMin="72" yMin="100" xMax="300" yMax="130">
+      <line xMin="72" yMin="100" xMax="300" yMax="112">
+        <word xMin="72.0" yMin="100.0" xMax="110.0" yMax="112.0">Figure</word>
+        <word xMin="114.0" yMin="100.0" xMax="122.0" yMax="112.0">1:</word>
+        <word xMin="126.0" yMin="100.0" xMax="300.0" yMax="112.0">Results&amp;more</word>
+      </line>
+      <line xMin="72" yMin="118" xMax="140" yMax="130">
+        <word xMin="72.0" yMin="118.0" xMax="140.0" yMax="130.0">second</word>
+      </line>
+    </block></flow>
+  </page>
+  <page width="612.000000" height="792.000000">
+    <flow><block><line>
+      <word xMin="400.0" yMin="700.0" xMax="420.0" yMax="710.0">Table</word>
+    </line></block></flow>
+  </page>
+</doc>
+</body>
+</html>
+"""
+
+
+class TestPdfTextIndex(unittest.TestCase):
+
+    def test_get_text(self):
+        index = PdfTextIndex.from_bbox_layout(BBOX_LAYOUT)
+        self.assertEqual(index.get_num_pages(), 2)
+        self.assertEqual(index.get_text(1, [0, 0, 612, 792], 72), "Figure 1: Results&more\nsecond")
+        self.assertEqual(index.get_text(1, [140, 196, 250, 220], 144), "Figure 1:")
+        self.assertEqual(index.get_text(1, [140, 196, 250, 220], 144, tol=30), "Figure 1:\nsecond")
+        self.assertEqual(index.get_text(1, [0, 0, 612, 90], 72), "")
+        self.assertEqual(index.get_text(2, [390, 690, 430, 720], 72), "Table")
+
+
+class TestFigure(unittest.TestCase):
+
+    def test_boxes(self):
+        fig = Figure(FigureType.figure, "1", 2, 72, "Figure 1", 792, 612, [1, 2, 30, 40], None)
+        self.assertEqual(fig.caption_bb, (1, 2, 30, 40))
+        self.assertIsInstance(fig.caption_bb[0], int)
+        self.assertIsNone(fig.region_bb)
+        with self.assertRaises(TypeError):
+            fig.caption_bb[0] = 5
+        fig.region_bb = [5, 6, 7, 8]
+        self.assertEqual(fig.region_bb, (5, 6, 7, 8))
+        self.assertEqual(pickle.loads(pickle.dumps(fig)), fig)
+
+        bulk = Figure.bulk([FigureType.figure, FigureType.table], ["1", "2"], [2, 3], [72, 72],
+                           ["Figure 1", "Table 2"], [[1, 2, 30, 40], None], [None, [5, 6, 7, 8]], [792, 792],
+                           [612, 612])
+        self.assertEqual(bulk[0], Figure(FigureType.figure, "1", 2, 72, "Figure 1", 792, 612,
+                                        [1, 2, 30, 40], None))
+        self.assertEqual(bulk[1].region_bb, (5.0, 6.0, 7.0, 8.0))
+        with self.assertRaises(TypeError):
+            bulk[1].region_bb[0] = 5
+        bulk[0].region_bb = [1, 1, 2, 2]
+        self.assertEqual(bulk[0].region_bb, (1.0, 1.0, 2.0, 2.0))
+        self.assertIsNone(bulk[1].caption_bb)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 from datasets import datasets
 import extractors
+from benchmark_extractor import build_stage_report, print_stage_report
 import argparse
 from time import time
 
@@ -11,6 +12,8 @@ def main():
     parser.add_argument("-w", "--write-figures", action="store_true")
     parser.add_argument("-r", "--compare-non-standard", action='store_true', help="Don't skip PDF in the dataset that" +
                                                                                   "are marked as being non-standard")
+    parser.add_argument("-s", "--stages", action='store_true', help="Print how long each processing stage took, " +
+                                                                    "requires an extractor that reports statistics")
     parser.add_argument("-q", "--quiet", action='store_true', help="Reduce printed output")
     args = parser.parse_args()
 
@@ -28,9 +31,14 @@ def main():
     filenames = [file_map[x] for x in doc_ids_to_use]
     extractor = extractors.get_extractor(args.extractor)
     print("Starting time extractor %s dataset %s" % (args.extractor, args.dataset))
-    t0 = time()
-    extractor.time(filenames, args.write_figures, verbose=verbose)
-    print(time() - t0)
+    if args.stages:
+        wall_time, stats = extractor.run_with_stats(filenames, args.write_figures)
+        print(wall_time)
+        print_stage_report(build_stage_report(stats))
+    else:
+        t0 = time()
+        extractor.time(filenames, args.write_figures, verbose=verbose)
+        print(time() - t0)
 
 if __name__ == "__main__":
     main()
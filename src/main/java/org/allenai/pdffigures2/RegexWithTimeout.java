@@ -23,6 +23,10 @@ final class RegexWithTimeout {
       public char charAt(int index) {
         if(System.currentTimeMillis() >= abortTime)
           throw new RegexTimeout();
+        // Also give up if the thread was interrupted, e.g. because its document timed out. The
+        // interrupted flag is left set so the caller's next interruption check sees it too
+        if(Thread.currentThread().isInterrupted())
+          throw new RegexTimeout();
 
         return inner.charAt(index);
       }
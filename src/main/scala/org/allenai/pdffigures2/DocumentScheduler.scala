@@ -0,0 +1,112 @@
+package org.allenai.pdffigures2
+
+import java.io.File
+import java.util.concurrent.atomic.AtomicReference
+import java.util.concurrent.{ Callable, ExecutionException, Executors, Future, Semaphore }
+
+import org.apache.pdfbox.pdmodel.PDDocument
+
+/** Schedules the documents of a batch. Documents can be ordered largest first, so big documents
+  * do not end up as stragglers at the end of a run, and the number of documents in flight is
+  * limited both by the number of threads and by a budget on their estimated memory use, so
+  * several large documents are not processed at once.
+  */
+object DocumentScheduler extends Logging {
+
+  /** Ways documents can be ordered, "size" and "pages" put the largest documents first */
+  val Orders = Seq("input", "size", "pages")
+
+  // Rough heap usage estimates used to admit documents against the memory budget. Rendering a
+  // page at 150 DPI takes ~8MB, and PDFBox's parsed objects take a few times the size of the file
+  val EstimatedMbPerPage = 8.0
+  val EstimatedHeapPerPdfByte = 4.0
+
+  case class ScheduledDocument(file: File, numPages: Option[Int], estimatedMb: Int)
+
+  /** @return the number of pages in `file`, or None if it could not be read */
+  def countPages(file: File): Option[Int] = {
+    var doc: PDDocument = null
+    try {
+      doc = PDDocument.load(file)
+      Some(doc.getNumberOfPages)
+    } catch {
+      case e: Exception =>
+        logger.debug(s"Unable to count pages in ${file.getName}: $e")
+        None
+    } finally {
+      if (doc != null) doc.close()
+    }
+  }
+
+  /** @return estimated megabytes of heap needed to process `file` */
+  def estimateMb(file: File, numPages: Option[Int]): Int = {
+    val fromSize = file.length() * EstimatedHeapPerPdfByte / (1024 * 1024)
+    val fromPages = numPages.map(_ * EstimatedMbPerPage).getOrElse(0.0)
+    math.max(1, math.ceil(math.max(fromSize, fromPages)).toInt)
+  }
+
+  /** Orders `files` as specified by `order`, counting pages only if ordering by pages */
+  def schedule(files: Seq[File], order: String): Seq[ScheduledDocument] = {
+    require(Orders.contains(order), s"Unknown order $order")
+    val documents = files.map { file =>
+      val numPages = if (order == "pages") countPages(file) else None
+      ScheduledDocument(file, numPages, estimateMb(file, numPages))
+    }
+    order match {
+      case "input" => documents
+      case "size" => documents.sortBy(-_.file.length())
+      case "pages" => documents.sortBy(d => (-d.numPages.getOrElse(0), -d.file.length()))
+    }
+  }
+
+  /** Runs `process` on each of `documents` in order using `threads` threads. If
+    * `memoryBudgetMb` is set, a document only starts once the estimated memory of the documents
+    * in flight plus its own fits in the budget (a document larger than the whole budget runs
+    * once it can have all of it). If `process` throws no more documents are started and the
+    * exception is rethrown.
+    *
+    * @return the results of `process`, in the same order as `documents`
+    */
+  def run[T](documents: Seq[ScheduledDocument], threads: Int, memoryBudgetMb: Option[Int])(
+    process: (ScheduledDocument, Int) => T
+  ): Seq[T] = {
+    val pool = Executors.newFixedThreadPool(threads)
+    val slots = new Semaphore(threads)
+    // Fair, so a large document waiting for memory is not overtaken by later, smaller ones
+    val memory = memoryBudgetMb.map(mb => new Semaphore(mb, true))
+    val failure = new AtomicReference[Throwable]()
+    try {
+      val futures = scala.collection.mutable.ArrayBuffer[Future[T]]()
+      val it = documents.zipWithIndex.iterator
+      while (it.hasNext && failure.get() == null) {
+        val (document, index) = it.next()
+        val permits = memoryBudgetMb.map(math.min(document.estimatedMb, _)).getOrElse(0)
+        slots.acquire()
+        memory.foreach(_.acquire(permits))
+        futures += pool.submit(new Callable[T] {
+          override def call(): T = {
+            try {
+              process(document, index)
+            } catch {
+              case e: Throwable =>
+                failure.compareAndSet(null, e)
+                throw e
+            } finally {
+              memory.foreach(_.release(permits))
+              slots.release()
+            }
+          }
+        })
+      }
+      futures.map { future =>
+        try {
+          future.get()
+        } catch {
+          case e: ExecutionException => throw e.getCause
+        }
+      }.toList
+    } finally {
+      pool.shutdownNow()
+    }
+  }
+}
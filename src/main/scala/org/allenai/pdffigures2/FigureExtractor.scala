@@ -22,30 +22,38 @@ case class FigureExtractor(
   def getFigures(
     doc: PDDocument,
     pages: Option[Seq[Int]] = None,
-    visualLogger: Option[VisualLogger] = None
+    visualLogger: Option[VisualLogger] = None,
+    timings: Option[StageTimings] = None,
+    renderer: Option[PageRenderer] = None
   ): Iterable[Figure] = {
-    parseDocument(doc, pages, visualLogger).figures
+    val pageRenderer = renderer.getOrElse(new PageRenderer(doc))
+    parseDocument(doc, pages, visualLogger, timings, pageRenderer).figures
   }
 
   def getRasterizedFigures(
     doc: PDDocument,
     dpi: Int,
     pages: Option[Seq[Int]] = None,
-    visualLogger: Option[VisualLogger] = None
+    visualLogger: Option[VisualLogger] = None,
+    timings: Option[StageTimings] = None,
+    renderer: Option[PageRenderer] = None
   ): Iterable[RasterizedFigure] = {
-    val content = parseDocument(doc, pages, visualLogger)
+    val pageRenderer = renderer.getOrElse(new PageRenderer(doc))
+    val content = parseDocument(doc, pages, visualLogger, timings, pageRenderer)
     content.pagesWithFigures.flatMap(
-      page =>
-        FigureRenderer.rasterizeFigures(doc, page, dpi, cleanRasterizedFigureRegions, visualLogger)
+      page => rasterizeFigures(doc, page, dpi, visualLogger, timings, pageRenderer)
     )
   }
 
   def getFiguresWithErrors(
     doc: PDDocument,
     pages: Option[Seq[Int]] = None,
-    visualLogger: Option[VisualLogger] = None
+    visualLogger: Option[VisualLogger] = None,
+    timings: Option[StageTimings] = None,
+    renderer: Option[PageRenderer] = None
   ): FiguresInDocument = {
-    val content = parseDocument(doc, pages, visualLogger)
+    val pageRenderer = renderer.getOrElse(new PageRenderer(doc))
+    val content = parseDocument(doc, pages, visualLogger, timings, pageRenderer)
     FiguresInDocument(content.figures, content.failedCaptions)
   }
 
@@ -53,12 +61,14 @@ case class FigureExtractor(
     doc: PDDocument,
     dpi: Int,
     pages: Option[Seq[Int]] = None,
-    visualLogger: Option[VisualLogger] = None
+    visualLogger: Option[VisualLogger] = None,
+    timings: Option[StageTimings] = None,
+    renderer: Option[PageRenderer] = None
   ): RasterizedFiguresInDocument = {
-    val content = parseDocument(doc, pages, visualLogger)
+    val pageRenderer = renderer.getOrElse(new PageRenderer(doc))
+    val content = parseDocument(doc, pages, visualLogger, timings, pageRenderer)
     val rasterizedFigures = content.pagesWithFigures.flatMap(
-      page =>
-        FigureRenderer.rasterizeFigures(doc, page, dpi, cleanRasterizedFigureRegions, visualLogger)
+      page => rasterizeFigures(doc, page, dpi, visualLogger, timings, pageRenderer)
     )
     RasterizedFiguresInDocument(rasterizedFigures, content.failedCaptions)
   }
@@ -66,34 +76,98 @@ case class FigureExtractor(
   def getFiguresWithText(
     doc: PDDocument,
     pages: Option[Seq[Int]] = None,
-    visualLogger: Option[VisualLogger] = None
+    visualLogger: Option[VisualLogger] = None,
+    timings: Option[StageTimings] = None,
+    renderer: Option[PageRenderer] = None
   ): Document = {
-    val content = parseDocument(doc, pages, visualLogger)
+    val pageRenderer = renderer.getOrElse(new PageRenderer(doc))
+    val content = parseDocument(doc, pages, visualLogger, timings, pageRenderer)
+    getDocumentFromContent(content, pages, visualLogger)
+  }
+
+  def getRasterizedFiguresWithText(
+    doc: PDDocument,
+    dpi: Int,
+    pages: Option[Seq[Int]] = None,
+    visualLogger: Option[VisualLogger] = None,
+    timings: Option[StageTimings] = None,
+    renderer: Option[PageRenderer] = None
+  ): DocumentWithRasterizedFigures = {
+    val pageRenderer = renderer.getOrElse(new PageRenderer(doc))
+    val content = parseDocument(doc, pages, visualLogger, timings, pageRenderer)
     val abstractText = getAbstract(content)
     val sections = getSections(content)
     if (visualLogger.isDefined) {
       visualLogger.get.logSections(sections, pages)
     }
-    Document(content.figures, abstractText, sections)
+    val rasterizedFigures = content.pagesWithFigures.flatMap(
+      page => rasterizeFigures(doc, page, dpi, visualLogger, timings, pageRenderer)
+    )
+    DocumentWithRasterizedFigures(rasterizedFigures, abstractText, sections)
   }
 
-  def getRasterizedFiguresWithText(
+  /** Parses `doc` and locates its figures without rasterizing them, so callers can rasterize the
+    * figures, or build the document's text, as separate steps using
+    * `getRasterizedFiguresFromContent` and `getDocumentFromContent`
+    */
+  def getDocumentContent(
+    doc: PDDocument,
+    pages: Option[Seq[Int]] = None,
+    visualLogger: Option[VisualLogger] = None,
+    timings: Option[StageTimings] = None,
+    renderer: Option[PageRenderer] = None
+  ): DocumentContent = {
+    val pageRenderer = renderer.getOrElse(new PageRenderer(doc))
+    parseDocument(doc, pages, visualLogger, timings, pageRenderer)
+  }
+
+  /** Rasterizes the figures in `content`, as returned by `getDocumentContent` for `doc` */
+  def getRasterizedFiguresFromContent(
     doc: PDDocument,
+    content: DocumentContent,
     dpi: Int,
+    visualLogger: Option[VisualLogger] = None,
+    timings: Option[StageTimings] = None,
+    renderer: Option[PageRenderer] = None
+  ): Seq[RasterizedFigure] = {
+    val pageRenderer = renderer.getOrElse(new PageRenderer(doc))
+    content.pagesWithFigures.flatMap(
+      page => rasterizeFigures(doc, page, dpi, visualLogger, timings, pageRenderer)
+    )
+  }
+
+  /** Builds the section-based `Document` for `content`, as returned by `getDocumentContent` */
+  def getDocumentFromContent(
+    content: DocumentContent,
     pages: Option[Seq[Int]] = None,
     visualLogger: Option[VisualLogger] = None
-  ): DocumentWithRasterizedFigures = {
-    val content = parseDocument(doc, pages, visualLogger)
+  ): Document = {
     val abstractText = getAbstract(content)
     val sections = getSections(content)
     if (visualLogger.isDefined) {
       visualLogger.get.logSections(sections, pages)
     }
-    val rasterizedFigures = content.pagesWithFigures.flatMap(
-      page =>
-        FigureRenderer.rasterizeFigures(doc, page, dpi, cleanRasterizedFigureRegions, visualLogger)
-    )
-    DocumentWithRasterizedFigures(rasterizedFigures, abstractText, sections)
+    Document(content.figures, abstractText, sections)
+  }
+
+  private def rasterizeFigures(
+    doc: PDDocument,
+    page: PageWithFigures,
+    dpi: Int,
+    visualLogger: Option[VisualLogger],
+    timings: Option[StageTimings],
+    renderer: PageRenderer
+  ): Seq[RasterizedFigure] = {
+    StageTimings.timePage(timings, StageTimings.RasterizeFigures, page.pageNumber) {
+      FigureRenderer.rasterizeFigures(
+        doc,
+        page,
+        dpi,
+        cleanRasterizedFigureRegions,
+        visualLogger,
+        renderer = Some(renderer)
+      )
+    }
   }
 
   private def getSections(content: DocumentContent): Seq[DocumentSection] = {
@@ -126,31 +200,48 @@ case class FigureExtractor(
     }
   }
 
-  /* Runs the full processing pipeline and returns the figures and intermediate output */
+  /* Runs the full processing pipeline and returns the figures and intermediate output. If
+   * `timings` is given, the time taken by each stage, and by each page for stages that are run per
+   * page, is recorded in it. Pages are rendered, when needed, with `renderer`. */
   private def parseDocument(
     doc: PDDocument,
     pages: Option[Seq[Int]],
-    visualLogger: Option[VisualLogger]
+    visualLogger: Option[VisualLogger],
+    timings: Option[StageTimings],
+    renderer: PageRenderer
   ): DocumentContent = {
-    val pagesWithText = TextExtractor.extractText(doc)
-    val pagesWithFormattingText = FormattingTextExtractor.extractFormattingText(pagesWithText)
-    val documentLayoutOption = DocumentLayout(pagesWithFormattingText)
+    import StageTimings.{ time, timePage }
+    val pagesWithText = time(timings, StageTimings.ExtractText) {
+      TextExtractor.extractText(doc)
+    }
+    val pagesWithFormattingText = time(timings, StageTimings.FormattingText) {
+      FormattingTextExtractor.extractFormattingText(pagesWithText)
+    }
+    val documentLayoutOption = time(timings, StageTimings.DocumentLayout) {
+      DocumentLayout(pagesWithFormattingText)
+    }
     if (documentLayoutOption.isEmpty) {
       logger.debug("Not enough information to build DocumentLayout, not detecting figures")
       DocumentContent(None, Seq(), pagesWithFormattingText)
     } else {
       val documentLayout = documentLayoutOption.get
       val rebuiltParagraphs = if (rebuildParagraphs) {
-        pagesWithFormattingText.map(p => ParagraphRebuilder.rebuildParagraphs(p, documentLayout))
+        time(timings, StageTimings.RebuildParagraphs) {
+          pagesWithFormattingText.map(p => ParagraphRebuilder.rebuildParagraphs(p, documentLayout))
+        }
       } else {
         pagesWithFormattingText
       }
       val withSections = if (detectSectionTitlesFirst) {
-        SectionTitleExtractor.stripSectionTitlesFromTextPage(rebuiltParagraphs, documentLayout)
+        time(timings, StageTimings.SectionTitles) {
+          SectionTitleExtractor.stripSectionTitlesFromTextPage(rebuiltParagraphs, documentLayout)
+        }
       } else {
         rebuiltParagraphs
       }
-      val captionStarts = CaptionDetector.findCaptions(withSections, documentLayout)
+      val captionStarts = time(timings, StageTimings.FindCaptions) {
+        CaptionDetector.findCaptions(withSections, documentLayout)
+      }
       val captionStartsFiltered = pages match {
         case Some(pagesToUse) => captionStarts.filter(c => pagesToUse.contains(c.page))
         case None => captionStarts
@@ -161,28 +252,36 @@ case class FigureExtractor(
           if (Thread.interrupted()) throw new InterruptedException()
           logger.debug(s"On page $pageNum")
           val pageText = withSections(pageNum)
-          val pageWithGraphics =
+          val pageWithGraphics = timePage(timings, StageTimings.ExtractGraphics, pageNum) {
             GraphicsExtractor.extractGraphics(
               doc,
               pageText,
               allowOcr,
               ignoreWhiteGraphics,
-              visualLogger
+              visualLogger,
+              Some(renderer)
             )
+          }
           if (visualLogger.isDefined) visualLogger.get.logExtractions(pageWithGraphics)
-          val pageWithCaptions = CaptionBuilder.buildCaptions(
-            pageCandidates,
-            pageWithGraphics,
-            documentLayout.medianLineSpacing
-          )
+          val pageWithCaptions = timePage(timings, StageTimings.BuildCaptions, pageNum) {
+            CaptionBuilder.buildCaptions(
+              pageCandidates,
+              pageWithGraphics,
+              documentLayout.medianLineSpacing
+            )
+          }
           if (visualLogger.isDefined) visualLogger.get.logPagesWithCaption(pageWithCaptions)
-          val pageWithRegions = RegionClassifier.classifyRegions(pageWithCaptions, documentLayout)
+          val pageWithRegions = timePage(timings, StageTimings.ClassifyRegions, pageNum) {
+            RegionClassifier.classifyRegions(pageWithCaptions, documentLayout)
+          }
           if (visualLogger.isDefined) visualLogger.get.logRegions(pageWithRegions)
-          val pageWithFigures = FigureDetector.locatedFigures(
-            pageWithRegions,
-            documentLayout,
-            visualLogger
-          )
+          val pageWithFigures = timePage(timings, StageTimings.LocateFigures, pageNum) {
+            FigureDetector.locatedFigures(
+              pageWithRegions,
+              documentLayout,
+              visualLogger
+            )
+          }
 
           if (visualLogger.isDefined)
             visualLogger.get.logFigures(
@@ -1,30 +1,52 @@
 package org.allenai.pdffigures2
 
 import java.io.File
-import java.util.concurrent.atomic.AtomicInteger
+import java.util.concurrent._
+import java.util.concurrent.atomic.{ AtomicInteger, AtomicReference }
 
 import ch.qos.logback.classic.{ Level, Logger }
-import org.allenai.pdffigures2.FigureExtractor.DocumentWithSavedFigures
+import org.allenai.pdffigures2.FigureExtractor.{
+  Document,
+  DocumentContent,
+  DocumentWithSavedFigures
+}
 import org.allenai.pdffigures2.JsonProtocol._
 import org.apache.pdfbox.pdmodel.PDDocument
 import org.slf4j.LoggerFactory
+import spray.json._
 
-import scala.collection.parallel.ForkJoinTaskSupport
+import scala.io.Source
 
 /** CLI tools to parse a batch of PDFs, and then save the figures, table, captions
   * or text to disk.
   */
 object FigureExtractorBatchCli extends Logging {
 
+  /** @param stageTimings milliseconds spent in each stage of processing the file, see
+    *                     `StageTimings` for the stage names
+    * @param pageTimings milliseconds spent on each (0 based) page for stages that are run per page
+    * @param failedFigures files of figures that could not be saved, these are left out of
+    *                      `numFigures` and the figure data
+    */
   case class ProcessingStatistics(
     filename: String,
     numPages: Int,
     numFigures: Int,
-    timeInMillis: Long
+    timeInMillis: Long,
+    stageTimings: Option[Map[String, Double]] = None,
+    pageTimings: Option[Map[String, Map[String, Double]]] = None,
+    failedFigures: Option[Seq[String]] = None
   )
   case class ProcessingError(filename: String, msg: Option[String], className: String)
-  implicit val processingStatisticsFormat = jsonFormat4(ProcessingStatistics.apply)
+
+  /** Thrown if a document takes longer than `timeoutPerDoc` seconds to process, when errors are
+    * ignored its class name is recorded in a `ProcessingError` instead
+    */
+  class DocumentTimeoutException(message: String = null, cause: Throwable = null)
+      extends RuntimeException(message, cause)
+  implicit val processingStatisticsFormat = jsonFormat7(ProcessingStatistics.apply)
   implicit val processingErrorFormat = jsonFormat3(ProcessingError.apply)
+  implicit val pipelineStageStatisticsFormat = jsonFormat9(PipelineStage.Statistics.apply)
 
   case class CliConfigBatch(
     inputFiles: Seq[File] = Seq(),
@@ -37,9 +59,35 @@ object FigureExtractorBatchCli extends Logging {
     debugLogging: Boolean = true,
     fullTextPrefix: Option[String] = None,
     figureImagePrefix: Option[String] = None,
-    figureFormat: String = "png"
+    figureFormat: String = "png",
+    pageManifest: Map[String, Seq[Int]] = Map(),
+    timeoutPerDoc: Option[Double] = None,
+    order: String = "size",
+    memoryBudgetMb: Option[Int] = None,
+    writerThreads: Option[Int] = None,
+    writerQueueSize: Int = 16,
+    imageWriteOptions: FigureWriter.WriteOptions = FigureWriter.WriteOptions(),
+    pipeline: Boolean = false,
+    loadThreads: Int = 1,
+    renderThreads: Int = 1,
+    stageQueueSize: Int = 2,
+    savePipelineStats: Option[String] = None
   )
 
+  /** Reads a JSON object mapping input filenames, without the ".pdf" extension, to the pages
+    * (1 based) to extract figures from and returns it with the pages switched to a 0 based index
+    */
+  def loadPageManifest(filename: String): Map[String, Seq[Int]] = {
+    val source = Source.fromFile(filename, "UTF-8")
+    val manifest =
+      try {
+        source.mkString.parseJson.convertTo[Map[String, Seq[Int]]]
+      } finally {
+        source.close()
+      }
+    manifest.map { case (name, pages) => name -> pages.map(_ - 1) }
+  }
+
   val Parser = new scopt.OptionParser[CliConfigBatch]("figure-extractor-batch") {
     head("figure-extractor-batch")
     arg[Seq[String]]("<input>") required () action { (i, c) =>
@@ -76,7 +124,23 @@ object FigureExtractorBatchCli extends Logging {
       c.copy(threads = t)
     } validate { t =>
       if (t >= 0) success else failure("Threads must be >= 0")
-    } text "Number of threads to use, 0 means using Scala's default"
+    } text "Number of threads to use, 0 means one per available processor"
+    opt[String]("order") action { (o, c) =>
+      c.copy(order = o)
+    } validate { o =>
+      if (DocumentScheduler.Orders.contains(o)) {
+        success
+      } else {
+        failure(s"Order must be one of ${DocumentScheduler.Orders.mkString(",")}")
+      }
+    } text "Order to process documents in: 'size' (default) or 'pages' for largest first, " +
+      "or 'input'. Ordering by pages requires reading every document first"
+    opt[Int]("memory-budget") action { (m, c) =>
+      c.copy(memoryBudgetMb = Some(m))
+    } validate { m =>
+      if (m > 0) success else failure("Memory budget must be > 0")
+    } text "Only start a document if the estimated memory use, in MB, of the documents being " +
+      "processed stays within this budget"
     opt[Unit]('e', "ignore-error") action { (_, c) =>
       c.copy(ignoreErrors = true)
     } text "Don't stop on errors, errors will be logged and also saved in `save-stats` if set"
@@ -108,6 +172,62 @@ object FigureExtractorBatchCli extends Logging {
         )
       }
     }
+    opt[String]('p', "page-manifest") action { (f, c) =>
+      c.copy(pageManifest = loadPageManifest(f))
+    } validate { f =>
+      if (new File(f).isFile) success else failure(s"Page manifest $f not found")
+    } text "JSON file mapping input filenames (without '.pdf') to the pages, 1 based, to " +
+      "extract figures from. Documents not in the manifest are processed in full"
+    opt[Double]("timeout-per-doc") action { (t, c) =>
+      c.copy(timeoutPerDoc = Some(t))
+    } validate { t =>
+      if (t > 0) success else failure("Timeout must be > 0")
+    } text "Stop processing a document if it takes longer than this many seconds, the document " +
+      "is then treated as an error"
+    opt[Int]("writer-threads") action { (t, c) =>
+      c.copy(writerThreads = Some(t))
+    } validate { t =>
+      if (t >= 0) success else failure("Writer threads must be >= 0")
+    } text "Number of threads encoding and writing rasterized figures (default the number of " +
+      "threads), 0 means figures are written by the thread that extracted them"
+    opt[Int]("writer-queue") action { (q, c) =>
+      c.copy(writerQueueSize = q)
+    } validate { q =>
+      if (q >= 0) success else failure("Writer queue size must be >= 0")
+    } text "Maximum number of rasterized figures waiting to be written (default 16), " +
+      "extraction pauses while the queue is full"
+    opt[Double]("image-quality") action { (q, c) =>
+      c.copy(imageWriteOptions = c.imageWriteOptions.copy(compressionQuality = Some(q.toFloat)))
+    } validate { q =>
+      if (q >= 0 && q <= 1) success else failure("Image quality must be between 0 and 1")
+    } text "ImageIO compression quality, from 0 to 1, to save figures with. For jpg lower " +
+      "means smaller and lossier, for png lower means smaller and slower to write"
+    opt[String]("image-compression-type") action { (t, c) =>
+      c.copy(imageWriteOptions = c.imageWriteOptions.copy(compressionType = Some(t)))
+    } text "ImageIO compression type to save figures with, for formats that support several"
+    opt[Unit]("pipeline") action { (_, c) =>
+      c.copy(pipeline = true)
+    } text "Process documents in a pipeline of load, parse, render and write stages, each with " +
+      "its own threads. Parsing uses `threads` threads and writing `writer-threads` (at least 1)"
+    opt[Int]("load-threads") action { (t, c) =>
+      c.copy(loadThreads = t)
+    } validate { t =>
+      if (t > 0) success else failure("Load threads must be > 0")
+    } text "Number of threads loading PDFs when using the pipeline (default 1)"
+    opt[Int]("render-threads") action { (t, c) =>
+      c.copy(renderThreads = t)
+    } validate { t =>
+      if (t > 0) success else failure("Render threads must be > 0")
+    } text "Number of threads rendering figures when using the pipeline (default 1)"
+    opt[Int]("stage-queue") action { (q, c) =>
+      c.copy(stageQueueSize = q)
+    } validate { q =>
+      if (q >= 0) success else failure("Stage queue size must be >= 0")
+    } text "Maximum number of documents waiting for each pipeline stage (default 2)"
+    opt[String]("save-pipeline-stats") action { (s, c) =>
+      c.copy(savePipelineStats = Some(s))
+    } text "Save the queue depth and utilization of each pipeline stage to the given file in " +
+      "JSON format"
     checkConfig { c =>
       val badFiles =
         c.inputFiles.find(f => !f.exists() || f.isDirectory || !f.getName.endsWith(".pdf"))
@@ -117,6 +237,8 @@ object FigureExtractorBatchCli extends Logging {
         failure(s"Can't set both save-regionless-captions and full-text")
       } else if (c.fullTextPrefix.isDefined && c.figureDataPrefix.isDefined) {
         failure(s"Can't set both full-text and figure-data-prefix")
+      } else if (c.pipeline && c.timeoutPerDoc.isDefined) {
+        failure(s"Can't set both pipeline and timeout-per-doc")
       } else {
         success
       }
@@ -145,146 +267,504 @@ object FigureExtractorBatchCli extends Logging {
     format: String,
     dpi: Int,
     figures: Seq[RasterizedFigure],
-    doc: PDDocument
+    doc: PDDocument,
+    options: FigureWriter.WriteOptions = FigureWriter.WriteOptions()
   ): Seq[SavedFigure] = {
     val filenames = getFilenames(prefix, docName, format, figures.map(_.figure))
-    FigureRenderer.saveRasterizedFigures(filenames.zip(figures), format, dpi)
+    FigureRenderer.saveRasterizedFigures(filenames.zip(figures), format, dpi, options)
   }
 
+  private def documentName(inputFile: File): String = {
+    val inputName = inputFile.getName
+    inputName.substring(0, inputName.lastIndexOf('.'))
+  }
+
+  /** Extracts figures from `inputFile` and saves the results as specified by `config`
+    *
+    * @param pages pages (0 based) to extract figures from, defaults to the pages listed in
+    *              `config.pageManifest` for this file, or all pages if the file is not listed
+    */
   def processFile(
     inputFile: File,
-    config: CliConfigBatch
+    config: CliConfigBatch,
+    pages: Option[Seq[Int]] = None
   ): Either[ProcessingError, ProcessingStatistics] = {
-    val fileStartTime = System.nanoTime()
-    var doc: PDDocument = null
-    val figureExtractor = FigureExtractor()
-    try {
-      doc = PDDocument.load(inputFile)
-      val useCairo = FigureRenderer.CairoFormat.contains(config.figureFormat)
-      val inputName = inputFile.getName
-      val truncatedName = inputName.substring(0, inputName.lastIndexOf('.'))
-      val numFigures = if (config.fullTextPrefix.isDefined) {
-        val outputFilename = s"${config.fullTextPrefix.get}$truncatedName.json"
-        val numFigures = if (config.figureImagePrefix.isDefined && !useCairo) {
-          val document = figureExtractor.getRasterizedFiguresWithText(doc, config.dpi)
-          val savedFigures = saveRasterizedFigures(
-            config.figureImagePrefix.get,
-            truncatedName,
-            config.figureFormat,
-            config.dpi,
-            document.figures,
-            doc
+    processFileDeferred(inputFile, config, pages, None) match {
+      case Left(error) => Left(error)
+      case Right(pending) => pending.await()
+    }
+  }
+
+  private def handleError(
+    inputFile: File,
+    config: CliConfigBatch,
+    e: Exception
+  ): Either[ProcessingError, Nothing] = {
+    if (config.ignoreErrors) {
+      logger.info(s"Error: $e on document ${inputFile.getName}")
+      Left(
+        ProcessingError(
+          inputFile.getAbsolutePath,
+          Option(e.getMessage),
+          e.getClass.getName
+        )
+      )
+    } else {
+      throw e
+    }
+  }
+
+  /** A processed document whose rasterized figures might still be being written by a
+    * `FigureWriter`
+    */
+  private class PendingDocument(
+    inputFile: File,
+    config: CliConfigBatch,
+    numPages: Int,
+    numFigures: Int,
+    startTime: Long,
+    endTime: Long,
+    stageTimings: StageTimings,
+    writes: Seq[Future[Long]],
+    failedFigures: Seq[String]
+  ) {
+
+    /** Waits for the figures to be written, the document is finished once its last figure is */
+    def await(): Either[ProcessingError, ProcessingStatistics] = {
+      try {
+        val timeTaken = (endTime +: writes.map(_.get())).max - startTime
+        logger.info(s"Finished ${inputFile.getName} in ${(timeTaken / 1000000) / 1000.0} seconds")
+        Right(
+          ProcessingStatistics(
+            inputFile.getAbsolutePath,
+            numPages,
+            numFigures,
+            timeTaken / 1000000,
+            Some(stageTimings.stageMillis),
+            Some(stageTimings.pageMillis),
+            if (failedFigures.isEmpty) None else Some(failedFigures)
           )
-          val documentWithFigures =
-            DocumentWithSavedFigures(savedFigures, document.abstractText, document.sections)
-          FigureRenderer.saveAsJSON(outputFilename, documentWithFigures)
-          document.figures.size
-        } else {
-          val document = figureExtractor.getFiguresWithText(doc)
-          if (useCairo) {
-            val filenames = getFilenames(
-              config.figureImagePrefix.get,
-              truncatedName,
-              config.figureFormat,
-              document.figures
-            )
-            val savedFigures = FigureRenderer
-              .saveFiguresAsImagesCairo(
-                doc,
-                filenames.zip(document.figures),
-                config.figureFormat,
-                config.dpi
-              )
-              .toSeq
-            val savedDocument =
-              DocumentWithSavedFigures(savedFigures, document.abstractText, document.sections)
-            FigureRenderer.saveAsJSON(outputFilename, savedDocument)
-          } else {
-            FigureRenderer.saveAsJSON(outputFilename, document)
+        )
+      } catch {
+        case e: ExecutionException =>
+          e.getCause match {
+            case cause: Exception => handleError(inputFile, config, cause)
+            case cause => throw cause
           }
-          document.figures.size
+      }
+    }
+  }
+
+  /** A document going through the steps of being processed: loading the PDF, parsing it to
+    * locate the figures, rendering the figures and saving the results. `processFile` runs the
+    * steps one after the other, `run` can instead run each step as a stage of a pipeline. The
+    * PDF is closed once the figures are rendered, or by `close` if a step fails.
+    */
+  private class DocumentJob(
+    inputFile: File,
+    config: CliConfigBatch,
+    pages: Option[Seq[Int]]
+  ) {
+    private val stageTimings = new StageTimings()
+    private val timings = Some(stageTimings)
+    private val figureExtractor = FigureExtractor()
+    private val truncatedName = documentName(inputFile)
+    private val pagesToUse = pages.orElse(config.pageManifest.get(truncatedName))
+    private val useCairo = config.figureImagePrefix.isDefined &&
+      FigureRenderer.CairoFormat.contains(config.figureFormat)
+    private val rasterize = config.figureImagePrefix.isDefined && !useCairo
+
+    private var doc: PDDocument = null
+    private var renderer: PageRenderer = null
+    private var content: DocumentContent = null
+    private var numPages = 0
+    private var figures: Seq[Figure] = Seq()
+    private var failedCaptions: Seq[Caption] = Seq()
+    private var document: Option[Document] = None
+    private var rasterizedFigures: Seq[RasterizedFigure] = Seq()
+    private var cairoFigures: Seq[SavedFigure] = Seq()
+    private var failedFigures: Seq[String] = Seq()
+    // Set when loading starts rather than when the job is built, so time spent waiting for a
+    // thread or for memory before loading is not counted
+    private var startTime = 0L
+
+    def load(): Unit = {
+      startTime = System.nanoTime()
+      doc = stageTimings.time(StageTimings.LoadDocument) { PDDocument.load(inputFile) }
+      numPages = doc.getNumberOfPages
+    }
+
+    def parse(): Unit = {
+      renderer = new PageRenderer(doc)
+      content = figureExtractor.getDocumentContent(
+        doc,
+        pagesToUse,
+        timings = timings,
+        renderer = Some(renderer)
+      )
+      figures = content.figures
+      failedCaptions = content.failedCaptions
+      if (config.fullTextPrefix.isDefined) {
+        document = Some(figureExtractor.getDocumentFromContent(content, pagesToUse))
+      }
+    }
+
+    /** Rasterizes the figures, or saves them with pdftocairo, and closes the PDF */
+    def render(): Unit = {
+      if (rasterize) {
+        rasterizedFigures = figureExtractor.getRasterizedFiguresFromContent(
+          doc,
+          content,
+          config.dpi,
+          timings = timings,
+          renderer = Some(renderer)
+        )
+      } else if (useCairo) {
+        val filenames =
+          getFilenames(config.figureImagePrefix.get, truncatedName, config.figureFormat, figures)
+        cairoFigures = stageTimings.time(StageTimings.SaveFigures) {
+          FigureRenderer
+            .saveFiguresAsImagesCairo(doc, filenames.zip(figures), config.figureFormat, config.dpi)
+            .toSeq
         }
-        numFigures
-      } else {
-        val (figures, failedCaptions) = if (config.figureImagePrefix.isDefined && !useCairo) {
-          val figuresWithErrors = figureExtractor.getRasterizedFiguresWithErrors(doc, config.dpi)
-          val savedFigures = saveRasterizedFigures(
-            config.figureImagePrefix.get,
-            truncatedName,
-            config.figureFormat,
-            config.dpi,
-            figuresWithErrors.figures,
-            doc
-          )
-          (Left(savedFigures), figuresWithErrors.failedCaptions)
-        } else {
-          val figuresWithErrors = figureExtractor.getFiguresWithErrors(doc)
-          if (useCairo) {
-            val filenames = getFilenames(
-              config.figureImagePrefix.get,
-              truncatedName,
-              config.figureFormat,
-              figuresWithErrors.figures
-            )
-            val savedFigures = FigureRenderer
-              .saveFiguresAsImagesCairo(
-                doc,
-                filenames.zip(figuresWithErrors.figures),
+        val savedFilenames = cairoFigures.map(_.renderURL).toSet
+        failedFigures = filenames.filterNot(savedFilenames.contains)
+      }
+      content = null
+      renderer = null
+      close()
+    }
+
+    /** Saves the rasterized figures and the JSON output. If `writer` is set the figures are handed
+      * to `writer`, and might still be being written when this returns
+      */
+    def write(writer: Option[FigureWriter]): PendingDocument = {
+      val writes = scala.collection.mutable.ArrayBuffer[Future[Long]]()
+      val savedFigures = if (rasterize) {
+        val filenames = getFilenames(
+          config.figureImagePrefix.get,
+          truncatedName,
+          config.figureFormat,
+          rasterizedFigures.map(_.figure)
+        )
+        val saved = stageTimings.time(StageTimings.SaveFigures) {
+          writer match {
+            case Some(figureWriter) =>
+              filenames.zip(rasterizedFigures).map {
+                case (filename, figure) =>
+                  val image = figure.bufferedImage
+                  val file = new File(filename)
+                  writes += figureWriter.write(image, config.figureFormat, file, timings)
+                  SavedFigure(figure, filename)
+              }
+            case None =>
+              FigureRenderer.saveRasterizedFigures(
+                filenames.zip(rasterizedFigures),
                 config.figureFormat,
-                config.dpi
+                config.dpi,
+                config.imageWriteOptions
               )
-              .toSeq
-            (Left(savedFigures), figuresWithErrors.failedCaptions)
-          } else {
-            (Right(figuresWithErrors.figures), figuresWithErrors.failedCaptions)
           }
         }
+        rasterizedFigures = Seq()
+        Some(saved)
+      } else if (useCairo) {
+        Some(cairoFigures)
+      } else {
+        None
+      }
+
+      val numFigures = if (config.fullTextPrefix.isDefined) {
+        val outputFilename = s"${config.fullTextPrefix.get}$truncatedName.json"
+        val withText = document.get
+        savedFigures match {
+          case Some(saved) =>
+            val documentWithFigures =
+              DocumentWithSavedFigures(saved, withText.abstractText, withText.sections)
+            FigureRenderer.saveAsJSON(outputFilename, documentWithFigures)
+          case None => FigureRenderer.saveAsJSON(outputFilename, withText)
+        }
+        figures.size
+      } else {
+        val toSave: Either[Seq[SavedFigure], Seq[Figure]] = savedFigures match {
+          case Some(saved) => Left(saved)
+          case None => Right(figures)
+        }
         if (config.figureDataPrefix.isDefined) {
           val outputFilename = s"${config.figureDataPrefix.get}$truncatedName.json"
           if (config.saveRegionlessCaptions) {
-            val toSave: Map[String, Either[Either[Seq[SavedFigure], Seq[Figure]], Seq[Caption]]] =
+            val data: Map[String, Either[Either[Seq[SavedFigure], Seq[Figure]], Seq[Caption]]] =
               Map(
-                "figures" -> Left(figures),
+                "figures" -> Left(toSave),
                 "regionless-captions" -> Right(failedCaptions)
               )
-            FigureRenderer.saveAsJSON(outputFilename, toSave)
+            FigureRenderer.saveAsJSON(outputFilename, data)
           } else {
-            val toSave: Either[Seq[SavedFigure], Seq[Figure]] = figures
             FigureRenderer.saveAsJSON(outputFilename, toSave)
           }
         }
-        figures match {
-          case Left(savedFigures) => savedFigures.size
-          case Right(figs) => figs.size
-        }
+        savedFigures.map(_.size).getOrElse(figures.size)
       }
-      val timeTaken = System.nanoTime() - fileStartTime
-      logger.info(s"Finished ${inputFile.getName} in ${(timeTaken / 1000000) / 1000.0} seconds")
-      Right(
-        ProcessingStatistics(
-          inputFile.getAbsolutePath,
-          doc.getNumberOfPages,
-          numFigures,
-          timeTaken / 1000000
-        )
+      new PendingDocument(
+        inputFile,
+        config,
+        numPages,
+        numFigures,
+        startTime,
+        System.nanoTime(),
+        stageTimings,
+        writes,
+        failedFigures
       )
+    }
+
+    def close(): Unit = {
+      if (doc != null) doc.close()
+      doc = null
+    }
+  }
+
+  /** As `processFile`, but if `writer` is set rasterized figures are handed to `writer` and the
+    * returned document has to be waited on for them to be written
+    */
+  private def processFileDeferred(
+    inputFile: File,
+    config: CliConfigBatch,
+    pages: Option[Seq[Int]],
+    writer: Option[FigureWriter]
+  ): Either[ProcessingError, PendingDocument] = {
+    val job = new DocumentJob(inputFile, config, pages)
+    try {
+      job.load()
+      job.parse()
+      job.render()
+      Right(job.write(writer))
+    } catch {
+      case e: Exception => handleError(inputFile, config, e)
+    } finally {
+      job.close()
+    }
+  }
+
+  /** Runs `processFile` on a thread from `executor` and waits at most `config.timeoutPerDoc`
+    * seconds for it to finish. If it does not, the thread is interrupted so it stops at the next
+    * interruption check and is returned to `executor`, and the document is reported as a
+    * `DocumentTimeoutException`. This only returns once the document has stopped being
+    * processed, so callers keep its thread and memory reserved until then.
+    */
+  def processFileWithTimeout(
+    inputFile: File,
+    config: CliConfigBatch,
+    executor: ExecutorService,
+    pages: Option[Seq[Int]] = None
+  ): Either[ProcessingError, ProcessingStatistics] =
+    withTimeout(inputFile, config, executor)(processFile(inputFile, config, pages))
+
+  private def withTimeout[T](inputFile: File, config: CliConfigBatch, executor: ExecutorService)(
+    fn: => Either[ProcessingError, T]
+  ): Either[ProcessingError, T] = {
+    val timeout = config.timeoutPerDoc.get
+    // 0 until the task starts, then 1 once it is running, or 2 if it timed out before starting
+    val state = new AtomicInteger(0)
+    val finished = new CountDownLatch(1)
+    val future = executor.submit(new Callable[Either[ProcessingError, T]] {
+      override def call(): Either[ProcessingError, T] = {
+        if (!state.compareAndSet(0, 1)) throw new CancellationException()
+        try fn
+        finally finished.countDown()
+      }
+    })
+    try {
+      future.get((timeout * 1000).toLong, TimeUnit.MILLISECONDS)
     } catch {
-      case e: Exception =>
+      case _: TimeoutException =>
+        future.cancel(true)
+        if (!state.compareAndSet(0, 2) && finished.getCount > 0) {
+          logger.info(s"Waiting for ${inputFile.getName} to stop after timing out")
+          finished.await()
+        }
+        val msg = s"Timed out after $timeout seconds"
         if (config.ignoreErrors) {
-          logger.info(s"Error: $e on document ${inputFile.getName}")
+          logger.info(s"Error: $msg on document ${inputFile.getName}")
           Left(
             ProcessingError(
               inputFile.getAbsolutePath,
-              Option(e.getMessage),
-              e.getClass.getName
+              Some(msg),
+              classOf[DocumentTimeoutException].getName
             )
           )
         } else {
-          throw e
+          throw new DocumentTimeoutException(s"${inputFile.getName}: $msg")
         }
+      case e: ExecutionException => throw e.getCause
+    }
+  }
+
+  /** Executor used to run documents under `timeoutPerDoc` from at most `threads` threads at
+    * once. Its threads are daemons so a document that ignores being interrupted can not keep the
+    * JVM alive
+    */
+  def buildTimeoutExecutor(threads: Int): ExecutorService = {
+    Executors.newFixedThreadPool(threads, new ThreadFactory {
+      private val defaultFactory = Executors.defaultThreadFactory()
+      override def newThread(r: Runnable): Thread = {
+        val thread = defaultFactory.newThread(r)
+        thread.setDaemon(true)
+        thread
+      }
+    })
+  }
+
+  /** Processes each document on one of `config.threads` threads, see `DocumentScheduler` */
+  private def runDocuments(
+    config: CliConfigBatch,
+    documents: Seq[DocumentScheduler.ScheduledDocument]
+  ): Seq[Either[ProcessingError, ProcessingStatistics]] = {
+    val threads =
+      if (config.threads == 0) Runtime.getRuntime.availableProcessors() else config.threads
+    val timeoutExecutor = config.timeoutPerDoc.map(_ => buildTimeoutExecutor(threads))
+    val savesRasterizedFigures = config.figureImagePrefix.isDefined &&
+      !FigureRenderer.CairoFormat.contains(config.figureFormat)
+    val writerThreads = config.writerThreads.getOrElse(threads)
+    val writer = if (savesRasterizedFigures && writerThreads > 0) {
+      Some(new FigureWriter(writerThreads, config.writerQueueSize, config.imageWriteOptions))
+    } else {
+      None
+    }
+    def process(inputFile: File) = {
+      timeoutExecutor match {
+        case Some(executor) =>
+          withTimeout(inputFile, config, executor) {
+            processFileDeferred(inputFile, config, None, writer)
+          }
+        case None => processFileDeferred(inputFile, config, None, writer)
+      }
+    }
+    val onPdf = new AtomicInteger(0)
+    val results =
+      try {
+        val processed = DocumentScheduler.run(documents, threads, config.memoryBudgetMb) {
+          case (document, _) =>
+            val curPdf = onPdf.incrementAndGet()
+            logger.info(
+              s"Processing file ${document.file.getName} " +
+                s"($curPdf of ${config.inputFiles.size}, ~${document.estimatedMb}MB)"
+            )
+            process(document.file)
+        }
+        // Workers move on to the next document while figures are written, so documents are only
+        // reported, and failed writes only turn into errors, once every document is processed
+        processed.map {
+          case Left(error) => Left(error)
+          case Right(pending) => pending.await()
+        }
+      } finally {
+        writer.foreach(_.close())
+      }
+    timeoutExecutor.foreach(_.shutdownNow())
+    results
+  }
+
+  /** Processes the documents on a pipeline of stages, each with its own threads: loading PDFs,
+    * parsing them (using `config.threads` threads), rendering figures and saving the results
+    * (using `config.writerThreads` threads, by default as many as parsing). At most
+    * `config.stageQueueSize` documents wait between two stages, so a stage that falls behind
+    * holds back the stages before it, and a document only starts loading once it fits in
+    * `config.memoryBudgetMb`. The utilization and queue depth of each stage are logged at the
+    * end, and saved to `config.savePipelineStats`.
+    */
+  private def runPipeline(
+    config: CliConfigBatch,
+    documents: Seq[DocumentScheduler.ScheduledDocument]
+  ): Seq[Either[ProcessingError, ProcessingStatistics]] = {
+    val parseThreads =
+      if (config.threads == 0) Runtime.getRuntime.availableProcessors() else config.threads
+    val writeThreads = math.max(config.writerThreads.getOrElse(parseThreads), 1)
+    val load = new PipelineStage("load", config.loadThreads, config.stageQueueSize)
+    val parse = new PipelineStage("parse", parseThreads, config.stageQueueSize)
+    val render = new PipelineStage("render", config.renderThreads, config.stageQueueSize)
+    val write = new PipelineStage("write", writeThreads, config.stageQueueSize)
+    val stages = Seq(load, parse, render, write)
+
+    val results = new Array[Either[ProcessingError, ProcessingStatistics]](documents.size)
+    val remaining = new CountDownLatch(documents.size)
+    val failure = new AtomicReference[Throwable]()
+    // Fair, so a large document waiting for memory is not overtaken by later, smaller ones
+    val memory = config.memoryBudgetMb.map(mb => new Semaphore(mb, true))
+    try {
+      documents.zipWithIndex.foreach {
+        case (document, index) =>
+          if (failure.get() != null) {
+            remaining.countDown() // Stop starting documents once one has failed
+          } else {
+            val permits = config.memoryBudgetMb.map(math.min(document.estimatedMb, _)).getOrElse(0)
+            memory.foreach(_.acquire(permits))
+            val job = new DocumentJob(document.file, config, None)
+            def finish(result: Either[ProcessingError, ProcessingStatistics]): Unit = {
+              results(index) = result
+              memory.foreach(_.release(permits))
+              remaining.countDown()
+            }
+            // Runs `fn` on `stage`, `fn` returns how to hand the document to the next stage, which
+            // is done outside the stage's busy time
+            def step(stage: PipelineStage)(fn: => (() => Unit)): Unit = stage.submitThen {
+              try {
+                fn
+              } catch {
+                case e: Exception if config.ignoreErrors =>
+                  job.close()
+                  finish(handleError(document.file, config, e))
+                  PipelineStage.Done
+                case e: Throwable =>
+                  job.close()
+                  failure.compareAndSet(null, e)
+                  finish(null)
+                  PipelineStage.Done
+              }
+            }
+            step(load) {
+              logger.info(
+                s"Processing file ${document.file.getName} " +
+                  s"(${index + 1} of ${documents.size}, ~${document.estimatedMb}MB)"
+              )
+              job.load()
+              () =>
+                step(parse) {
+                  job.parse()
+                  () =>
+                    step(render) {
+                      job.render()
+                      () =>
+                        step(write) {
+                          finish(job.write(None).await())
+                          PipelineStage.Done
+                        }
+                    }
+                }
+            }
+          }
+      }
+      remaining.await()
+      stages.foreach(_.close())
     } finally {
-      if (doc != null) doc.close()
+      stages.foreach(_.shutdownNow())
+    }
+    if (failure.get() != null) throw failure.get()
+
+    val statistics = stages.map(_.statistics)
+    statistics.foreach { stage =>
+      logger.info(
+        f"Stage ${stage.name}: ${stage.threads} threads, ${stage.tasks} documents, " +
+          f"${stage.utilization * 100}%.1f%% utilization, mean queue depth " +
+          f"${stage.meanQueueDepth}%.2f (max ${stage.maxQueueDepth}), blocked on a full " +
+          f"queue for ${stage.blockedMillis / 1000.0}%.1f seconds"
+      )
+    }
+    if (config.savePipelineStats.isDefined) {
+      FigureRenderer.saveAsJSON(config.savePipelineStats.get, statistics)
+      logger.info(s"Pipeline stats saved to ${config.savePipelineStats.get}")
     }
+    results.toList
   }
 
   def run(config: CliConfigBatch): Unit = {
@@ -293,32 +773,9 @@ object FigureExtractorBatchCli extends Logging {
       val root = LoggerFactory.getLogger("root").asInstanceOf[Logger]
       root.setLevel(Level.INFO)
     }
-    val results = if (config.threads == 1) {
-      config.inputFiles.zipWithIndex.map {
-        case (inputFile, fileNum) =>
-          logger.info(
-            s"Processing file ${inputFile.getName} " +
-              s"(${fileNum + 1} of ${config.inputFiles.size})"
-          )
-          processFile(inputFile, config)
-      }
-    } else {
-      val parFiles = config.inputFiles.par
-      if (config.threads != 0) {
-        parFiles.tasksupport = new ForkJoinTaskSupport(
-          new scala.concurrent.forkjoin.ForkJoinPool(config.threads)
-        )
-      }
-      val onPdf = new AtomicInteger(0)
-      parFiles.map { inputFile =>
-        val curPdf = onPdf.incrementAndGet();
-        logger.info(
-          s"Processing file ${inputFile.getName} " +
-            s"($curPdf of ${config.inputFiles.size})"
-        )
-        processFile(inputFile, config)
-      }.toList
-    }
+    val documents = DocumentScheduler.schedule(config.inputFiles, config.order)
+    val results =
+      if (config.pipeline) runPipeline(config, documents) else runDocuments(config, documents)
     val totalTime = System.nanoTime() - startTime
     logger.info(s"Finished processing ${config.inputFiles.size} files")
     logger.info(s"Took ${(totalTime / 1000000) / 1000.0} seconds")
@@ -0,0 +1,223 @@
+package org.allenai.pdffigures2
+
+import java.io._
+import java.net.{ InetAddress, ServerSocket, Socket }
+import java.nio.charset.StandardCharsets
+import java.nio.file.{ Files, StandardCopyOption }
+import java.util.concurrent.{ ExecutorService, Executors }
+
+import ch.qos.logback.classic.{ Level, Logger }
+import org.allenai.pdffigures2.FigureExtractorBatchCli.{
+  processingErrorFormat,
+  processingStatisticsFormat,
+  CliConfigBatch,
+  ProcessingError,
+  ProcessingStatistics
+}
+import org.allenai.pdffigures2.JsonProtocol._
+import org.slf4j.LoggerFactory
+import spray.json._
+
+/** Long running version of FigureExtractorBatchCli. PDFs are submitted over a local socket so the
+  * JVM start up and JIT warm up costs are paid once, instead of once per batch of PDFs.
+  *
+  * The protocol is line based. Clients send one JSON object per line of the form
+  * `{"input": "/path/to/file.pdf"}`, optionally with a "pages" list of the (1 based) pages to
+  * extract figures from, and get back one JSON object per line containing `input` and
+  * either the `stats` or the `error` that `FigureExtractorBatchCli.processFile` returned for that
+  * file. Output is saved to disk using the prefixes the server was started with.
+  */
+object FigureExtractorServer extends Logging {
+
+  case class ServerRequest(input: String, pages: Option[Seq[Int]])
+  case class ServerResponse(
+    input: String,
+    stats: Option[ProcessingStatistics],
+    error: Option[ProcessingError]
+  )
+  implicit val serverRequestFormat = jsonFormat2(ServerRequest.apply)
+  implicit val serverResponseFormat = jsonFormat3(ServerResponse.apply)
+
+  case class CliConfigServer(
+    port: Int = 0,
+    portFile: Option[String] = None,
+    threads: Int = 1,
+    batchConfig: CliConfigBatch = CliConfigBatch(ignoreErrors = true)
+  )
+
+  val Parser = new scopt.OptionParser[CliConfigServer]("figure-extractor-server") {
+    head("figure-extractor-server")
+    opt[Int]('p', "port") action { (p, c) =>
+      c.copy(port = p)
+    } validate { p =>
+      if (p >= 0) success else failure("Port must be >= 0")
+    } text "Port to listen on, 0 (the default) picks a free port"
+    opt[String]("port-file") action { (f, c) =>
+      c.copy(portFile = Some(f))
+    } text "Write the port the server is listening on to this file once it is ready"
+    opt[Int]('t', "threads") action { (t, c) =>
+      c.copy(threads = t)
+    } validate { t =>
+      if (t >= 0) success else failure("Threads must be >= 0")
+    } text "Number of connections to serve in parallel, 0 means one per available processor"
+    opt[Int]('i', "dpi") action { (dpi, c) =>
+      c.copy(batchConfig = c.batchConfig.copy(dpi = dpi))
+    } validate { dpi =>
+      if (dpi > 0) success else failure("DPI must > 0")
+    } text "DPI to save the figures in (default 150)"
+    opt[Unit]('q', "quiet") action { (_, c) =>
+      c.copy(batchConfig = c.batchConfig.copy(debugLogging = false))
+    } text "Switches logging to INFO level"
+    opt[String]('d', "figure-data-prefix") action { (o, c) =>
+      c.copy(batchConfig = c.batchConfig.copy(figureDataPrefix = Some(o)))
+    } text "Save JSON figure data to '<data-prefix><input_filename>.json'"
+    opt[Unit]('c', "save-regionless-captions") action { (_, c) =>
+      c.copy(batchConfig = c.batchConfig.copy(saveRegionlessCaptions = true))
+    } text "Include captions for which no figure regions were found in the JSON data"
+    opt[String]('g', "full-text-prefix") action { (f, c) =>
+      c.copy(batchConfig = c.batchConfig.copy(fullTextPrefix = Some(f)))
+    } text "Save the document and figures into '<full-text-prefix><input_filename>.json"
+    opt[String]('m', "figure-prefix") action { (f, c) =>
+      c.copy(batchConfig = c.batchConfig.copy(figureImagePrefix = Some(f)))
+    } text "Save figures as <figure-prefix><input_filename>-<Table|Figure><Name>-<id>.png"
+    opt[String]('f', "figure-format") action { (f, c) =>
+      c.copy(batchConfig = c.batchConfig.copy(figureFormat = f))
+    } text "Format to save figures (default png)" validate { x =>
+      if (FigureRenderer.AllowedFormats.contains(x)) {
+        success
+      } else {
+        failure(
+          s"$x not supported (allowed " +
+            s"formats: ${FigureRenderer.AllowedFormats.mkString(",")}"
+        )
+      }
+    }
+    opt[Double]("timeout-per-doc") action { (t, c) =>
+      c.copy(batchConfig = c.batchConfig.copy(timeoutPerDoc = Some(t)))
+    } validate { t =>
+      if (t > 0) success else failure("Timeout must be > 0")
+    } text "Stop processing a document if it takes longer than this many seconds"
+    checkConfig { c =>
+      val batchConfig = c.batchConfig
+      if (batchConfig.saveRegionlessCaptions && batchConfig.fullTextPrefix.isDefined) {
+        failure(s"Can't set both save-regionless-captions and full-text")
+      } else if (batchConfig.fullTextPrefix.isDefined && batchConfig.figureDataPrefix.isDefined) {
+        failure(s"Can't set both full-text and figure-data-prefix")
+      } else {
+        success
+      }
+    }
+  }
+
+  /** Processes the PDF named in a single request line, under `config.timeoutPerDoc` using
+    * `timeoutExecutor` if it is set
+    */
+  def handleRequest(
+    line: String,
+    config: CliConfigBatch,
+    timeoutExecutor: Option[ExecutorService] = None
+  ): ServerResponse = {
+    try {
+      val request = line.parseJson.convertTo[ServerRequest]
+      val inputFile = new File(request.input)
+      if (!inputFile.isFile) {
+        val error = ProcessingError(
+          request.input,
+          Some("File not found"),
+          classOf[FileNotFoundException].getName
+        )
+        ServerResponse(request.input, None, Some(error))
+      } else {
+        val pages = request.pages.map(_.map(_ - 1)) // Switch to 0 based index
+        val result = timeoutExecutor match {
+          case Some(executor) =>
+            FigureExtractorBatchCli.processFileWithTimeout(inputFile, config, executor, pages)
+          case None => FigureExtractorBatchCli.processFile(inputFile, config, pages)
+        }
+        result match {
+          case Right(stats) => ServerResponse(request.input, Some(stats), None)
+          case Left(error) => ServerResponse(request.input, None, Some(error))
+        }
+      }
+    } catch {
+      case e: Exception =>
+        val error = ProcessingError(line, Option(e.getMessage), e.getClass.getName)
+        ServerResponse(line, None, Some(error))
+    }
+  }
+
+  private def handleConnection(
+    socket: Socket,
+    config: CliConfigBatch,
+    timeoutExecutor: Option[ExecutorService]
+  ): Unit = {
+    try {
+      val reader = new BufferedReader(
+        new InputStreamReader(socket.getInputStream, StandardCharsets.UTF_8)
+      )
+      val writer = new BufferedWriter(
+        new OutputStreamWriter(socket.getOutputStream, StandardCharsets.UTF_8)
+      )
+      var line = reader.readLine()
+      while (line != null) {
+        if (line.trim.nonEmpty) {
+          writer.write(handleRequest(line, config, timeoutExecutor).toJson.compactPrint)
+          writer.newLine()
+          writer.flush()
+        }
+        line = reader.readLine()
+      }
+    } catch {
+      case e: IOException => logger.info(s"Connection closed: $e")
+    } finally {
+      socket.close()
+    }
+  }
+
+  /* Write the port atomically so clients polling for the file never read a partial write */
+  private def writePortFile(portFile: String, port: Int): Unit = {
+    val target = new File(portFile).getAbsoluteFile
+    val tmp = File.createTempFile("port", ".tmp", target.getParentFile)
+    val writer = new PrintWriter(tmp)
+    writer.write(port.toString)
+    writer.close()
+    Files.move(tmp.toPath, target.toPath, StandardCopyOption.ATOMIC_MOVE)
+  }
+
+  def run(config: CliConfigServer): Unit = {
+    if (!config.batchConfig.debugLogging) {
+      val root = LoggerFactory.getLogger("root").asInstanceOf[Logger]
+      root.setLevel(Level.INFO)
+    }
+    val threads =
+      if (config.threads == 0) Runtime.getRuntime.availableProcessors() else config.threads
+    val pool = Executors.newFixedThreadPool(threads)
+    val timeoutExecutor = config.batchConfig.timeoutPerDoc.map { _ =>
+      FigureExtractorBatchCli.buildTimeoutExecutor(threads)
+    }
+    val serverSocket = new ServerSocket(config.port, 50, InetAddress.getLoopbackAddress)
+    try {
+      val port = serverSocket.getLocalPort
+      logger.info(s"Listening on port $port with $threads threads")
+      if (config.portFile.isDefined) writePortFile(config.portFile.get, port)
+      while (true) {
+        val socket = serverSocket.accept()
+        pool.submit(new Runnable {
+          override def run(): Unit =
+            handleConnection(socket, config.batchConfig, timeoutExecutor)
+        })
+      }
+    } finally {
+      pool.shutdownNow()
+      timeoutExecutor.foreach(_.shutdownNow())
+      serverSocket.close()
+    }
+  }
+
+  def main(args: Array[String]): Unit = {
+    Parser.parse(args, CliConfigServer()) match {
+      case Some(config) => run(config)
+      case None => System.exit(1)
+    }
+  }
+}
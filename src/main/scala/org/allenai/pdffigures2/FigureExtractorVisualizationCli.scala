@@ -85,6 +85,8 @@ object FigureExtractorVisualizationCli extends Logging {
     )
     val doc = PDDocument.load(inputFile)
     logger.info(s"Loading ${inputFile.getName}")
+    // Shared so pages rendered while extracting figures are not rendered again for display
+    val renderer = Some(new PageRenderer(doc))
 
     logger.info(s"Extracting figures from ${inputFile.getName}")
     // Logs all the extraction steps to `vLogger`
@@ -95,11 +97,12 @@ object FigureExtractorVisualizationCli extends Logging {
             doc,
             config.displayDpi,
             pages,
-            Some(vLogger)
+            Some(vLogger),
+            renderer = renderer
           )
           .figures
       } else {
-        FigureExtractor().getFiguresWithText(doc, pages, Some(vLogger)).figures
+        FigureExtractor().getFiguresWithText(doc, pages, Some(vLogger), renderer = renderer).figures
       }
     } else {
       if (config.showCleanedFigureRegions) {
@@ -107,14 +110,15 @@ object FigureExtractorVisualizationCli extends Logging {
           doc,
           config.displayDpi,
           pages,
-          Some(vLogger)
+          Some(vLogger),
+          renderer = renderer
         )
       } else {
-        FigureExtractor().getFigures(doc, pages, Some(vLogger))
+        FigureExtractor().getFigures(doc, pages, Some(vLogger), renderer = renderer)
       }
     }
     logger.info(s"Displaying figures")
-    vLogger.displayVisualLog(doc, config.displayDpi)
+    vLogger.displayVisualLog(doc, config.displayDpi, renderer)
     doc.close()
     logger.info(s"Finished")
   }
@@ -1,14 +1,19 @@
 package org.allenai.pdffigures2
 
 import org.apache.pdfbox.pdmodel.PDDocument
+import org.apache.pdfbox.rendering.{ PDFRenderer, RenderDestination }
 import spray.json._
 
+import java.awt.Color
 import java.awt.image.BufferedImage
 import java.io._
+import java.util.concurrent.Semaphore
 import javax.imageio.ImageIO
 
+import scala.collection.mutable
+
 /** Methods rendering figures as images and saving those images to disk */
-object FigureRenderer {
+object FigureRenderer extends Logging {
 
   val CairoFormat = Set("ps", "eps", "pdf", "svg")
   val AllowedFormats = CairoFormat ++ ImageIO.getWriterFormatNames
@@ -22,6 +27,50 @@ object FigureRenderer {
   /** If we don't expand the image, how much to pad the figure region when it is rasterized */
   private val PadUnexpandedImage = 1
 
+  /** @return the (width, height) in pixels of `pageIndex` rendered at `dpi`, as computed by
+    *         `PDFRenderer.renderImageWithDPI`
+    */
+  def pageSizeInPixels(doc: PDDocument, pageIndex: Int, dpi: Int): (Int, Int) = {
+    val page = doc.getPage(pageIndex)
+    val scale = dpi / 72f
+    val w = Math.max(Math.floor(page.getCropBox.getWidth * scale).toInt, 1)
+    val h = Math.max(Math.floor(page.getCropBox.getHeight * scale).toInt, 1)
+    if (page.getRotation == 90 || page.getRotation == 270) (h, w) else (w, h)
+  }
+
+  /** Renders the pixel region (x1, y1, x2, y2), inclusive and in the coordinates of the page
+    * rendered at `dpi`, of page `pageIndex` into an image the size of that region. The result
+    * matches cropping the region out of `renderer.renderImageWithDPI(pageIndex, dpi)`.
+    */
+  def renderRegion(
+    renderer: PDFRenderer,
+    pageIndex: Int,
+    dpi: Int,
+    x1: Int,
+    y1: Int,
+    x2: Int,
+    y2: Int
+  ): BufferedImage = {
+    val w = x2 - x1 + 1
+    val h = y2 - y1 + 1
+    val image = new BufferedImage(w, h, BufferedImage.TYPE_INT_RGB)
+    val graphics = image.createGraphics()
+    try {
+      graphics.setBackground(Color.WHITE)
+      graphics.clearRect(0, 0, w, h)
+      graphics.translate(-x1, -y1)
+      graphics.clipRect(x1, y1, w, h)
+      val scale = dpi / 72f
+      renderer.renderPageToGraphics(pageIndex, graphics, scale, scale, RenderDestination.EXPORT)
+    } finally {
+      graphics.dispose()
+    }
+    image
+  }
+
+  private def translate(box: Box, dx: Int, dy: Int): Box =
+    Box(box.x1 + dx, box.y1 + dy, box.x2 + dx, box.y2 + dy)
+
   /** Expands the given region in an attempt to ensure no connected components in `img` are
     * only partially contained in the region, while ensuring region does not
     * intersect any box in `otherContentScaled`.
@@ -84,13 +133,22 @@ object FigureRenderer {
 
   /** Rasterize the figures in `page` with `dpi` and optionally cleaning/post-processing the figure
     * regions
+    *
+    * @param clipToRegions whether to render each figure's region on its own rather than
+    *                      rendering the whole page and cropping. This only allocates a buffer the
+    *                      size of each region, but interprets the page's whole content stream
+    *                      once per figure. Pages `renderer` already has cached at `dpi` are
+    *                      always cropped
+    * @param renderer renderer to use for the document, so renders can be shared with other steps
     */
   def rasterizeFigures(
     doc: PDDocument,
     page: PageWithFigures,
     dpi: Int,
     clean: Boolean,
-    logger: Option[VisualLogger]
+    logger: Option[VisualLogger],
+    clipToRegions: Boolean = false,
+    renderer: Option[PageRenderer] = None
   ): Seq[RasterizedFigure] = {
     val scale = dpi / 72.0
     val nonFigureContent =
@@ -98,36 +156,67 @@ object FigureRenderer {
         page.failedCaptions.map(_.boundary) ++
         page.figures.map(_.captionBoundary)).map(_.scale(scale))
     var figureRegions = page.figures.map(_.regionBoundary).map(_.scale(scale))
-    val renderer = new InterruptiblePDFRenderer(doc)
-    val pageImg = renderer.renderImageWithDPI(page.pageNumber, dpi)
+    val pageRenderer = renderer.getOrElse(new PageRenderer(doc))
+    val (pageWidth, pageHeight) = pageSizeInPixels(doc, page.pageNumber, dpi)
+
+    // Pixels to render around a figure's region, enough for `expandFigureBounds` to expand the
+    // region as far as it could on the whole page
+    val margin = if (clean) MaxExpand + 1 else PadUnexpandedImage * 2
+    def pixelRegion(fig: Figure): (Int, Int, Int, Int) = {
+      val r = fig.regionBoundary
+      (
+        Math.max(Math.floor(scale * r.x1).toInt, 0),
+        Math.max(Math.floor(scale * r.y1).toInt, 0),
+        Math.min(Math.ceil(scale * r.x2).toInt, pageWidth - 1),
+        Math.min(Math.ceil(scale * r.y2).toInt, pageHeight - 1)
+      )
+    }
+    def renderedRegion(x1: Int, y1: Int, x2: Int, y2: Int): (Int, Int, Int, Int) = (
+      Math.max(x1 - margin, 0),
+      Math.max(y1 - margin, 0),
+      Math.min(x2 + margin, pageWidth - 1),
+      Math.min(y2 + margin, pageHeight - 1)
+    )
+    val cachedPage = pageRenderer.getCached(page.pageNumber, dpi)
+    val renderRegions = clipToRegions && cachedPage.isEmpty
+    // Renders at the output DPI are rarely needed again, so they are not added to the cache
+    lazy val pageImg = cachedPage.getOrElse(pageRenderer.renderOnce(page.pageNumber, dpi))
+
     val rasterized = page.figures.zipWithIndex.map {
       case (fig, figureNumber) =>
         val otherFigureRegions =
           figureRegions.take(figureNumber) ++ figureRegions.drop(figureNumber + 1)
-        val r = fig.regionBoundary
-        val x1 = Math.max(Math.floor(scale * r.x1).toInt, 0)
-        val y1 = Math.max(Math.floor(scale * r.y1).toInt, 0)
-        val x2 = Math.min(Math.ceil(scale * r.x2).toInt, pageImg.getWidth - 1)
-        val y2 = Math.min(Math.ceil(scale * r.y2).toInt, pageImg.getHeight - 1)
+        val (x1, y1, x2, y2) = pixelRegion(fig)
+        // `img` holds the part of the page starting at pixel (offsetX, offsetY)
+        val (img, offsetX, offsetY) = if (renderRegions) {
+          val (rx1, ry1, rx2, ry2) = renderedRegion(x1, y1, x2, y2)
+          val regionImg =
+            renderRegion(pageRenderer.renderer, page.pageNumber, dpi, rx1, ry1, rx2, ry2)
+          (regionImg, rx1, ry1)
+        } else {
+          (pageImg, 0, 0)
+        }
         val (cx1, cy1, cx2, cy2) = if (clean) {
-          expandFigureBounds(
-            x1,
-            y1,
-            x2,
-            y2,
-            nonFigureContent ++ otherFigureRegions,
+          val (ex1, ey1, ex2, ey2) = expandFigureBounds(
+            x1 - offsetX,
+            y1 - offsetY,
+            x2 - offsetX,
+            y2 - offsetY,
+            (nonFigureContent ++ otherFigureRegions).map(translate(_, -offsetX, -offsetY)),
             PadNonFigureContent,
-            pageImg
+            img
           )
+          (ex1 + offsetX, ey1 + offsetY, ex2 + offsetX, ey2 + offsetY)
         } else {
           (
             Math.max(x1 - PadUnexpandedImage, 0),
             Math.max(y1 - PadUnexpandedImage, 0),
-            Math.min(x2 + PadUnexpandedImage * 2, pageImg.getWidth - 1),
-            Math.min(y2 + PadUnexpandedImage * 2, pageImg.getHeight - 1)
+            Math.min(x2 + PadUnexpandedImage * 2, pageWidth - 1),
+            Math.min(y2 + PadUnexpandedImage * 2, pageHeight - 1)
           )
         }
-        val figureImage = pageImg.getSubimage(cx1, cy1, cx2 - cx1 + 1, cy2 - cy1 + 1)
+        val figureImage =
+          img.getSubimage(cx1 - offsetX, cy1 - offsetY, cx2 - cx1 + 1, cy2 - cy1 + 1)
         val rasterizedFigure = RasterizedFigure(fig, Box(cx1, cy1, cx2, cy2), figureImage, dpi)
         figureRegions = figureRegions.updated(figureNumber, fig.regionBoundary)
         rasterizedFigure
@@ -140,17 +229,24 @@ object FigureRenderer {
   def saveRasterizedFigures(
     figuresAndFilenames: Seq[(String, RasterizedFigure)],
     format: String,
-    dpi: Int
+    dpi: Int,
+    options: FigureWriter.WriteOptions = FigureWriter.WriteOptions()
   ): Seq[SavedFigure] = {
     require(ImageIO.getWriterFormatNames.contains(format), s"Can't save to format $format")
     figuresAndFilenames.map {
       case (filename, rasterizedFigure) =>
-        ImageIO.write(rasterizedFigure.bufferedImage, format, new File(filename))
+        FigureWriter.writeImage(rasterizedFigure.bufferedImage, format, new File(filename), options)
         SavedFigure(rasterizedFigure, filename)
     }
   }
 
-  /** Save figures to disk in a vector graphic format by shelling out to pdftocairo */
+  /** Save figures to disk in a vector graphic format by shelling out to pdftocairo. Each page
+    * with figures is saved once as a single page PDF in a temporary file, which is then read by
+    * one pdftocairo process per figure on that page. The processes for a page run concurrently,
+    * limited across all callers to `MaxCairoProcesses` processes at a time. Figures pdftocairo
+    * fails to save are logged and left out of the returned figures, rather than failing the
+    * whole document.
+    */
   def saveFiguresAsImagesCairo(
     doc: PDDocument,
     figuresAndFilenames: Seq[(String, Figure)],
@@ -159,30 +255,107 @@ object FigureRenderer {
   ): Iterable[SavedFigure] = {
     require(CairoFormat.contains(format), s"Cairo can't render to format $format")
     val groupedByPage = figuresAndFilenames.groupBy(_._2.page)
-    groupedByPage.flatMap {
+    groupedByPage.toSeq.sortBy(_._1).flatMap {
       case (pageNum, pageFigures) =>
-        val pageDoc = new PDDocument() // Save some IO by just sending cairo the relevant page
-        pageDoc.addPage(doc.getPage(pageNum))
-        val savedFigures = pageFigures.map {
-          case (filename, fig) =>
-            if (Thread.interrupted()) throw new InterruptedException()
-            val box = fig.regionBoundary
-            val x = Math.round(box.x1) - PadUnexpandedImage
-            val y = Math.round(box.y1) - PadUnexpandedImage
-            val w = Math.round(box.width) + PadUnexpandedImage * 2
-            val h = Math.round(box.height) + PadUnexpandedImage * 2
-            val cmdStr = s"pdftocairo -$format -r $dpi " +
-              s"-x $x -y $y -H $h -W $w -paperw $w -paperh $h - $filename"
-            val cmd = Runtime.getRuntime.exec(cmdStr)
-            val outStream = cmd.getOutputStream
-            pageDoc.save(outStream) // Stream the doc to cairo
-            if (cmd.waitFor() != 0) {
-              throw new IOException("Error using cairo to save a figure")
-            }
-            SavedFigure(fig, filename, dpi)
+        val pageFile = File.createTempFile("pdffigures2-page", ".pdf")
+        try {
+          val pageDoc = new PDDocument() // Save some IO by just sending cairo the relevant page
+          try {
+            pageDoc.addPage(doc.getPage(pageNum))
+            pageDoc.save(pageFile)
+          } finally {
+            pageDoc.close()
+          }
+          saveFiguresFromPageCairo(pageFile, pageFigures, format, dpi)
+        } finally {
+          pageFile.delete()
+        }
+    }
+  }
+
+  /** Maximum number of pdftocairo processes to run at once */
+  val MaxCairoProcesses: Int = Math.max(1, Runtime.getRuntime.availableProcessors())
+  private val cairoProcesses = new Semaphore(MaxCairoProcesses)
+
+  private case class CairoProcess(process: Process, filename: String, figure: Figure)
+
+  private def saveFiguresFromPageCairo(
+    pageFile: File,
+    figuresAndFilenames: Seq[(String, Figure)],
+    format: String,
+    dpi: Int
+  ): Seq[SavedFigure] = {
+    val running = mutable.Queue[CairoProcess]()
+    val saved = mutable.ArrayBuffer[SavedFigure]()
+
+    // `cairo` has already been dequeued, so it is destroyed here if we stop waiting for it
+    def finish(cairo: CairoProcess): Unit = {
+      try {
+        val exitCode = try {
+          cairo.process.waitFor()
+        } catch {
+          case e: InterruptedException =>
+            cairo.process.destroy()
+            throw e
+        }
+        if (exitCode == 0) {
+          saved += SavedFigure(cairo.figure, cairo.filename, dpi)
+        } else {
+          logger.warn(s"pdftocairo exited with code $exitCode saving ${cairo.filename}")
+        }
+      } finally {
+        cairoProcesses.release()
+      }
+    }
+
+    // Wait on our own processes when there are no permits left instead of blocking while holding
+    // permits, otherwise several callers holding all the permits between them could deadlock
+    def acquire(): Unit = {
+      var acquired = cairoProcesses.tryAcquire()
+      while (!acquired) {
+        if (running.nonEmpty) {
+          finish(running.dequeue())
+          acquired = cairoProcesses.tryAcquire()
+        } else {
+          cairoProcesses.acquire()
+          acquired = true
         }
-        pageDoc.close()
-        savedFigures
+      }
+    }
+
+    try {
+      figuresAndFilenames.foreach {
+        case (filename, fig) =>
+          if (Thread.interrupted()) throw new InterruptedException()
+          val box = fig.regionBoundary
+          val x = Math.round(box.x1) - PadUnexpandedImage
+          val y = Math.round(box.y1) - PadUnexpandedImage
+          val w = Math.round(box.width) + PadUnexpandedImage * 2
+          val h = Math.round(box.height) + PadUnexpandedImage * 2
+          val cmd = Seq("pdftocairo", s"-$format", "-r", dpi.toString, "-x", x.toString,
+            "-y", y.toString, "-H", h.toString, "-W", w.toString, "-paperw", w.toString,
+            "-paperh", h.toString, pageFile.getAbsolutePath, filename)
+          acquire()
+          val process = try {
+            new ProcessBuilder(cmd: _*)
+              .redirectErrorStream(true)
+              .redirectOutput(ProcessBuilder.Redirect.INHERIT)
+              .start()
+          } catch {
+            case e: IOException =>
+              cairoProcesses.release()
+              throw e
+          }
+          running.enqueue(CairoProcess(process, filename, fig))
+      }
+      while (running.nonEmpty) finish(running.dequeue())
+      saved
+    } finally {
+      // Only non-empty if we were interrupted or failed to start a process
+      running.foreach { cairo =>
+        cairo.process.destroy()
+        cairoProcesses.release()
+      }
     }
   }
 
@@ -0,0 +1,134 @@
+package org.allenai.pdffigures2
+
+import java.awt.image.BufferedImage
+import java.io.{ File, IOException }
+import java.util.concurrent._
+import javax.imageio.{ IIOImage, ImageIO, ImageWriteParam, ImageWriter }
+
+/** Encodes and writes images to disk on its own pool of `threads` threads, so several images are
+  * encoded at once and callers can carry on while their figures are written. At most `maxQueued`
+  * images can wait to be written, `write` blocks once that many are waiting so rasterized images
+  * can not pile up in memory faster than they are written out.
+  */
+class FigureWriter(
+  threads: Int,
+  maxQueued: Int,
+  options: FigureWriter.WriteOptions = FigureWriter.WriteOptions()
+) {
+  require(threads > 0, "Threads must be > 0")
+  require(maxQueued >= 0, "Queue size must be >= 0")
+
+  private val pool = Executors.newFixedThreadPool(threads)
+
+  // Images being written plus images waiting to be written
+  private val slots = new Semaphore(threads + maxQueued)
+
+  /** Queues `image` to be written to `file` in `format`, blocking while the queue is full. The
+    * time spent encoding and writing the image is added to `timings` as
+    * `StageTimings.WriteFigures`.
+    *
+    * @return a future that completes with the `System.nanoTime` the image finished being written
+    */
+  def write(
+    image: BufferedImage,
+    format: String,
+    file: File,
+    timings: Option[StageTimings] = None
+  ): Future[Long] = {
+    slots.acquire()
+    try {
+      pool.submit(new Callable[Long] {
+        override def call(): Long = {
+          try {
+            StageTimings.time(timings, StageTimings.WriteFigures) {
+              FigureWriter.writeImage(image, format, file, options)
+            }
+            System.nanoTime()
+          } finally {
+            slots.release()
+          }
+        }
+      })
+    } catch {
+      case e: RejectedExecutionException =>
+        slots.release()
+        throw e
+    }
+  }
+
+  /** Number of images waiting to be, or being, written */
+  def pending: Int = threads + maxQueued - slots.availablePermits()
+
+  /** Waits for queued images to be written, then stops the writer's threads */
+  def close(): Unit = {
+    pool.shutdown()
+    pool.awaitTermination(Long.MaxValue, TimeUnit.MILLISECONDS)
+  }
+}
+
+object FigureWriter {
+
+  /** @param compressionQuality ImageIO compression quality, from 0 to 1, for formats that
+    *                           support it. For JPEG lower values mean smaller, lossier images,
+    *                           for PNG lower values mean a higher, slower, deflate level
+    *                           (PNG compression can only be set on Java 9 or later)
+    * @param compressionType ImageIO compression type to use for formats with several, for
+    *                        example "LZW" for TIFF, defaults to the format's first type
+    */
+  case class WriteOptions(
+    compressionQuality: Option[Float] = None,
+    compressionType: Option[String] = None
+  )
+
+  /** Encodes `image` as `format` and writes it to `file` using `options`, with the first ImageIO
+    * writer for `format` that can encode `image`
+    */
+  def writeImage(
+    image: BufferedImage,
+    format: String,
+    file: File,
+    options: WriteOptions = WriteOptions()
+  ): Unit = {
+    val writers = ImageIO.getImageWritersByFormatName(format)
+    if (!writers.hasNext) {
+      throw new IOException(s"No ImageIO writer for format $format")
+    }
+    var writer: ImageWriter = null
+    while (writer == null && writers.hasNext) {
+      val candidate = writers.next()
+      val provider = candidate.getOriginatingProvider
+      if (provider == null || provider.canEncodeImage(image)) {
+        writer = candidate
+      } else {
+        candidate.dispose()
+      }
+    }
+    if (writer == null) {
+      throw new IOException(s"No ImageIO writer for format $format can encode the image")
+    }
+    try {
+      val param = writer.getDefaultWriteParam
+      val compress = options.compressionQuality.isDefined || options.compressionType.isDefined
+      if (compress && param.canWriteCompressed) {
+        param.setCompressionMode(ImageWriteParam.MODE_EXPLICIT)
+        val compressionType =
+          options.compressionType.orElse(Option(param.getCompressionTypes).flatMap(_.headOption))
+        compressionType.foreach(param.setCompressionType)
+        options.compressionQuality.foreach(param.setCompressionQuality)
+      }
+      file.delete() // As `ImageIO.write` does, otherwise a longer existing file is not truncated
+      val stream = ImageIO.createImageOutputStream(file)
+      if (stream == null) {
+        throw new IOException(s"Can't write to ${file.getPath}")
+      }
+      try {
+        writer.setOutput(stream)
+        writer.write(null, new IIOImage(image, null, null), param)
+      } finally {
+        stream.close()
+      }
+    } finally {
+      writer.dispose()
+    }
+  }
+}
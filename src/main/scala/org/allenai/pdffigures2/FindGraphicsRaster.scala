@@ -1,12 +1,9 @@
 package org.allenai.pdffigures2
 
 import org.apache.pdfbox.pdmodel.PDDocument
-import org.apache.pdfbox.rendering.{ ImageType, PDFRenderer }
 
 import java.awt.image.BufferedImage
 
-import scala.collection.mutable
-
 /** Finds the bounding boxes of graphical elements in a PDF by rasterizing the PDF and
   * finding the the bounding boxes of the connected components in the image.
   * Currently only used for OCRed PDFs.
@@ -20,9 +17,13 @@ object FindGraphicsRaster {
   private val DPI = 72
   require(72 % DPI == 0, "Currently need an integer scaling factor relative to 72 DPI")
 
-  def findCCBoundingBoxes(doc: PDDocument, page: Int, remove: Iterable[Box]): List[Box] = {
-    val renderer = new PDFRenderer(doc)
-    val img = renderer.renderImageWithDPI(page, DPI, ImageType.GRAY)
+  def findCCBoundingBoxes(
+    doc: PDDocument,
+    page: Int,
+    remove: Iterable[Box],
+    renderer: Option[PageRenderer] = None
+  ): List[Box] = {
+    val img = renderer.getOrElse(new PageRenderer(doc)).renderGray(page, DPI)
     findCCBoundingBoxes(img, remove, Threshold, DPI / 72)
   }
 
@@ -37,73 +38,129 @@ object FindGraphicsRaster {
     val pixels: Array[Int] = new Array[Int](w * h)
     image.getRaster.getPixels(0, 0, w, h, pixels)
     remove.foreach { box =>
-      for (y <- Math.floor(box.y1 / rescale).toInt to
-             Math.min(Math.ceil(box.y2 / rescale).toInt, h)) {
-        for (x <- Math.floor(box.x1 / rescale).toInt to
-               Math.min(Math.ceil(box.x2 / rescale).toInt, w)) {
-          pixels(w * y + x) = grayScaleTresh
+      val minY = Math.max(Math.floor(box.y1 / rescale).toInt, 0)
+      val maxY = Math.min(Math.ceil(box.y2 / rescale).toInt, h - 1)
+      val minX = Math.max(Math.floor(box.x1 / rescale).toInt, 0)
+      val maxX = Math.min(Math.ceil(box.x2 / rescale).toInt, w - 1)
+      if (minX <= maxX) {
+        var y = minY
+        while (y <= maxY) {
+          java.util.Arrays.fill(pixels, w * y + minX, w * y + maxX + 1, grayScaleTresh)
+          y += 1
         }
       }
     }
     findCCBoundingBoxes(pixels, w, h, grayScaleTresh, rescale)
   }
 
-  private def findCCBoundingBoxes(
+  /** Returns the bounding boxes of the 4-connected components of pixels darker than
+    * `pixThreshold` in the `w` by `h` image `pixels`, scaled by `rescale`.
+    *
+    * Uses two pass union-find labeling: the first pass labels each pixel from its left and upper
+    * neighbours, recording which labels are connected, and the second pass folds each pixel
+    * into the bounding box of its component's root label. Roots are always the smallest label in
+    * their component, so components are returned in the reverse of the order their first pixel
+    * appears in the image.
+    */
+  private[pdffigures2] def findCCBoundingBoxes(
     pixels: Array[Int],
     w: Int,
     h: Int,
     pixThreshold: Int,
     rescale: Int
   ): List[Box] = {
-    val pixelsToExplore = mutable.Set[Int]()
+    val labels = new Array[Int](w * h)
+    // Labels start at 1 so 0 can mean background, parent(label) == label for roots
+    var parent = new Array[Int](256)
+    var numLabels = 0
 
-    var boundingBoxes = List[Box]()
-    for (y <- 0 until h) {
-      for (x <- 0 until w) {
-        val pixelIndex = x + y * w
+    def find(label: Int): Int = {
+      var root = label
+      while (parent(root) != root) root = parent(root)
+      var current = label
+      while (parent(current) != root) {
+        val next = parent(current)
+        parent(current) = root
+        current = next
+      }
+      root
+    }
+
+    def union(a: Int, b: Int): Int = {
+      val rootA = find(a)
+      val rootB = find(b)
+      if (rootA < rootB) {
+        parent(rootB) = rootA
+        rootA
+      } else {
+        parent(rootA) = rootB
+        rootB
+      }
+    }
+
+    var y = 0
+    while (y < h) {
+      val row = y * w
+      var x = 0
+      while (x < w) {
+        val pixelIndex = row + x
         if (pixels(pixelIndex) < pixThreshold) {
-          var minX = x
-          var maxX = x
-          var minY = y
-          var maxY = y
-          pixelsToExplore.add(pixelIndex)
-          while (pixelsToExplore.nonEmpty) {
-            val currentPixel = pixelsToExplore.head
-            pixelsToExplore.remove(currentPixel)
-            if (currentPixel > w) {
-              val lowerPixel = currentPixel - w
-              if (pixels(lowerPixel) < pixThreshold) {
-                pixelsToExplore.add(currentPixel - w)
-                minY = Math.min(minY, lowerPixel / w)
-              }
+          val left = if (x > 0) labels(pixelIndex - 1) else 0
+          val up = if (y > 0) labels(pixelIndex - w) else 0
+          labels(pixelIndex) = if (left == 0 && up == 0) {
+            numLabels += 1
+            if (numLabels == parent.length) {
+              parent = java.util.Arrays.copyOf(parent, parent.length * 2)
             }
-            if (currentPixel < pixels.length - w) {
-              val upperPixel = currentPixel + w
-              if (pixels(upperPixel) < pixThreshold) {
-                pixelsToExplore.add(upperPixel)
-                maxY = Math.max(maxY, upperPixel / w)
-              }
-            }
-            if (currentPixel % w != 0) {
-              val leftPixel = currentPixel - 1
-              if (pixels(leftPixel) < pixThreshold) {
-                pixelsToExplore.add(leftPixel)
-                minX = Math.min(minX, leftPixel % w)
-              }
-            }
-            if ((currentPixel + 1) % w != 0) {
-              val rightPixel = currentPixel + 1
-              if (pixels(rightPixel) < pixThreshold) {
-                pixelsToExplore.add(rightPixel + 1)
-                maxX = Math.max(maxX, rightPixel % w)
-              }
-            }
-            // Set the current pixel to white so we don't visit it again.
-            pixels(currentPixel) = pixThreshold
+            parent(numLabels) = numLabels
+            numLabels
+          } else if (left == 0) {
+            up
+          } else if (up == 0 || up == left) {
+            left
+          } else {
+            union(left, up)
           }
-          boundingBoxes = new Box(minX * rescale, minY * rescale, maxX * rescale, maxY * rescale) :: boundingBoxes
         }
+        x += 1
+      }
+      y += 1
+    }
+
+    val minX = Array.fill(numLabels + 1)(Int.MaxValue)
+    val minY = Array.fill(numLabels + 1)(Int.MaxValue)
+    val maxX = Array.fill(numLabels + 1)(-1)
+    val maxY = Array.fill(numLabels + 1)(-1)
+    y = 0
+    while (y < h) {
+      val row = y * w
+      var x = 0
+      while (x < w) {
+        val label = labels(row + x)
+        if (label != 0) {
+          val root = find(label)
+          if (x < minX(root)) minX(root) = x
+          if (x > maxX(root)) maxX(root) = x
+          if (y < minY(root)) minY(root) = y
+          if (y > maxY(root)) maxY(root) = y
+        }
+        x += 1
+      }
+      y += 1
+    }
+
+    var boundingBoxes = List[Box]()
+    var label = 1
+    while (label <= numLabels) {
+      if (parent(label) == label) {
+        boundingBoxes = Box(
+          minX(label) * rescale,
+          minY(label) * rescale,
+          maxX(label) * rescale,
+          maxY(label) * rescale
+        ) :: boundingBoxes
       }
+      label += 1
     }
     boundingBoxes
   }
@@ -26,9 +26,10 @@ object GraphicsExtractor extends Logging {
     page: PageWithClassifiedText,
     allowOcr: Boolean,
     ignoreWhiteGraphics: Boolean,
-    vLogger: Option[VisualLogger]
+    vLogger: Option[VisualLogger],
+    renderer: Option[PageRenderer] = None
   ): PageWithGraphics = {
-    val rawGraphics = extractRawGraphics(doc, page, allowOcr, ignoreWhiteGraphics)
+    val rawGraphics = extractRawGraphics(doc, page, allowOcr, ignoreWhiteGraphics, renderer)
     val pageBounds = Box.fromPDRect(doc.getPage(page.pageNumber).getCropBox)
     val (graphics, nonFigureGraphics) = preprocessGraphics(rawGraphics, page, pageBounds)
     logger.debug(s"Found ${graphics.size} graphic areas, ${graphics.size} after cleaning")
@@ -48,7 +49,8 @@ object GraphicsExtractor extends Logging {
     doc: PDDocument,
     textPage: PageWithClassifiedText,
     allowOcr: Boolean,
-    ignoreWhiteGraphics: Boolean
+    ignoreWhiteGraphics: Boolean,
+    renderer: Option[PageRenderer]
   ): List[Box] = {
     val page = textPage.pageNumber
     val bounds = Box.fromPDRect(doc.getPage(page).getCropBox)
@@ -60,7 +62,8 @@ object GraphicsExtractor extends Logging {
         val rasterCCs = FindGraphicsRaster.findCCBoundingBoxes(
           doc,
           page,
-          (textPage.classifiedText.allText ++ textPage.paragraphs).map(_.boundary)
+          (textPage.classifiedText.allText ++ textPage.paragraphs).map(_.boundary),
+          renderer
         )
         rasterCCs.filter(_.area > OcrGraphicMinSize) // Clean up noise/trailing character pixels
       } else {
@@ -0,0 +1,130 @@
+package org.allenai.pdffigures2
+
+import org.apache.pdfbox.pdmodel.PDDocument
+import org.apache.pdfbox.rendering.ImageType
+
+import java.awt.RenderingHints
+import java.awt.image.BufferedImage
+
+/** Renders the pages of a single document. One renderer is reused for every page, so PDFBox's
+  * font and image caches are shared between renders, and rendered pages are kept in a least
+  * recently used cache of at most `maxBytes` bytes so a page needed by several processing steps
+  * is only rendered once. A request for a lower DPI, or for grayscale, is served by downsampling
+  * a cached render of the page at a higher DPI instead of rendering the page again.
+  *
+  * Returned images are shared and must not be modified.
+  */
+class PageRenderer(doc: PDDocument, maxBytes: Long = PageRenderer.DefaultMaxBytes) {
+
+  private case class RenderKey(page: Int, dpi: Int, gray: Boolean)
+
+  val renderer = new InterruptiblePDFRenderer(doc)
+
+  // Access ordered, so iteration starts at the least recently used page
+  private val cache = new java.util.LinkedHashMap[RenderKey, BufferedImage](16, 0.75f, true)
+  private var cachedBytes = 0L
+
+  private def bytes(image: BufferedImage): Long = {
+    val bytesPerPixel = if (image.getType == BufferedImage.TYPE_BYTE_GRAY) 1 else 4
+    image.getWidth.toLong * image.getHeight * bytesPerPixel
+  }
+
+  private def put(key: RenderKey, image: BufferedImage): Unit = {
+    val size = bytes(image)
+    if (size <= maxBytes) {
+      cache.put(key, image)
+      cachedBytes += size
+      val it = cache.entrySet().iterator()
+      while (cachedBytes > maxBytes && it.hasNext) {
+        val entry = it.next()
+        cachedBytes -= bytes(entry.getValue)
+        it.remove()
+      }
+    }
+  }
+
+  /** @return a cached color render of `page` we can downsample to `dpi`, preferring the
+    *         smallest
+    */
+  private def findSource(page: Int, dpi: Int): Option[BufferedImage] = {
+    var best: Option[(Int, BufferedImage)] = None
+    val it = cache.entrySet().iterator()
+    while (it.hasNext) {
+      val entry = it.next()
+      val key = entry.getKey
+      if (key.page == page && !key.gray && key.dpi >= dpi && best.forall(_._1 > key.dpi)) {
+        best = Some((key.dpi, entry.getValue))
+      }
+    }
+    best.map(_._2)
+  }
+
+  private def downsample(
+    source: BufferedImage,
+    page: Int,
+    dpi: Int,
+    imageType: Int
+  ): BufferedImage = {
+    val (w, h) = FigureRenderer.pageSizeInPixels(doc, page, dpi)
+    val image = new BufferedImage(w, h, imageType)
+    val graphics = image.createGraphics()
+    try {
+      graphics.setRenderingHint(
+        RenderingHints.KEY_INTERPOLATION,
+        RenderingHints.VALUE_INTERPOLATION_BILINEAR
+      )
+      graphics.setRenderingHint(RenderingHints.KEY_RENDERING, RenderingHints.VALUE_RENDER_QUALITY)
+      graphics.drawImage(source, 0, 0, w, h, null)
+    } finally {
+      graphics.dispose()
+    }
+    image
+  }
+
+  private def get(
+    page: Int,
+    dpi: Int,
+    gray: Boolean,
+    store: Boolean
+  ): BufferedImage = synchronized {
+    val key = RenderKey(page, dpi, gray)
+    val cached = cache.get(key)
+    if (cached != null) {
+      cached
+    } else {
+      val image = findSource(page, dpi) match {
+        case Some(source) =>
+          val imageType = if (gray) BufferedImage.TYPE_BYTE_GRAY else BufferedImage.TYPE_INT_RGB
+          downsample(source, page, dpi, imageType)
+        case None =>
+          renderer.renderImageWithDPI(page, dpi, if (gray) ImageType.GRAY else ImageType.RGB)
+      }
+      if (store) put(key, image)
+      image
+    }
+  }
+
+  /** @return `page` rendered in color at `dpi` */
+  def render(page: Int, dpi: Int): BufferedImage = get(page, dpi, gray = false, store = true)
+
+  /** @return `page` rendered in color at `dpi`, using the cache if it holds a suitable render but
+    *         without caching the result. For renders only needed once, such as rendering pages at
+    *         the output DPI to crop figures from, so they do not push the renders used to parse the
+    *         document out of the cache, and can be released as soon as the caller is done
+    */
+  def renderOnce(page: Int, dpi: Int): BufferedImage = get(page, dpi, gray = false, store = false)
+
+  /** @return `page` rendered in grayscale at `dpi` */
+  def renderGray(page: Int, dpi: Int): BufferedImage = get(page, dpi, gray = true, store = true)
+
+  /** @return a color render of `page` at exactly `dpi` if one is cached */
+  def getCached(page: Int, dpi: Int): Option[BufferedImage] = synchronized {
+    Option(cache.get(RenderKey(page, dpi, gray = false)))
+  }
+}
+
+object PageRenderer {
+
+  /** Enough for about eight letter sized pages rendered in color at 150 DPI */
+  val DefaultMaxBytes: Long = 64L * 1024 * 1024
+}
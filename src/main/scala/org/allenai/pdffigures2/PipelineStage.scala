@@ -0,0 +1,134 @@
+package org.allenai.pdffigures2
+
+import java.util.concurrent.atomic.{ AtomicInteger, AtomicLong }
+import java.util.concurrent.{ Executors, RejectedExecutionException, Semaphore, TimeUnit }
+
+/** One stage of a pipeline, tasks are run on the stage's own pool of `threads` threads and at
+  * most `queueSize` tasks can wait for a free thread. `submit` blocks while the queue is full, so
+  * a slow stage holds back the stages feeding it instead of letting their output pile up.
+  *
+  * The stage records how deep its queue was each time a task was submitted, how long submitters
+  * were blocked on a full queue, and how much of its threads' time was spent running tasks, see
+  * `statistics`. Tasks that hand their results to another stage should do so with `submitThen`,
+  * so time spent blocked on the other stage's full queue is not counted as this stage being busy.
+  */
+class PipelineStage(val name: String, val threads: Int, val queueSize: Int) {
+  require(threads > 0, s"$name: threads must be > 0")
+  require(queueSize >= 0, s"$name: queue size must be >= 0")
+
+  private val pool = Executors.newFixedThreadPool(threads)
+
+  // Tasks running plus tasks waiting to run
+  private val slots = new Semaphore(threads + queueSize)
+  private val running = new AtomicInteger(0)
+
+  private val startTime = System.nanoTime()
+  @volatile private var endTime: Option[Long] = None
+  private val tasks = new AtomicLong(0)
+  private val busyNanos = new AtomicLong(0)
+  private val blockedNanos = new AtomicLong(0)
+  private val queueDepthSum = new AtomicLong(0)
+  private val maxQueueDepth = new AtomicInteger(0)
+
+  /** Number of tasks waiting for a free thread */
+  def queueDepth: Int =
+    math.max(0, threads + queueSize - slots.availablePermits() - running.get())
+
+  /** Queues `task` to run on this stage, blocking while the queue is full */
+  def submit(task: => Unit): Unit = submitThen { task; PipelineStage.Done }
+
+  /** As `submit`, but `task` returns a continuation, such as submitting its result to the next
+    * stage, that is run on the same thread once the time spent on `task` has been recorded. The
+    * task keeps its place in the queue until the continuation returns, so a blocked next stage
+    * still holds back this one.
+    */
+  def submitThen(task: => (() => Unit)): Unit = {
+    val blockedStart = System.nanoTime()
+    slots.acquire()
+    blockedNanos.addAndGet(System.nanoTime() - blockedStart)
+    // Tasks waiting ahead of this one, which already holds a slot but is not running
+    val depth = math.max(0, queueDepth - 1)
+    try {
+      pool.execute(new Runnable {
+        override def run(): Unit = {
+          running.incrementAndGet()
+          try {
+            val start = System.nanoTime()
+            val next =
+              try {
+                task
+              } finally {
+                busyNanos.addAndGet(System.nanoTime() - start)
+              }
+            next()
+          } finally {
+            running.decrementAndGet()
+            slots.release()
+          }
+        }
+      })
+    } catch {
+      case e: RejectedExecutionException =>
+        slots.release()
+        throw e
+    }
+    tasks.incrementAndGet()
+    queueDepthSum.addAndGet(depth)
+    var max = maxQueueDepth.get()
+    while (depth > max && !maxQueueDepth.compareAndSet(max, depth)) max = maxQueueDepth.get()
+  }
+
+  /** Waits for submitted tasks to finish, then stops the stage's threads */
+  def close(): Unit = {
+    pool.shutdown()
+    pool.awaitTermination(Long.MaxValue, TimeUnit.MILLISECONDS)
+    if (endTime.isEmpty) endTime = Some(System.nanoTime())
+  }
+
+  /** Stops the stage's threads, interrupting running tasks */
+  def shutdownNow(): Unit = {
+    pool.shutdownNow()
+    if (endTime.isEmpty) endTime = Some(System.nanoTime())
+  }
+
+  def statistics: PipelineStage.Statistics = {
+    val elapsed = endTime.getOrElse(System.nanoTime()) - startTime
+    val numTasks = tasks.get()
+    PipelineStage.Statistics(
+      name,
+      threads,
+      queueSize,
+      numTasks,
+      if (numTasks == 0) 0.0 else queueDepthSum.get().toDouble / numTasks,
+      maxQueueDepth.get(),
+      blockedNanos.get() / 1000000,
+      busyNanos.get() / 1000000,
+      if (elapsed <= 0) 0.0 else busyNanos.get().toDouble / (elapsed * threads)
+    )
+  }
+}
+
+object PipelineStage {
+
+  /** Continuation for tasks that have nothing to hand on */
+  val Done: () => Unit = () => ()
+
+  /** @param meanQueueDepth average number of tasks already waiting when a task was submitted
+    * @param blockedMillis time tasks spent waiting to be submitted because the queue was full
+    * @param busyMillis time the stage's threads spent running tasks, not counting time spent in
+    *                   their continuations (see `submitThen`)
+    * @param utilization fraction of the stage's thread time spent running tasks, a stage that is
+    *                    close to 1 while the stage before it is blocked needs more threads
+    */
+  case class Statistics(
+    name: String,
+    threads: Int,
+    queueSize: Int,
+    tasks: Long,
+    meanQueueDepth: Double,
+    maxQueueDepth: Int,
+    blockedMillis: Long,
+    busyMillis: Long,
+    utilization: Double
+  )
+}
@@ -0,0 +1,91 @@
+package org.allenai.pdffigures2
+
+import scala.collection.mutable
+
+/** Records how long each stage of processing a document takes. Stages that run once per page
+  * also record the time spent on each page. Timings are kept in nanoseconds and reported in
+  * milliseconds. Recording is synchronized so pages can be processed in parallel.
+  */
+class StageTimings {
+  private val stageNanos = mutable.LinkedHashMap[String, Long]()
+  private val pageNanos = mutable.LinkedHashMap[String, mutable.Map[Int, Long]]()
+
+  /** Runs `fn`, adding the time it takes to `stage` */
+  def time[T](stage: String)(fn: => T): T = {
+    val start = System.nanoTime()
+    try {
+      fn
+    } finally {
+      record(stage, System.nanoTime() - start)
+    }
+  }
+
+  /** Runs `fn`, adding the time it takes to `stage` and to `stage` on page `page` */
+  def timePage[T](stage: String, page: Int)(fn: => T): T = {
+    val start = System.nanoTime()
+    try {
+      fn
+    } finally {
+      recordPage(stage, page, System.nanoTime() - start)
+    }
+  }
+
+  def record(stage: String, nanos: Long): Unit = synchronized {
+    stageNanos.update(stage, stageNanos.getOrElse(stage, 0L) + nanos)
+  }
+
+  def recordPage(stage: String, page: Int, nanos: Long): Unit = synchronized {
+    record(stage, nanos)
+    val pages = pageNanos.getOrElseUpdate(stage, mutable.Map[Int, Long]())
+    pages.update(page, pages.getOrElse(page, 0L) + nanos)
+  }
+
+  /** Total milliseconds spent in each stage */
+  def stageMillis: Map[String, Double] = synchronized {
+    stageNanos.map { case (stage, nanos) => stage -> StageTimings.toMillis(nanos) }.toMap
+  }
+
+  /** Milliseconds spent on each page, 0 based and keyed as strings so they can be saved as
+    * JSON objects, for stages that were timed per page
+    */
+  def pageMillis: Map[String, Map[String, Double]] = synchronized {
+    pageNanos.map {
+      case (stage, pages) =>
+        stage -> pages.map {
+          case (page, nanos) => page.toString -> StageTimings.toMillis(nanos)
+        }.toMap
+    }.toMap
+  }
+}
+
+object StageTimings {
+  val LoadDocument = "loadDocument"
+  val ExtractText = "extractText"
+  val FormattingText = "formattingText"
+  val DocumentLayout = "documentLayout"
+  val RebuildParagraphs = "rebuildParagraphs"
+  val SectionTitles = "sectionTitles"
+  val FindCaptions = "findCaptions"
+  val ExtractGraphics = "extractGraphics"
+  val BuildCaptions = "buildCaptions"
+  val ClassifyRegions = "classifyRegions"
+  val LocateFigures = "locateFigures"
+  val RasterizeFigures = "rasterizeFigures"
+  val SaveFigures = "saveFigures"
+  val WriteFigures = "writeFigures"
+
+  private def toMillis(nanos: Long): Double = math.round(nanos / 1000.0) / 1000.0
+
+  /** Runs `fn`, timing it as `stage` if `timings` is defined */
+  def time[T](timings: Option[StageTimings], stage: String)(fn: => T): T = timings match {
+    case Some(t) => t.time(stage)(fn)
+    case None => fn
+  }
+
+  /** Runs `fn`, timing it as `stage` on page `page` if `timings` is defined */
+  def timePage[T](timings: Option[StageTimings], stage: String, page: Int)(fn: => T): T =
+    timings match {
+      case Some(t) => t.timePage(stage, page)(fn)
+      case None => fn
+    }
+}
@@ -2,7 +2,6 @@ package org.allenai.pdffigures2
 
 import org.allenai.pdffigures2.SectionedTextBuilder.DocumentSection
 import org.apache.pdfbox.pdmodel.PDDocument
-import org.apache.pdfbox.rendering.PDFRenderer
 import java.awt.event.{ ActionEvent, KeyEvent }
 import java.awt._
 import java.awt.image.BufferedImage
@@ -80,16 +79,17 @@ class VisualLogger(
     copy
   }
 
-  def displayVisualLog(doc: PDDocument, dpi: Int): Unit = {
+  /** Shows the logs for each page of `doc`, rendered at `dpi` with `renderer` if given */
+  def displayVisualLog(doc: PDDocument, dpi: Int, renderer: Option[PageRenderer] = None): Unit = {
     val pagesToShow = logs.values.flatMap(_.keys).toSet
     val keysToShow = ReservedKeys.filter(logs.contains) ++
       (logs.keySet -- ReservedKeys.toSet)
 
     val scaling = dpi / 72.0
     if (pagesToShow.nonEmpty) {
-      val renderer = new PDFRenderer(doc)
+      val pageRenderer = renderer.getOrElse(new PageRenderer(doc))
       val visualizationPerPage = pagesToShow.map { pageNum =>
-        val pageImg = renderer.renderImageWithDPI(pageNum, dpi)
+        val pageImg = pageRenderer.render(pageNum, dpi)
         val imagesToShow = keysToShow.map { key =>
           val annotations = logs(key).getOrElse(pageNum, Seq())
           val img = cloneImage(pageImg)
@@ -0,0 +1,75 @@
+package org.allenai.pdffigures2
+
+import org.apache.pdfbox.pdmodel.PDDocument
+
+import java.io.File
+
+/** Compares rendering whole pages and cropping out the figures to rendering only each figure's
+  * region with `FigureRenderer.renderRegion`, reporting time taken and pixel buffer memory.
+  *
+  * Usage: FigureRendererBenchmark <pdf> [<dpi>] [<iterations>]
+  */
+object FigureRendererBenchmark {
+
+  // Margin rendered around each region, the same margin `rasterizeFigures` uses when cleaning
+  private val Margin = 21
+
+  def main(args: Array[String]): Unit = {
+    val dpi = if (args.length > 1) args(1).toInt else 300
+    val iterations = if (args.length > 2) args(2).toInt else 5
+    val doc = PDDocument.load(new File(args(0)))
+    try {
+      val figuresByPage = FigureExtractor().getFigures(doc).groupBy(_.page)
+      val renderer = new InterruptiblePDFRenderer(doc)
+      val scale = dpi / 72.0
+      val regionsByPage = figuresByPage.map {
+        case (page, figures) =>
+          val (w, h) = FigureRenderer.pageSizeInPixels(doc, page, dpi)
+          page -> figures.map { fig =>
+            val r = fig.regionBoundary.scale(scale)
+            (
+              Math.max(Math.floor(r.x1).toInt - Margin, 0),
+              Math.max(Math.floor(r.y1).toInt - Margin, 0),
+              Math.min(Math.ceil(r.x2).toInt + Margin, w - 1),
+              Math.min(Math.ceil(r.y2).toInt + Margin, h - 1)
+            )
+          }
+      }
+
+      def renderPages(): Long = regionsByPage.map {
+        case (page, regions) =>
+          val img = renderer.renderImageWithDPI(page, dpi)
+          regions.foreach {
+            case (x1, y1, x2, y2) => img.getSubimage(x1, y1, x2 - x1 + 1, y2 - y1 + 1)
+          }
+          img.getWidth.toLong * img.getHeight * 4
+      }.sum
+
+      def renderRegions(): Long = regionsByPage.map {
+        case (page, regions) =>
+          regions.map {
+            case (x1, y1, x2, y2) =>
+              val img = FigureRenderer.renderRegion(renderer, page, dpi, x1, y1, x2, y2)
+              img.getWidth.toLong * img.getHeight * 4
+          }.sum
+      }.sum
+
+      def time(fn: => Long): (Double, Long) = {
+        fn // Warm up
+        var bytes = 0L
+        val start = System.nanoTime()
+        for (_ <- 0 until iterations) bytes = fn
+        ((System.nanoTime() - start) / 1000000.0 / iterations, bytes)
+      }
+
+      val (pageMs, pageBytes) = time(renderPages())
+      val (regionMs, regionBytes) = time(renderRegions())
+      val numFigures = regionsByPage.values.map(_.size).sum
+      println(s"$numFigures figures on ${regionsByPage.size} pages at $dpi DPI")
+      println(f"Whole pages: $pageMs%.1f ms, ${pageBytes / 1e6}%.1f MB of pixel buffers")
+      println(f"Regions:     $regionMs%.1f ms, ${regionBytes / 1e6}%.1f MB of pixel buffers")
+    } finally {
+      doc.close()
+    }
+  }
+}
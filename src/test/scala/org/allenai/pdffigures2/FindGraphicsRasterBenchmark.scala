@@ -0,0 +1,121 @@
+package org.allenai.pdffigures2
+
+import org.apache.pdfbox.pdmodel.PDDocument
+import org.apache.pdfbox.rendering.{ ImageType, PDFRenderer }
+
+import java.io.File
+
+import scala.collection.mutable
+
+/** Compares `FindGraphicsRaster`'s connected component labeling to the flood fill it replaced,
+  * which is kept here as a reference implementation.
+  *
+  * Usage: FindGraphicsRasterBenchmark <pdf> [<page, 0 based>] [<iterations>]
+  * Scanned pages are the interesting case, since they are why FindGraphicsRaster exists.
+  */
+object FindGraphicsRasterBenchmark {
+
+  /** The original flood fill, with its `rightPixel + 1` and top row bugs fixed */
+  def floodFillBoundingBoxes(
+    pixelsIn: Array[Int],
+    w: Int,
+    h: Int,
+    pixThreshold: Int,
+    rescale: Int
+  ): List[Box] = {
+    val pixels = pixelsIn.clone()
+    val pixelsToExplore = mutable.Set[Int]()
+    var boundingBoxes = List[Box]()
+    for (y <- 0 until h) {
+      for (x <- 0 until w) {
+        val pixelIndex = x + y * w
+        if (pixels(pixelIndex) < pixThreshold) {
+          var minX = x
+          var maxX = x
+          var minY = y
+          var maxY = y
+          pixelsToExplore.add(pixelIndex)
+          while (pixelsToExplore.nonEmpty) {
+            val currentPixel = pixelsToExplore.head
+            pixelsToExplore.remove(currentPixel)
+            if (currentPixel >= w) {
+              val lowerPixel = currentPixel - w
+              if (pixels(lowerPixel) < pixThreshold) {
+                pixelsToExplore.add(lowerPixel)
+                minY = Math.min(minY, lowerPixel / w)
+              }
+            }
+            if (currentPixel < pixels.length - w) {
+              val upperPixel = currentPixel + w
+              if (pixels(upperPixel) < pixThreshold) {
+                pixelsToExplore.add(upperPixel)
+                maxY = Math.max(maxY, upperPixel / w)
+              }
+            }
+            if (currentPixel % w != 0) {
+              val leftPixel = currentPixel - 1
+              if (pixels(leftPixel) < pixThreshold) {
+                pixelsToExplore.add(leftPixel)
+                minX = Math.min(minX, leftPixel % w)
+              }
+            }
+            if ((currentPixel + 1) % w != 0) {
+              val rightPixel = currentPixel + 1
+              if (pixels(rightPixel) < pixThreshold) {
+                pixelsToExplore.add(rightPixel)
+                maxX = Math.max(maxX, rightPixel % w)
+              }
+            }
+            pixels(currentPixel) = pixThreshold
+          }
+          boundingBoxes = Box(minX * rescale, minY * rescale, maxX * rescale, maxY * rescale) ::
+            boundingBoxes
+        }
+      }
+    }
+    boundingBoxes
+  }
+
+  /** Renders `page` of `doc` the same way `FindGraphicsRaster` does */
+  def renderPage(doc: PDDocument, page: Int): (Array[Int], Int, Int) = {
+    val img = new PDFRenderer(doc).renderImageWithDPI(page, 72, ImageType.GRAY)
+    val pixels = new Array[Int](img.getWidth * img.getHeight)
+    img.getRaster.getPixels(0, 0, img.getWidth, img.getHeight, pixels)
+    (pixels, img.getWidth, img.getHeight)
+  }
+
+  private def timeMillis(iterations: Int)(fn: => Unit): Double = {
+    val start = System.nanoTime()
+    for (_ <- 0 until iterations) fn
+    (System.nanoTime() - start) / 1000000.0 / iterations
+  }
+
+  def main(args: Array[String]): Unit = {
+    val page = if (args.length > 1) args(1).toInt else 0
+    val iterations = if (args.length > 2) args(2).toInt else 20
+    val doc = PDDocument.load(new File(args(0)))
+    val (pixels, w, h) =
+      try {
+        renderPage(doc, page)
+      } finally {
+        doc.close()
+      }
+    val threshold = 240
+    val expected = floodFillBoundingBoxes(pixels, w, h, threshold, 1)
+    val actual = FindGraphicsRaster.findCCBoundingBoxes(pixels.clone(), w, h, threshold, 1)
+    require(expected == actual, "Union-find and flood fill results differ")
+
+    // Warm up the JIT before timing
+    timeMillis(math.max(iterations / 4, 1)) {
+      floodFillBoundingBoxes(pixels, w, h, threshold, 1)
+      FindGraphicsRaster.findCCBoundingBoxes(pixels.clone(), w, h, threshold, 1)
+    }
+    val floodFill = timeMillis(iterations) { floodFillBoundingBoxes(pixels, w, h, threshold, 1) }
+    val unionFind = timeMillis(iterations) {
+      FindGraphicsRaster.findCCBoundingBoxes(pixels.clone(), w, h, threshold, 1)
+    }
+    println(s"Page $page: ${w}x$h pixels, ${expected.size} components")
+    println(f"Flood fill:  $floodFill%.2f ms")
+    println(f"Union-find:  $unionFind%.2f ms (${floodFill / unionFind}%.1fx faster)")
+  }
+}
@@ -0,0 +1,41 @@
+package org.allenai.pdffigures2
+
+import org.apache.pdfbox.pdmodel.PDDocument
+import org.scalatest.funsuite.AnyFunSuite
+
+class TestFigureRenderer extends AnyFunSuite {
+
+  test("Rendering a region should match cropping it out of the rendered page") {
+    val pdf = PDDocument.load(
+      getClass.getClassLoader.getResourceAsStream(
+        "test-pdfs/498bb0efad6ec15dd09d941fb309aa18d6df9f5f.pdf"
+      )
+    )
+    try {
+      val dpi = 150
+      val renderer = new InterruptiblePDFRenderer(pdf)
+      val pageImg = renderer.renderImageWithDPI(0, dpi)
+      assert(
+        FigureRenderer.pageSizeInPixels(pdf, 0, dpi) === ((pageImg.getWidth, pageImg.getHeight))
+      )
+      val w = pageImg.getWidth
+      val h = pageImg.getHeight
+      val regions = Seq((0, 0, w - 1, h - 1), (0, 0, 99, 49), (w / 3, h / 4, w / 2, h / 2))
+      regions.foreach {
+        case (x1, y1, x2, y2) =>
+          val region = FigureRenderer.renderRegion(renderer, 0, dpi, x1, y1, x2, y2)
+          assert(region.getWidth === x2 - x1 + 1)
+          assert(region.getHeight === y2 - y1 + 1)
+          // Allow a few anti-aliased edge pixels to differ
+          val differing = (for {
+            x <- 0 until region.getWidth
+            y <- 0 until region.getHeight
+            if region.getRGB(x, y) != pageImg.getRGB(x + x1, y + y1)
+          } yield 1).size
+          assert(differing <= region.getWidth * region.getHeight / 100)
+      }
+    } finally {
+      pdf.close()
+    }
+  }
+}
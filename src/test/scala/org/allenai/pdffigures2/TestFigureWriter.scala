@@ -0,0 +1,60 @@
+package org.allenai.pdffigures2
+
+import org.scalatest.funsuite.AnyFunSuite
+
+import java.awt.Color
+import java.awt.image.BufferedImage
+import java.io.File
+import javax.imageio.ImageIO
+
+class TestFigureWriter extends AnyFunSuite {
+
+  private def testImage(): BufferedImage = {
+    val image = new BufferedImage(64, 32, BufferedImage.TYPE_INT_RGB)
+    val graphics = image.createGraphics()
+    graphics.setColor(Color.WHITE)
+    graphics.fillRect(0, 0, 64, 32)
+    graphics.setColor(Color.BLACK)
+    graphics.fillRect(8, 8, 16, 16)
+    graphics.dispose()
+    image
+  }
+
+  test("Queued images should be written and timed") {
+    val dir = java.nio.file.Files.createTempDirectory("figure-writer").toFile
+    val writer = new FigureWriter(2, 1)
+    val timings = new StageTimings()
+    try {
+      val image = testImage()
+      val files = (0 until 8).map(i => new File(dir, s"figure-$i.png"))
+      val start = System.nanoTime()
+      val writes = files.map(file => writer.write(image, "png", file, Some(timings)))
+      writes.foreach(write => assert(write.get() >= start))
+      files.foreach { file =>
+        val read = ImageIO.read(file)
+        assert((read.getWidth, read.getHeight) === ((64, 32)))
+        assert(read.getRGB(10, 10) === image.getRGB(10, 10))
+        assert(read.getRGB(40, 20) === image.getRGB(40, 20))
+      }
+      assert(writer.pending === 0)
+      assert(timings.stageMillis.contains(StageTimings.WriteFigures))
+    } finally {
+      writer.close()
+      dir.listFiles().foreach(_.delete())
+      dir.delete()
+    }
+  }
+
+  test("Compression options should be applied to formats that support them") {
+    val file = File.createTempFile("figure", ".jpg")
+    try {
+      val image = testImage()
+      FigureWriter.writeImage(image, "jpg", file, FigureWriter.WriteOptions(Some(1.0f)))
+      val highQuality = file.length()
+      FigureWriter.writeImage(image, "jpg", file, FigureWriter.WriteOptions(Some(0.05f)))
+      assert(file.length() < highQuality)
+    } finally {
+      file.delete()
+    }
+  }
+}
@@ -0,0 +1,59 @@
+package org.allenai.pdffigures2
+
+import org.apache.pdfbox.pdmodel.PDDocument
+import org.scalatest.funsuite.AnyFunSuite
+
+import scala.util.Random
+
+class TestFindGraphicsRaster extends AnyFunSuite {
+
+  private def check(pixels: Array[Int], w: Int, h: Int, threshold: Int): Unit = {
+    val expected = FindGraphicsRasterBenchmark.floodFillBoundingBoxes(pixels, w, h, threshold, 2)
+    val actual = FindGraphicsRaster.findCCBoundingBoxes(pixels.clone(), w, h, threshold, 2)
+    assert(actual === expected)
+  }
+
+  test("Union-find labeling should match a flood fill on random images") {
+    val random = new Random(0)
+    for (density <- Seq(0.05, 0.3, 0.5, 0.6, 0.9)) {
+      for (_ <- 0 until 20) {
+        val w = random.nextInt(40) + 1
+        val h = random.nextInt(40) + 1
+        val pixels = Array.fill(w * h)(if (random.nextDouble() < density) 0 else 255)
+        check(pixels, w, h, 240)
+      }
+    }
+  }
+
+  test("Union-find labeling should handle components that merge late") {
+    // A "U" shape whose arms get different labels until the bottom row joins them, and a comb
+    // whose teeth are all joined by its last row
+    val u = Array(
+      0, 255, 0,
+      0, 255, 0,
+      0, 0, 0
+    )
+    check(u, 3, 3, 240)
+    assert(FindGraphicsRaster.findCCBoundingBoxes(u, 3, 3, 240, 1) === List(Box(0, 0, 2, 2)))
+    val comb = Array.tabulate(30 * 9) { i =>
+      val x = i % 30
+      val y = i / 30
+      if (y == 8 || x % 2 == 0 || (y == 0 && x % 4 == 1)) 0 else 255
+    }
+    check(comb, 30, 9, 240)
+  }
+
+  test("Union-find labeling should match a flood fill on a rendered page") {
+    val pdf = PDDocument.load(
+      getClass.getClassLoader.getResourceAsStream(
+        "test-pdfs/498bb0efad6ec15dd09d941fb309aa18d6df9f5f.pdf"
+      )
+    )
+    try {
+      val (pixels, w, h) = FindGraphicsRasterBenchmark.renderPage(pdf, 0)
+      check(pixels, w, h, 240)
+    } finally {
+      pdf.close()
+    }
+  }
+}
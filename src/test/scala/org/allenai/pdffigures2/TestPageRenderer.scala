@@ -0,0 +1,67 @@
+package org.allenai.pdffigures2
+
+import org.apache.pdfbox.pdmodel.PDDocument
+import org.scalatest.funsuite.AnyFunSuite
+
+import java.awt.image.BufferedImage
+
+class TestPageRenderer extends AnyFunSuite {
+
+  private def loadPdf(): PDDocument = PDDocument.load(
+    getClass.getClassLoader.getResourceAsStream(
+      "test-pdfs/498bb0efad6ec15dd09d941fb309aa18d6df9f5f.pdf"
+    )
+  )
+
+  test("Pages should be rendered once and lower DPIs derived from cached renders") {
+    val pdf = loadPdf()
+    try {
+      val renderer = new PageRenderer(pdf)
+      val page = renderer.render(0, 150)
+      assert(renderer.render(0, 150) eq page)
+      assert(renderer.getCached(0, 150).exists(_ eq page))
+      assert(renderer.getCached(0, 72).isEmpty)
+
+      val gray = renderer.renderGray(0, 72)
+      assert(gray.getType === BufferedImage.TYPE_BYTE_GRAY)
+      assert((gray.getWidth, gray.getHeight) === FigureRenderer.pageSizeInPixels(pdf, 0, 72))
+      assert(renderer.renderGray(0, 72) eq gray)
+    } finally {
+      pdf.close()
+    }
+  }
+
+  test("Renders that are only needed once should not be cached") {
+    val pdf = loadPdf()
+    try {
+      val renderer = new PageRenderer(pdf)
+      val page = renderer.renderOnce(0, 150)
+      assert((page.getWidth, page.getHeight) === FigureRenderer.pageSizeInPixels(pdf, 0, 150))
+      assert(renderer.getCached(0, 150).isEmpty)
+
+      val cached = renderer.render(0, 150)
+      assert(renderer.renderOnce(0, 150) eq cached)
+      renderer.renderOnce(0, 72)
+      assert(renderer.getCached(0, 72).isEmpty)
+    } finally {
+      pdf.close()
+    }
+  }
+
+  test("Least recently used pages should be evicted once the cache is full") {
+    val pdf = loadPdf()
+    try {
+      val (w, h) = FigureRenderer.pageSizeInPixels(pdf, 0, 72)
+      // Room for two pages rendered in color at 72 DPI
+      val renderer = new PageRenderer(pdf, w.toLong * h * 4 * 2 + 1)
+      val first = renderer.render(0, 72)
+      renderer.render(1, 72)
+      renderer.render(0, 72)
+      renderer.render(2, 72)
+      assert(renderer.getCached(0, 72).exists(_ eq first))
+      assert(renderer.getCached(1, 72).isEmpty)
+    } finally {
+      pdf.close()
+    }
+  }
+}
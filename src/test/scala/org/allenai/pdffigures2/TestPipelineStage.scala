@@ -0,0 +1,80 @@
+package org.allenai.pdffigures2
+
+import org.scalatest.funsuite.AnyFunSuite
+
+import java.util.concurrent.atomic.AtomicInteger
+import java.util.concurrent.{ CountDownLatch, TimeUnit }
+
+class TestPipelineStage extends AnyFunSuite {
+
+  test("Tasks should run and be passed on to the next stage") {
+    val first = new PipelineStage("first", 2, 1)
+    val second = new PipelineStage("second", 1, 1)
+    val done = new AtomicInteger(0)
+    (0 until 10).foreach { _ =>
+      first.submit {
+        second.submit { done.incrementAndGet() }
+      }
+    }
+    first.close()
+    second.close()
+    assert(done.get() === 10)
+    Seq(first, second).foreach { stage =>
+      val stats = stage.statistics
+      assert(stats.tasks === 10)
+      assert(stats.utilization >= 0 && stats.utilization <= 1)
+    }
+  }
+
+  test("Time blocked on the next stage should not count towards utilization") {
+    val first = new PipelineStage("first", 1, 0)
+    val second = new PipelineStage("second", 1, 0)
+    (0 until 5).foreach { _ =>
+      first.submitThen {
+        () => second.submit { Thread.sleep(100) }
+      }
+    }
+    first.close()
+    second.close()
+    val firstStats = first.statistics
+    val secondStats = second.statistics
+    assert(firstStats.tasks === 5)
+    assert(secondStats.tasks === 5)
+    assert(secondStats.blockedMillis > 0)
+    assert(firstStats.busyMillis < 50)
+    assert(firstStats.utilization < 0.2)
+    assert(secondStats.utilization > 0.5)
+  }
+
+  test("Submitting should block while the queue is full") {
+    val stage = new PipelineStage("stage", 1, 1)
+    val release = new CountDownLatch(1)
+    val started = new CountDownLatch(1)
+    stage.submit {
+      started.countDown()
+      release.await()
+    }
+    assert(started.await(10, TimeUnit.SECONDS))
+    stage.submit {} // Waits in the queue
+    assert(stage.queueDepth === 1)
+
+    val submitted = new CountDownLatch(1)
+    val submitter = new Thread(new Runnable {
+      override def run(): Unit = {
+        stage.submit {}
+        submitted.countDown()
+      }
+    })
+    submitter.start()
+    assert(!submitted.await(200, TimeUnit.MILLISECONDS))
+    release.countDown()
+    assert(submitted.await(10, TimeUnit.SECONDS))
+    submitter.join()
+    stage.close()
+
+    val stats = stage.statistics
+    assert(stats.tasks === 3)
+    assert(stats.maxQueueDepth <= 1)
+    assert(stats.blockedMillis > 0)
+  }
+}